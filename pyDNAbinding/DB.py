@@ -1,24 +1,293 @@
-import numpy as np
+import os
+import re
+import sys
+import time
+import hashlib
+import threading
+import cPickle as pickle
 
 from collections import namedtuple
+from contextlib import contextmanager
 
-import psycopg2
-conn = psycopg2.connect("host=mitra dbname=cisbp")
+import numpy as np
 
 from binding_model import (
     PWMBindingModel, EnergeticDNABindingModel, DNABindingModels )
+import profiling
+
+################################################################################
+# Connection and cache configuration
+#
+# Connections are only opened when a query isn't in the cache. All of the
+# settings can be changed through environment variables or the configure_*
+# functions below.
+
+DB_CONNECTION_STRING = os.environ.get(
+    'PYDNABINDING_DB', "host=mitra dbname=cisbp")
+CACHE_DIR = os.environ.get(
+    'PYDNABINDING_DB_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'pyDNAbinding', 'db'))
+# the number of seconds that a cached query result is considered fresh
+CACHE_TTL = float(os.environ.get('PYDNABINDING_DB_CACHE_TTL', 7*24*60*60))
+# serve all queries from the cache, and never open a DB connection
+OFFLINE = os.environ.get('PYDNABINDING_OFFLINE', '') not in ('', '0')
+MAX_POOL_SIZE = 4
+
+def _psycopg2_connect():
+    import psycopg2
+    return psycopg2.connect(DB_CONNECTION_STRING)
+
+_connection_factory = _psycopg2_connect
+# the DB-API parameter style of the connections - 'format' (%s) or 'qmark' (?)
+_paramstyle = 'format'
+_pool = None
+_pool_lock = threading.Lock()
+
+# in memory copies of the cached query results and the models built from them
+_query_results = {}
+_models = {}
+
+def set_connection_factory(connection_factory, paramstyle='format'):
+    """Open DB connections with connection_factory().
+
+    This allows a stand-in DB (e.g. a local sqlite3 database) to be used
+    in place of the cisbp postgres DB.
+    """
+    global _connection_factory, _paramstyle, _pool
+    assert paramstyle in ('format', 'qmark')
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+        _pool = None
+        _connection_factory = connection_factory
+        _paramstyle = paramstyle
+    return
+
+def set_offline_mode(offline=True):
+    global OFFLINE
+    OFFLINE = offline
+
+def configure_cache(cache_dir=None, ttl=None):
+    global CACHE_DIR, CACHE_TTL
+    if cache_dir is not None:
+        CACHE_DIR = cache_dir
+    if ttl is not None:
+        CACHE_TTL = ttl
+    clear_memory_cache()
+    return
+
+class ConnectionPool(object):
+    """A thread safe pool of at most max_size DB connections.
+
+    """
+    def getconn(self):
+        with self._condition:
+            while len(self._idle) == 0 and self._size >= self.max_size:
+                self._condition.wait()
+            if len(self._idle) > 0:
+                return self._idle.pop()
+            self._size += 1
+        try:
+            return self._connection_factory()
+        except:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    def putconn(self, conn):
+        with self._condition:
+            self._idle.append(conn)
+            self._condition.notify()
+
+    def discard(self, conn):
+        """Close conn instead of returning it to the pool.
+
+        """
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def closeall(self):
+        with self._condition:
+            for conn in self._idle:
+                conn.close()
+            self._size -= len(self._idle)
+            self._idle = []
+
+    def __init__(self, connection_factory, max_size):
+        self._connection_factory = connection_factory
+        self.max_size = max_size
+        self._size = 0
+        self._idle = []
+        self._condition = threading.Condition()
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(_connection_factory, MAX_POOL_SIZE)
+        return _pool
+
+@contextmanager
+def db_connection():
+    """Check a connection out of the connection pool.
+
+    If the block raises, the connection's transaction is rolled back before
+    the connection is returned to the pool (a connection in an aborted 
+    transaction would fail every later query), and the connection is
+    discarded if the rollback fails.
+    """
+    if OFFLINE:
+        raise ValueError, "Can not connect to the DB in offline mode."
+    pool = _get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+    except:
+        exc_info = sys.exc_info()
+        try:
+            conn.rollback()
+        except Exception:
+            pool.discard(conn)
+        else:
+            pool.putconn(conn)
+        raise exc_info[0], exc_info[1], exc_info[2]
+    pool.putconn(conn)
+
+def _convert_paramstyle(query):
+    if _paramstyle == 'format':
+        return query
+    # replace the %s place holders, and un-escape %%
+    return re.sub('%(%|s)', lambda m: '%' if m.group(1) == '%' else '?', query)
+
+################################################################################
+# Query result cache
+#
+# Query results are cached on disk, keyed by the query string and parameters,
+# as pickled (timestamp, rows) tuples.
+
+def _cache_key(query, params):
+    return hashlib.sha1(repr((" ".join(query.split()), tuple(params)))
+                        ).hexdigest()
+
+def _cache_fname(key):
+    return os.path.join(CACHE_DIR, key + ".pkl")
+
+def _read_cached_result(key):
+    if key in _query_results:
+        return _query_results[key]
+    try:
+        with open(_cache_fname(key), 'rb') as fp:
+            result = pickle.load(fp)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+    _query_results[key] = result
+    return result
+
+def _write_cached_result(key, result):
+    _query_results[key] = result
+    if not os.path.exists(CACHE_DIR):
+        try: os.makedirs(CACHE_DIR)
+        except OSError: pass # another process created the directory
+    # write to a temporary file and then move it, so that concurrent readers
+    # never see a partially written file
+    tmp_fname = "%s.%i.tmp" % (_cache_fname(key), os.getpid())
+    with open(tmp_fname, 'wb') as ofp:
+        pickle.dump(result, ofp, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_fname, _cache_fname(key))
+    return
+
+def clear_memory_cache():
+    _query_results.clear()
+    _models.clear()
+
+def invalidate_cache():
+    """Remove all cached query results.
+
+    """
+    clear_memory_cache()
+    if not os.path.exists(CACHE_DIR): return
+    for fname in os.listdir(CACHE_DIR):
+        if fname.endswith('.pkl'):
+            os.unlink(os.path.join(CACHE_DIR, fname))
+    return
+
+def execute_query(query, params=()):
+    """Return the rows from query, using the cache when possible.
+
+    Cached results older than CACHE_TTL seconds are re-queried, unless we are
+    in offline mode, in which case every query is served from the cache.
+    """
+    params = list(params)
+    key = _cache_key(query, params)
+    result = _read_cached_result(key)
+    if result is not None:
+        timestamp, rows = result
+        if OFFLINE or time.time() - timestamp < CACHE_TTL:
+            profiling.record_cache_lookup('DB.query', True)
+            return rows
+    profiling.record_cache_lookup('DB.query', False)
+    if OFFLINE:
+        raise ValueError, \
+            "Query results are not in the cache and offline mode is enabled."
+    with profiling.stage('DB.query'), db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(_convert_paramstyle(query), params)
+        rows = [tuple(row) for row in cur.fetchall()]
+        cur.close()
+    _models.pop(key, None)
+    _write_cached_result(key, (time.time(), rows))
+    return rows
+
+def _load_models(query, params, build_model):
+    """Return a list of models built from the rows of query.
+
+    Models are only rebuilt when the query result changes.
+    """
+    rows = execute_query(query, params)
+    key = _cache_key(query, params)
+    if key not in _models:
+        _models[key] = [build_model(row) for row in rows]
+    return list(_models[key])
+
+################################################################################
+# Loaders
+
+def _build_filter_clause(tf_names, tf_ids, motif_ids, motif_id_column):
+    """Build the where clause condition for the loader arguments.
+
+    Returns the condition (or None) and the list of query parameters.
+    """
+    if isinstance(tf_names, str): tf_names = [tf_names,]
+    if isinstance(tf_ids, str): tf_ids = [tf_ids,]
+    if isinstance(motif_ids, str): motif_ids = [motif_ids,]
+
+    if tf_names == None and tf_ids == None and motif_ids == None:
+        return None, []
+    elif tf_names != None and tf_ids == None and motif_ids == None:
+        column, values = 'tf_name', list(tf_names)
+    elif tf_ids != None and motif_ids == None and tf_names == None:
+        column, values = 'tf_id', list(tf_ids)
+    elif motif_ids != None and tf_ids == None and tf_names == None:
+        column, values = motif_id_column, list(motif_ids)
+    else:
+        raise ValueError, "only one of tf_ids, tf_names, and motif_ids can can be set."
+    return "%s in (%s)" % (column, ", ".join(["%s"]*len(values))), values
 
 Genome = namedtuple('Genome', ['name', 'revision', 'species', 'filename'])
 def load_genome_metadata(annotation_id):
-    cur = conn.cursor()
     query = """
-    SELECT name, revision, species, local_filename 
-      FROM genomes 
+    SELECT name, revision, species, local_filename
+      FROM genomes
      WHERE annotation_id=%s;
     """
-    cur.execute(query, [annotation_id,])
-    res = cur.fetchall()
-    if len(res) == 0: 
+    res = execute_query(query, [annotation_id,])
+    if len(res) == 0:
         raise ValueError, \
             "No genome exists in the DB with annotation_id '%i' " \
                 % annotation_id
@@ -26,48 +295,31 @@ def load_genome_metadata(annotation_id):
     return Genome(*(res[0]))
 
 def load_pwms_from_db(tf_names=None, tf_ids=None, motif_ids=None):
-    cur = conn.cursor()    
     query = """
-    SELECT tf_id, motif_id, tf_name, tf_species, pwm 
-      FROM related_motifs_mv NATURAL JOIN pwms 
-     WHERE tf_species in ('Mus_musculus', 'Homo_sapiens') 
-       AND rank = 1 
+    SELECT tf_id, motif_id, tf_name, tf_species, pwm
+      FROM related_motifs_mv NATURAL JOIN pwms
+     WHERE tf_species in ('Mus_musculus', 'Homo_sapiens')
+       AND rank = 1
     """
-    if isinstance(tf_names, str): tf_names = [tf_names,]
-    if isinstance(tf_ids, str): tf_ids = [tf_ids,]
-    if isinstance(motif_ids, str): motif_ids = [motif_ids,]
+    condition, params = _build_filter_clause(
+        tf_names, tf_ids, motif_ids, 'motif_id')
+    if condition is not None:
+        query += " AND " + condition
 
-    if tf_names == None and tf_ids == None and motif_ids == None:
-        cur.execute(query)
-    elif tf_names != None and tf_ids == None and motif_ids == None:
-        query += " AND tf_name in %s"
-        cur.execute(query, [tuple(tf_names),])
-    elif tf_ids != None and motif_ids == None and tf_names == None:
-        query += " AND tf_id in %s"
-        cur.execute(query, [tuple(tf_ids),])
-    elif motif_ids != None and tf_ids == None and tf_names == None:
-        query += " AND motif_id in %s"
-        cur.execute(query, [tuple(motif_ids),])
-    else:
-        raise ValueError, "only one of tf_ids, tf_names, and motif_ids can can be set."
-    
-    def iter_models():
-        for data in cur.fetchall():
-            tf_id, motif_id, tf_name, tf_species, pwm = list(data)
-            
-            yield PWMBindingModel(
-                pwm, 
-                tf_id=tf_id, 
-                motif_id=motif_id, 
-                tf_name=tf_name, 
-                tf_species=tf_species
-            )
-    
-    models = DNABindingModels(iter_models())
+    def build_model(data):
+        tf_id, motif_id, tf_name, tf_species, pwm = list(data)
+        return PWMBindingModel(
+            pwm,
+            tf_id=tf_id,
+            motif_id=motif_id,
+            tf_name=tf_name,
+            tf_species=tf_species
+        )
+
+    models = DNABindingModels(_load_models(query, params, build_model))
     return models
 
 def load_selex_models_from_db(tf_names=None, tf_ids=None, motif_ids=None):
-    cur = conn.cursor()    
     query = """
      SELECT tf_id,
         format('SELEX_%%s', selex_motif_id) AS motif_id,
@@ -77,39 +329,25 @@ def load_selex_models_from_db(tf_names=None, tf_ids=None, motif_ids=None):
         ddg_array
        FROM best_selex_models
     """
-    if isinstance(tf_names, str): tf_names = [tf_names,]
-    if isinstance(tf_ids, str): tf_ids = [tf_ids,]
-    if isinstance(motif_ids, str): motif_ids = [motif_ids,]
+    condition, params = _build_filter_clause(
+        tf_names, tf_ids, motif_ids, 'selex_models.key')
+    if condition is not None:
+        query += " WHERE " + condition
 
-    if tf_names == None and tf_ids == None and motif_ids == None:
-        cur.execute(query, [])
-    elif tf_names != None and tf_ids == None and motif_ids == None:
-        query += " WHERE tf_name in %s"
-        cur.execute(query, [tuple(tf_names),])
-    elif tf_ids != None and motif_ids == None and tf_names == None:
-        query += " WHERE tf_id in %s"
-        cur.execute(query, [tuple(tf_ids),])
-    elif motif_ids != None and tf_ids == None and tf_names == None:
-        query += " WHERE selex_models.key in %s"
-        cur.execute(query, [tuple(motif_ids),])
-    else:
-        raise ValueError, "only one of tf_ids, tf_names, and motif_ids can can be set."
+    def build_model(data):
+        ( tf_id, motif_id, tf_name, tf_species, consensus_energy, ddg_array
+          ) = data
+        ddg_array = np.array(ddg_array)
+        return EnergeticDNABindingModel(
+            consensus_energy,
+            ddg_array,
+            tf_id=tf_id,
+            motif_id=motif_id,
+            tf_name=tf_name,
+            tf_species=tf_species
+        )
 
-    def iter_models():
-        for data in cur.fetchall():
-            ( tf_id, motif_id, tf_name, tf_species, consensus_energy, ddg_array 
-              ) = data
-            ddg_array = np.array(ddg_array)
-            yield EnergeticDNABindingModel(
-                consensus_energy, 
-                ddg_array,
-                tf_id=tf_id, 
-                motif_id=motif_id, 
-                tf_name=tf_name, 
-                tf_species=tf_species
-            )
-
-    models = DNABindingModels(iter_models())
+    models = DNABindingModels(_load_models(query, params, build_model))
     if len(models) == 0:
         raise ValueError, "No motifs found (tf_ids: %s, tf_names: %s, motif_ids: %s)" % (
             tf_ids, tf_names, motif_ids)
@@ -0,0 +1,122 @@
+"""Aggregate binding site scores into per region summary statistics.
+
+The aggregations work on the last axis of a score array of any shape, so a
+whole (models, seqs, positions) score tensor is summarized in one pass.
+FixedLengthDNASequences.aggregate_models_binding_sites fuses the
+aggregation into scoring, so the full score arrays are never stored.
+
+Statistics (see RegionScoreAggregator):
+max        : the max score
+mean       : the mean score
+top_k_mean : the mean of the top_k highest scores
+count_above: the number of scores above threshold
+log_sum_exp: temperature*log(sum(exp(scores/temperature))) - with energetic
+             models (scores in kcal/mol) this is the log of the (unnormalized)
+             region occupancy at low protein concentrations
+quantiles  : the quantiles of the scores, after taking the max score over
+             non-overlapping windows of quantile_window positions (so that
+             one strong site doesn't fill the top quantiles)
+"""
+import numpy as np
+
+from misc import R, T
+
+AGGREGATION_STATS = (
+    'max', 'mean', 'top_k_mean', 'count_above', 'log_sum_exp', 'quantiles')
+DEFAULT_STATS = ('mean', 'max', 'quantiles')
+DEFAULT_QUANTILES = (0.99, 0.95, 0.90, 0.75, 0.50)
+
+def window_max(scores, window):
+    """Return the max over non-overlapping windows along the last axis.
+
+    A partial window at the end is kept.
+    """
+    if window == 1:
+        return scores
+    num_positions = scores.shape[-1]
+    num_windows = (num_positions + window - 1)//window
+    padded = np.empty(
+        scores.shape[:-1] + (num_windows*window,), dtype=scores.dtype)
+    padded[...,:num_positions] = scores
+    padded[...,num_positions:] = -np.inf
+    return padded.reshape(
+        scores.shape[:-1] + (num_windows, window)).max(-1)
+
+def log_sum_exp(scores, temperature=R*T):
+    max_scores = scores.max(-1)
+    return max_scores + temperature*np.log(np.exp(
+        (scores - max_scores[...,None])/temperature).sum(-1))
+
+def top_k_mean(scores, k):
+    k = min(k, scores.shape[-1])
+    return np.partition(scores, -k, axis=-1)[...,-k:].mean(-1)
+
+class RegionScoreAggregator(object):
+    """Compute a fixed set of summary statistics of binding site scores.
+
+    """
+    @property
+    def stat_names(self):
+        """The names of the aggregated values, in output order.
+
+        """
+        names = []
+        for stat in self.stats:
+            if stat == 'top_k_mean':
+                names.append('top%i_mean' % self.top_k)
+            elif stat == 'count_above':
+                names.append('count_above_%g' % self.threshold)
+            elif stat == 'quantiles':
+                names.extend('q%g' % (100*x) for x in self.quantiles)
+            else:
+                names.append(stat)
+        return names
+
+    @property
+    def num_stats(self):
+        return len(self.stat_names)
+
+    def aggregate(self, scores, out=None):
+        """Aggregate scores along the last axis.
+
+        Returns a scores.shape[:-1] + (num_stats,) float32 array.
+        """
+        if out is None:
+            out = np.empty(scores.shape[:-1] + (self.num_stats,), dtype='float32')
+        i = 0
+        for stat in self.stats:
+            if stat == 'max':
+                out[...,i] = scores.max(-1)
+            elif stat == 'mean':
+                out[...,i] = scores.mean(-1)
+            elif stat == 'top_k_mean':
+                out[...,i] = top_k_mean(scores, self.top_k)
+            elif stat == 'count_above':
+                out[...,i] = (scores > self.threshold).sum(-1)
+            elif stat == 'log_sum_exp':
+                out[...,i] = log_sum_exp(scores, self.temperature)
+            elif stat == 'quantiles':
+                quantiles = np.percentile(
+                    window_max(scores, self.quantile_window),
+                    [100*x for x in self.quantiles], axis=-1)
+                # np.percentile puts the quantiles on the first axis
+                out[...,i:i+len(self.quantiles)] = np.rollaxis(
+                    quantiles, 0, quantiles.ndim)
+                i += len(self.quantiles)
+                continue
+            i += 1
+        return out
+
+    def __init__(self, stats=DEFAULT_STATS, top_k=5, threshold=0.0,
+                 quantiles=DEFAULT_QUANTILES, quantile_window=1,
+                 temperature=R*T):
+        for stat in stats:
+            if stat not in AGGREGATION_STATS:
+                raise ValueError, "Unrecognized aggregation statistic '%s' (expecting one of %s)" % (
+                    stat, ", ".join(AGGREGATION_STATS))
+        self.stats = tuple(stats)
+        self.top_k = top_k
+        self.threshold = threshold
+        self.quantiles = tuple(quantiles)
+        self.quantile_window = quantile_window
+        self.temperature = temperature
@@ -0,0 +1,205 @@
+"""GC content aware background binding site score distributions.
+
+Binding site scores from regions with different GC content aren't directly
+comparable - a GC rich motif scores higher in GC rich regions by chance. A
+BackgroundTable stores, for each GC content bin, the quantiles of a model's
+binding site scores in random sequence with that GC content, so scores can
+be converted to background p-values (or z-scores) without resampling.
+
+Tables are built once per model and cached in memory and on disk, keyed by
+the model's filter hash (see ModelSummary) and the table parameters. The
+disk cache directory defaults to ~/.cache/pyDNAbinding/background, and can
+be set with the PYDNABINDING_BACKGROUND_CACHE environment variable.
+
+Example:
+
+table = get_background_table(model)
+pvalues = table.pvalues(
+    model.score_binding_sites(seq, 'MAX'), calc_gc_content(seq))
+"""
+import os
+import hashlib
+
+import numpy as np
+
+from sequence import (
+    code_encode_sequence, sample_random_coded_seqs, decode_coded_seqs,
+    UNKNOWN_BASE )
+import profiling
+
+DEFAULT_GC_BIN_EDGES = tuple(np.linspace(0.2, 0.8, 13).round(3))
+DEFAULT_NUM_BACKGROUND_SITES = 100000
+
+BACKGROUND_CACHE_ENV_VARIABLE = 'PYDNABINDING_BACKGROUND_CACHE'
+DEFAULT_BACKGROUND_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'pyDNAbinding', 'background')
+
+_background_tables = {}
+
+def background_cache_dir():
+    return os.environ.get(
+        BACKGROUND_CACHE_ENV_VARIABLE, DEFAULT_BACKGROUND_CACHE_DIR)
+
+def calc_gc_content(seq):
+    """Return the fraction of the known bases of seq that are G or C.
+
+    Returns 0.5 if seq has no known bases.
+    """
+    codes = code_encode_sequence(seq)
+    num_known = (codes != UNKNOWN_BASE).sum()
+    if num_known == 0:
+        return 0.5
+    return float(((codes == 1) | (codes == 2)).sum())/num_known
+
+def _quantile_levels(num_sites):
+    # evenly spaced levels, plus log spaced levels in the upper tail so that
+    # small p-values are resolved down to 1/num_sites
+    return np.unique(np.concatenate((
+        np.linspace(0, 1, 101),
+        1 - np.logspace(-2, -np.log10(num_sites), 101) )))
+
+class BackgroundTable(object):
+    """The background score distribution of a model in each GC content bin.
+
+    GC bin i covers [gc_bin_edges[i], gc_bin_edges[i+1]), and GC contents
+    outside of the edges use the first or last bin. Each bin was sampled at
+    its center GC content.
+    """
+    __slots__ = ['gc_bin_edges', 'quantile_levels', 'score_quantiles',
+                 'means', 'sds', 'num_sites', 'filter_hash', 'direction']
+
+    @property
+    def num_gc_bins(self):
+        return len(self.gc_bin_edges) - 1
+
+    @property
+    def gc_bin_centers(self):
+        return (self.gc_bin_edges[1:] + self.gc_bin_edges[:-1])/2
+
+    def gc_bins(self, gc_contents):
+        """Return the GC bin index of each GC content.
+
+        """
+        return np.clip(
+            np.searchsorted(self.gc_bin_edges, gc_contents, side='right') - 1,
+            0, self.num_gc_bins - 1)
+
+    def _iter_gc_bin_scores(self, scores, gc_contents):
+        scores = np.asarray(scores)
+        bins = np.broadcast_to(self.gc_bins(gc_contents), scores.shape)
+        for gc_bin in np.unique(bins):
+            is_in_bin = (bins == gc_bin)
+            yield gc_bin, is_in_bin, scores[is_in_bin]
+
+    def pvalues(self, scores, gc_contents):
+        """Return the fraction of background sites that score at least scores.
+
+        gc_contents is a GC content, or an array that broadcasts against
+        scores. The p-values are at least 1/num_sites.
+        """
+        rv = np.empty(np.shape(scores), dtype='float64')
+        for gc_bin, is_in_bin, bin_scores in self._iter_gc_bin_scores(
+                scores, gc_contents):
+            rv[is_in_bin] = 1 - np.interp(
+                bin_scores, self.score_quantiles[gc_bin], self.quantile_levels)
+        return np.maximum(rv, 1./self.num_sites)
+
+    def zscores(self, scores, gc_contents):
+        """Return the scores standardized by the background mean and sd.
+
+        """
+        rv = np.empty(np.shape(scores), dtype='float64')
+        for gc_bin, is_in_bin, bin_scores in self._iter_gc_bin_scores(
+                scores, gc_contents):
+            rv[is_in_bin] = (bin_scores - self.means[gc_bin])/self.sds[gc_bin]
+        return rv
+
+    def save(self, fname):
+        np.savez(fname, **dict(
+            (key, getattr(self, key)) for key in self.__slots__))
+
+    @classmethod
+    def load(cls, fname):
+        data = np.load(fname)
+        rv = cls.__new__(cls)
+        for key in cls.__slots__:
+            setattr(rv, key, data[key])
+        rv.num_sites = int(rv.num_sites)
+        rv.filter_hash, rv.direction = str(rv.filter_hash), str(rv.direction)
+        return rv
+
+    def __init__(self, model, gc_bin_edges=DEFAULT_GC_BIN_EDGES,
+                 num_sites=DEFAULT_NUM_BACKGROUND_SITES, direction='MAX',
+                 random_state=0):
+        """Sample the background score distributions of model.
+
+        Each GC bin scores num_sites binding sites in one iid random
+        sequence.
+        """
+        if not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
+        self.gc_bin_edges = np.array(gc_bin_edges, dtype='float64')
+        if len(self.gc_bin_edges) < 2 or (np.diff(self.gc_bin_edges) <= 0).any():
+            raise ValueError, "The GC bin edges must be increasing"
+        self.num_sites = num_sites
+        self.filter_hash = model.summary.filter_hash
+        self.direction = direction
+        self.quantile_levels = _quantile_levels(num_sites)
+        self.score_quantiles = np.empty(
+            (self.num_gc_bins, len(self.quantile_levels)), dtype='float32')
+        self.means = np.empty(self.num_gc_bins, dtype='float64')
+        self.sds = np.empty(self.num_gc_bins, dtype='float64')
+        with profiling.stage('background'):
+            for i, gc_content in enumerate(self.gc_bin_centers):
+                seq = decode_coded_seqs(sample_random_coded_seqs(
+                    1, num_sites + model.motif_len - 1, gc_content,
+                    random_state))[0]
+                scores = model.score_binding_sites(seq, direction)
+                self.score_quantiles[i] = np.percentile(
+                    scores, 100*self.quantile_levels)
+                self.means[i] = scores.mean()
+                self.sds[i] = scores.std()
+
+def _cache_key(model, gc_bin_edges, num_sites, direction, seed):
+    return hashlib.sha1(repr((
+        model.summary.filter_hash, tuple(float(x) for x in gc_bin_edges),
+        int(num_sites), direction, seed))).hexdigest()
+
+def get_background_table(model, gc_bin_edges=DEFAULT_GC_BIN_EDGES,
+                         num_sites=DEFAULT_NUM_BACKGROUND_SITES,
+                         direction='MAX', seed=0, use_disk_cache=True):
+    """Return model's BackgroundTable, building it if it isn't cached.
+
+    """
+    key = _cache_key(model, gc_bin_edges, num_sites, direction, seed)
+    table = _background_tables.get(key)
+    fname = os.path.join(background_cache_dir(), key + '.npz')
+    if table is None and use_disk_cache and os.path.exists(fname):
+        table = BackgroundTable.load(fname)
+        _background_tables[key] = table
+    profiling.record_cache_lookup('background', table is not None)
+    if table is None:
+        table = BackgroundTable(
+            model, gc_bin_edges, num_sites, direction, seed)
+        _background_tables[key] = table
+        if use_disk_cache:
+            if not os.path.exists(os.path.dirname(fname)):
+                os.makedirs(os.path.dirname(fname))
+            # write to a temporary file first, so that other processes never
+            # load a partially written table
+            tmp_fname = "%s.%i.tmp.npz" % (fname[:-len('.npz')], os.getpid())
+            table.save(tmp_fname)
+            os.rename(tmp_fname, fname)
+    return table
+
+def get_background_tables(models, **kwargs):
+    """Return the BackgroundTable of every model (see get_background_table).
+
+    """
+    return [get_background_table(model, **kwargs) for model in models]
+
+def clear_background_cache():
+    """Clear the in memory cache (the disk cache is left in place).
+
+    """
+    _background_tables.clear()
@@ -0,0 +1,266 @@
+"""Benchmarks for the scoring hot paths.
+
+All of the benchmarks use synthetic (seeded) models and sequences, so they
+don't need the DB. To run them, and check for regressions against a stored
+baseline:
+
+python -m pyDNAbinding.benchmark --output results.json --baseline baseline.json
+
+A benchmark regresses when its time exceeds the baseline time by more than
+the threshold fraction (25% by default), in which case the exit status is 1.
+Use --save-baseline to store the results as the new baseline.
+"""
+import re
+import sys
+import json
+import time
+import platform
+import argparse
+
+from collections import OrderedDict
+
+import numpy as np
+
+from sequence import one_hot_encode_sequences, dinucleotide_encode_sequences
+from signal import (
+    multichannel_fftconvolve, multichannel_overlap_add_fftconvolve )
+from binding_model import (
+    EnergeticDNABindingModel, FixedLengthDNASequences,
+    est_chem_potential_from_affinities )
+
+DEFAULT_REGRESSION_THRESHOLD = 0.25
+MIN_BENCHMARK_TIME = 0.2
+
+BENCHMARKS = OrderedDict()
+
+def benchmark(name):
+    """Register a benchmark.
+
+    The decorated function should perform any set up, and then return the
+    function to be timed.
+    """
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+def build_random_seqs(n_seqs, seq_len, seed=0):
+    random_state = np.random.RandomState(seed)
+    bases = np.array(list('ACGT'))
+    return ["".join(x) for x in bases[
+        random_state.randint(4, size=(n_seqs, seq_len))]]
+
+def build_random_models(n_models, motif_len, seed=0):
+    random_state = np.random.RandomState(seed)
+    return [ EnergeticDNABindingModel(
+                 random_state.randn(),
+                 random_state.randn(motif_len, 4),
+                 motif_id='RANDOM_%i' % i)
+             for i in xrange(n_models) ]
+
+def build_random_dinucleotide_models(n_models, motif_len, seed=0):
+    random_state = np.random.RandomState(seed)
+    models = []
+    for i in xrange(n_models):
+        ddg_array = random_state.randn(motif_len, 16)
+        # the last row would score the base after the binding site
+        ddg_array[-1] = 0
+        models.append(EnergeticDNABindingModel(
+            random_state.randn(), ddg_array,
+            motif_id='RANDOM_DINUCLEOTIDE_%i' % i))
+    return models
+
+################################################################################
+# Benchmarks
+
+@benchmark('encode_one_hot_1000x1000')
+def bench_encode():
+    seqs = build_random_seqs(1000, 1000)
+    return lambda: one_hot_encode_sequences(seqs)
+
+@benchmark('encode_dinucleotide_1000x1000')
+def bench_encode_dinucleotide():
+    seqs = build_random_seqs(1000, 1000)
+    return lambda: dinucleotide_encode_sequences(seqs)
+
+for _seq_len in (100, 1000, 10000, 100000, 1000000):
+    @benchmark('score_seq_FWD_len%i' % _seq_len)
+    def bench_score_seq(seq_len=_seq_len):
+        seq = build_random_seqs(1, seq_len)[0]
+        model = build_random_models(1, 20)[0]
+        return lambda: model.score_binding_sites(seq, 'FWD')
+
+@benchmark('score_seq_MAX_len100000')
+def bench_score_seq_max():
+    seq = build_random_seqs(1, 100000)[0]
+    model = build_random_models(1, 20)[0]
+    return lambda: model.score_binding_sites(seq, 'MAX')
+
+# the dinucleotide benchmarks have the same sizes as the one-hot benchmarks
+# above, so they measure the cost of the 16 channel encoding
+@benchmark('score_seq_dinucleotide_MAX_len100000')
+def bench_score_seq_dinucleotide_max():
+    seq = build_random_seqs(1, 100000)[0]
+    model = build_random_dinucleotide_models(1, 20)[0]
+    return lambda: model.score_binding_sites(seq, 'MAX')
+
+@benchmark('score_fixed_length_MAX_1000x500')
+def bench_score_fixed_length_seqs():
+    seqs = FixedLengthDNASequences(build_random_seqs(1000, 500))
+    model = build_random_models(1, 20)[0]
+    return lambda: seqs.score_binding_sites(model, 'MAX')
+
+@benchmark('score_fixed_length_blas_MAX_100models_500x200')
+def bench_score_fixed_length_seqs_blas():
+    seqs = FixedLengthDNASequences(build_random_seqs(500, 200))
+    models = build_random_models(100, 12)
+    return lambda: seqs.score_models_binding_sites(models, 'MAX')
+
+@benchmark('score_fixed_length_dinucleotide_MAX_1000x500')
+def bench_score_fixed_length_seqs_dinucleotide():
+    seqs = FixedLengthDNASequences(build_random_seqs(1000, 500))
+    model = build_random_dinucleotide_models(1, 20)[0]
+    seqs.dinucleotide_coded_seqs
+    return lambda: seqs.score_binding_sites(model, 'MAX')
+
+@benchmark('score_fixed_length_blas_dinucleotide_MAX_100models_500x200')
+def bench_score_fixed_length_seqs_blas_dinucleotide():
+    seqs = FixedLengthDNASequences(build_random_seqs(500, 200))
+    models = build_random_dinucleotide_models(100, 12)
+    seqs.dinucleotide_coded_seqs
+    return lambda: seqs.score_models_binding_sites(models, 'MAX')
+
+@benchmark('fft_convolve_len10000')
+def bench_fft_convolve():
+    x = one_hot_encode_sequences(build_random_seqs(1, 10000))[0]
+    h = build_random_models(1, 20)[0].convolutional_filter
+    return lambda: multichannel_fftconvolve(x, h)
+
+@benchmark('overlap_add_convolve_len1000000')
+def bench_overlap_add_convolve():
+    x = one_hot_encode_sequences(build_random_seqs(1, 1000000))[0]
+    h = build_random_models(1, 20)[0].convolutional_filter
+    return lambda: multichannel_overlap_add_fftconvolve(x, h)
+
+@benchmark('est_chem_potential_10000')
+def bench_est_chem_potential():
+    seqs = FixedLengthDNASequences(build_random_seqs(10000, 100))
+    model = build_random_models(1, 20)[0]
+    affinities = -(seqs.score_binding_sites(model, 'MAX').max(1))
+    return lambda: est_chem_potential_from_affinities(affinities, 1e-7, 1e-8)
+
+# END Benchmarks
+################################################################################
+
+def time_benchmark(fn, repeat=3, min_time=MIN_BENCHMARK_TIME):
+    """Return the best time per call of fn over repeat runs.
+
+    Each run calls fn enough times to take at least min_time seconds.
+    """
+    # calibrate the number of calls per run
+    number = 1
+    while True:
+        start = time.time()
+        for i in xrange(number): fn()
+        elapsed = time.time() - start
+        if elapsed >= min_time: break
+        number *= 2 if elapsed == 0 else max(
+            2, int(min_time/elapsed) + 1)
+    times = [elapsed/number,]
+    for i in xrange(repeat-1):
+        start = time.time()
+        for i in xrange(number): fn()
+        times.append((time.time() - start)/number)
+    return min(times), number
+
+def run_benchmarks(name_pattern=None, repeat=3, verbose=False):
+    """Run the benchmarks whose names match name_pattern.
+
+    Returns an OrderedDict mapping the benchmark names to results dicts.
+    """
+    results = OrderedDict()
+    for name, setup in BENCHMARKS.iteritems():
+        if name_pattern is not None and not re.search(name_pattern, name):
+            continue
+        best_time, number = time_benchmark(setup(), repeat)
+        results[name] = OrderedDict(
+            [('time', best_time), ('number', number), ('repeat', repeat)])
+        if verbose:
+            print >> sys.stderr, "%-40s %.6fs" % (name, best_time)
+    return results
+
+def find_regressions(results, baseline, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    """Return (name, baseline_time, time) for every regressed benchmark.
+
+    Benchmarks that are missing from the baseline are skipped.
+    """
+    regressions = []
+    for name, result in results.iteritems():
+        if name not in baseline: continue
+        baseline_time = baseline[name]['time']
+        if result['time'] > baseline_time*(1+threshold):
+            regressions.append((name, baseline_time, result['time']))
+    return regressions
+
+def build_results_dict(results):
+    return OrderedDict([
+        ('machine', OrderedDict([
+            ('platform', platform.platform()),
+            ('processor', platform.processor()),
+            ('python', platform.python_version()),
+            ('numpy', np.__version__)])),
+        ('benchmarks', results)
+    ])
+
+def load_results(fname):
+    with open(fname) as fp:
+        return json.load(fp)['benchmarks']
+
+def save_results(results, fname):
+    with open(fname, 'w') as ofp:
+        json.dump(build_results_dict(results), ofp, indent=2)
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pyDNAbinding scoring hot paths.')
+    parser.add_argument('--output',
+        help='write the benchmark results to this json file')
+    parser.add_argument('--baseline',
+        help='compare the results against this json file')
+    parser.add_argument('--save-baseline', action='store_true',
+        help='write the results to the --baseline file')
+    parser.add_argument('--threshold', type=float,
+        default=DEFAULT_REGRESSION_THRESHOLD,
+        help='fractional slow down that counts as a regression')
+    parser.add_argument('--filter',
+        help='only run benchmarks whose names match this regex')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--list', action='store_true',
+        help='list the benchmarks and exit')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    if args.list:
+        for name in BENCHMARKS: print name
+        return 0
+    results = run_benchmarks(args.filter, args.repeat, verbose=True)
+    if args.output is not None:
+        save_results(results, args.output)
+    if args.baseline is not None:
+        if args.save_baseline:
+            save_results(results, args.baseline)
+            return 0
+        regressions = find_regressions(
+            results, load_results(args.baseline), args.threshold)
+        for name, baseline_time, new_time in regressions:
+            print >> sys.stderr, \
+                "REGRESSION %s: %.6fs -> %.6fs (%+.1f%%)" % (
+                    name, baseline_time, new_time,
+                    100*(new_time/baseline_time - 1))
+        if len(regressions) > 0:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,19 +1,33 @@
 import math
+import hashlib
 
 from collections import OrderedDict
-from itertools import izip
 
 import numpy as np
-import yaml
 
-
-from scipy.optimize import brentq
+# yaml and scipy.optimize are slow to import and only needed to save/load
+# models and to estimate chemical potentials, so they're imported on first
+# use in the functions that need them
 
 from sequence import (
-    one_hot_encode_sequence, one_hot_encode_sequences, OneHotCodedDNASeq )
+    one_hot_encode_sequence, one_hot_encode_sequences, OneHotCodedDNASeq,
+    ONE_HOT_ENCODING_TABLE, dinucleotide_encode_sequence, 
+    dinucleotide_encode_sequences, DinucleotideCodedDNASeq,
+    DINUCLEOTIDE_RC_CHANNEL_ORDER )
+from shape import (
+    one_hot_plus_shape_encode_sequence, one_hot_plus_shape_encode_sequences,
+    OneHotPlusShapeCodedDNASeq, RC_SHAPE_FEATURE_ORDER )
 
 from misc import logistic, R, T, calc_occ
-from signal import multichannel_convolve, rfftn, irfftn, next_good_fshape
+import profiling
+from low_rank import LowRankFilterBasis, DEFAULT_MAX_ERROR
+from signal import (
+    multichannel_convolve, multichannel_batch_convolve, 
+    multichannel_overlap_save_max_convolve,
+    choose_convolve_strategy, ConvolveStrategy, ScoringWorkspace )
+
+# the largest temporary window array that the BLAS engine builds (bytes)
+DEFAULT_BLAS_MEMORY_BUDGET = 2**28
 
 class ScoreDirection():
     __slots__ = ['FWD', 'RC', 'MAX']
@@ -21,8 +35,69 @@ class ScoreDirection():
     RC = 'RC'
     MAX = 'MAX'
 
+class EncodingType():
+    __slots__ = ['ONE_HOT', 'ONE_HOT_PLUS_SHAPE', 'DINUCLEOTIDE']
+    ONE_HOT = 'ONE_HOT'
+    ONE_HOT_PLUS_SHAPE = 'ONE_HOT_PLUS_SHAPE'
+    DINUCLEOTIDE = 'DINUCLEOTIDE'
+
+def encode_sequence(seq, encoding_type):
+    """Encode a DNA sequence string with the encoding encoding_type.
+
+    """
+    assert encoding_type in EncodingType.__slots__
+    with profiling.stage('encode') as stage:
+        if encoding_type == EncodingType.ONE_HOT:
+            rv = one_hot_encode_sequence(seq)
+        elif encoding_type == EncodingType.ONE_HOT_PLUS_SHAPE:
+            rv = one_hot_plus_shape_encode_sequence(seq)
+        elif encoding_type == EncodingType.DINUCLEOTIDE:
+            rv = dinucleotide_encode_sequence(seq)
+        stage.add_array(rv)
+    return rv
+
+def reverse_complement_convolutional_filter(filt):
+    """Return the filter that scores the reverse complement strand.
+
+    Scoring a sequence with the returned filter is equivalent to scoring its
+    reverse complement with filt. The positions are reversed and the bases
+    are complemented. For one-hot-plus-shape filters the shape features stay
+    in place except for the base step features, whose left and right
+    channels are swapped. For dinucleotide filters the base pairs are 
+    reversed and complemented - the pair rows are reversed, and the last
+    (always zero) row stays last.
+    """
+    if filt.shape[1] == 4:
+        return filt[::-1,::-1]
+    elif filt.shape[1] == 10:
+        channel_order = [3, 2, 1, 0] + [4+x for x in RC_SHAPE_FEATURE_ORDER]
+        return filt[::-1,channel_order]
+    elif filt.shape[1] == 16:
+        rc_filt = np.zeros_like(filt)
+        rc_filt[:-1] = filt[-2::-1,DINUCLEOTIDE_RC_CHANNEL_ORDER]
+        return rc_filt
+    raise TypeError, "Unrecognized filter type - expecting one-hot (Nx4), one-hot-plus-shape (NX10) or dinucleotide (Nx16)"
+
+def build_dinucleotide_filter(filt):
+    """Return the dinucleotide filter that scores sequences the same as filt.
+
+    filt is a one-hot (Nx4) filter. Row p of the returned (Nx16) filter 
+    scores the base pair (p, p+1) with base p's score from filt - plus base 
+    p+1's score for the last pair - and the last row is zero. This is the
+    starting point for fitting dinucleotide models.
+    """
+    motif_len = filt.shape[0]
+    if filt.shape[1] != 4:
+        raise TypeError, "Expecting a one-hot (Nx4) filter"
+    if motif_len < 2:
+        raise ValueError, "Dinucleotide filters need at least two positions"
+    rv = np.zeros((motif_len, 4, 4), dtype=filt.dtype)
+    rv[:motif_len-1] += filt[:motif_len-1,:,None]
+    rv[motif_len-2] += filt[motif_len-1][None,:]
+    return rv.reshape(motif_len, 16)
+
 def score_coded_seq_with_convolutional_filter(
-        coded_seq, filt, direction):
+        coded_seq, filt, direction, rc_filt=None, out=None, workspace=None):
     """Score coded sequence using the convolutional filter filt. 
     
     input:
@@ -34,22 +109,87 @@ def score_coded_seq_with_convolutional_filter(
                 RC: score using the reverse complement of the filter
                MAX: score in both diretions, and then return the maximum score 
                     between the two directions
-    returns  : Nx(BS_len-seq_len+1) numpy array with binding sites scores
+    rc_filt  : the reverse complement of filt, if it has already been built
+    out      : optional (N-BS_len+1) array to write the scores to
+    workspace: optional ScoringWorkspace to take temporary arrays from
+    returns  : (N-BS_len+1) numpy array with binding sites scores, where
+               entry i is the score of the binding site starting at base i
+
+    The reverse complement strand is always scored with the reverse 
+    complement filter, so the sequence is never copied. Long sequences are
+    scored block by block, with both strands sharing each block's transform
+    and writing into a single output array.
     """
     assert direction in ScoreDirection.__slots__
+    if direction != ScoreDirection.FWD and rc_filt is None:
+        rc_filt = reverse_complement_convolutional_filter(filt)
+    # multichannel_convolve flips the filter along both axes, so we pass
+    # flipped filters to get the correlation with the sequence
+    if choose_convolve_strategy(
+            len(coded_seq), len(filt)) == ConvolveStrategy.OVERLAP_ADD:
+        filts = []
+        if direction in (ScoreDirection.FWD, ScoreDirection.MAX):
+            filts.append(filt[::-1,::-1])
+        if direction in (ScoreDirection.RC, ScoreDirection.MAX):
+            filts.append(rc_filt[::-1,::-1])
+        return multichannel_overlap_save_max_convolve(
+            coded_seq, filts, out, workspace)
     if direction == ScoreDirection.FWD: 
         return multichannel_convolve(
-            np.fliplr(np.flipud(coded_seq)), filt, mode='valid')
-    elif direction == ScoreDirection.RC: 
+            coded_seq, np.fliplr(np.flipud(filt)), 'valid', out, workspace)
+    if direction == ScoreDirection.RC: 
         return multichannel_convolve(
-            coded_seq, filt, mode='valid')
+            coded_seq, np.fliplr(np.flipud(rc_filt)), 'valid', out, workspace)
     elif direction == ScoreDirection.MAX:
         fwd_scores = multichannel_convolve(
-            np.fliplr(np.flipud(coded_seq)), filt, mode='valid')
+            coded_seq, np.fliplr(np.flipud(filt)), 'valid', out, workspace)
+        rc_out = None
+        if workspace is not None:
+            rc_out = workspace.buffer(
+                'scores', fwd_scores.shape, fwd_scores.dtype)
         rc_scores = multichannel_convolve(
-            coded_seq, filt, mode='valid')
+            coded_seq, np.fliplr(np.flipud(rc_filt)), 'valid', rc_out, 
+            workspace)
         # take the in-place maximum
-        return np.maximum(fwd_scores, rc_scores, fwd_scores) 
+        with profiling.stage('score.strand_max'):
+            return np.maximum(fwd_scores, rc_scores, fwd_scores) 
+    assert False, 'Should be unreachable'
+
+def score_coded_seqs_with_convolutional_filter(
+        coded_seqs, filt, direction, out=None, workspace=None):
+    """Score a batch of equal length coded sequences with filt.
+
+    This is the batched version of score_coded_seq_with_convolutional_filter. 
+
+    input:
+    coded_seqs: (num_seqs, seq_len, num_channels) encoded DNA sequences
+    out       : optional (num_seqs, seq_len-BS_len+1) array to write the 
+                scores to
+    workspace : optional ScoringWorkspace to take temporary arrays from
+    returns   : (num_seqs, seq_len-BS_len+1) numpy array with binding sites 
+                scores
+    """
+    assert direction in ScoreDirection.__slots__
+    if direction == ScoreDirection.FWD: 
+        return multichannel_batch_convolve(
+            coded_seqs, np.fliplr(np.flipud(filt)), 'valid', out, workspace)
+    rc_filt = reverse_complement_convolutional_filter(filt)
+    if direction == ScoreDirection.RC: 
+        return multichannel_batch_convolve(
+            coded_seqs, np.fliplr(np.flipud(rc_filt)), 'valid', out, 
+            workspace)
+    elif direction == ScoreDirection.MAX:
+        fwd_scores = multichannel_batch_convolve(
+            coded_seqs, np.fliplr(np.flipud(filt)), 'valid', out, workspace)
+        rc_out = None
+        if workspace is not None:
+            rc_out = workspace.buffer(
+                'scores', fwd_scores.shape, fwd_scores.dtype)
+        rc_scores = multichannel_batch_convolve(
+            coded_seqs, np.fliplr(np.flipud(rc_filt)), 'valid', rc_out, 
+            workspace)
+        with profiling.stage('score.strand_max'):
+            return np.maximum(fwd_scores, rc_scores, fwd_scores) 
     assert False, 'Should be unreachable'
 
 class DNASequence(object):
@@ -63,8 +203,36 @@ class DNASequence(object):
         self.seq = seq
 
         if one_hot_coded_seq is None:
-            one_hot_coded_seq = one_hot_encode_sequence(seq)
+            one_hot_coded_seq = encode_sequence(seq, EncodingType.ONE_HOT)
         self.one_hot_coded_seq = one_hot_coded_seq
+        self._one_hot_plus_shape_coded_seq = None
+        self._dinucleotide_coded_seq = None
+
+    @property
+    def one_hot_plus_shape_coded_seq(self):
+        profiling.record_cache_lookup(
+            'encode.shape', self._one_hot_plus_shape_coded_seq is not None)
+        if self._one_hot_plus_shape_coded_seq is None:
+            self._one_hot_plus_shape_coded_seq = encode_sequence(
+                self.seq, EncodingType.ONE_HOT_PLUS_SHAPE)
+        return self._one_hot_plus_shape_coded_seq
+
+    @property
+    def dinucleotide_coded_seq(self):
+        if self._dinucleotide_coded_seq is None:
+            self._dinucleotide_coded_seq = encode_sequence(
+                self.seq, EncodingType.DINUCLEOTIDE)
+        return self._dinucleotide_coded_seq
+
+    def get_coded_seq(self, encoding_type):
+        assert encoding_type in EncodingType.__slots__
+        if encoding_type == EncodingType.ONE_HOT:
+            return self.one_hot_coded_seq
+        elif encoding_type == EncodingType.ONE_HOT_PLUS_SHAPE:
+            return self.one_hot_plus_shape_coded_seq
+        elif encoding_type == EncodingType.DINUCLEOTIDE:
+            return self.dinucleotide_coded_seq
+        assert False, 'Should be unreachable'
 
     def __str__(self):
         return str(self.seq)
@@ -85,6 +253,10 @@ class DNASequences(object):
     def iter_one_hot_coded_seqs(self):
         for seq in self:
             yield seq.one_hot_coded_seq
+
+    def iter_coded_seqs(self, encoding_type):
+        for seq in self:
+            yield seq.get_coded_seq(encoding_type)
     
     def __len__(self):
         return len(self._seqs)
@@ -93,8 +265,8 @@ class DNASequences(object):
     def seq_lens(self):
         return self._seq_lens
 
-    def score_binding_sites(self, model, direction):
-        return model.score_seqs_binding_sites(self, direction)
+    def score_binding_sites(self, model, direction, out=None, workspace=None):
+        return model.score_seqs_binding_sites(self, direction, out, workspace)
     
     def __init__(self, seqs):
         self._seqs = []
@@ -103,10 +275,133 @@ class DNASequences(object):
             if isinstance(seq, str):
                 seq = DNASequence(seq)
             assert isinstance(seq, DNASequence)
-            self._seq_lens.append(len(seqs))
+            self._seq_lens.append(len(seq))
             self._seqs.append(seq)
         self._seq_lens = np.array(self._seq_lens, dtype=int)
 
+class DNASequenceView(object):
+    """Lightweight reference to a sequence stored in a sequence container.
+
+    The sequence string and its encodings are built from the container when
+    they are accessed, and are not cached.
+    """
+    __slots__ = ['_seqs', '_index']
+
+    def __len__(self):
+        return self._seqs.get_seq_len(self._index)
+
+    @property
+    def seq(self):
+        return self._seqs.get_seq(self._index)
+
+    @property
+    def one_hot_coded_seq(self):
+        return self._seqs.get_coded_seq(self._index, EncodingType.ONE_HOT)
+
+    @property
+    def one_hot_plus_shape_coded_seq(self):
+        return self._seqs.get_coded_seq(
+            self._index, EncodingType.ONE_HOT_PLUS_SHAPE)
+
+    @property
+    def dinucleotide_coded_seq(self):
+        return self._seqs.get_coded_seq(self._index, EncodingType.DINUCLEOTIDE)
+
+    def get_coded_seq(self, encoding_type):
+        return self._seqs.get_coded_seq(self._index, encoding_type)
+
+    def __str__(self):
+        return self.seq
+
+    def __repr__(self):
+        return repr(self.seq)
+
+    def __init__(self, seqs, index):
+        self._seqs = seqs
+        self._index = index
+
+class PackedDNASequences(DNASequences):
+    """Container that stores sequences in a single contiguous byte buffer.
+
+    Sequence i is stored in buffer[offsets[i]:offsets[i+1]], so the memory 
+    used per sequence is its length plus an 8 byte offset. Indexing and 
+    iteration return DNASequenceView objects, and sequences are only encoded 
+    when their encoding is requested.
+    """
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            assert step == 1, "Packed sequences can only be sliced with step 1"
+            stop = max(start, stop)
+            return PackedDNASequences._from_buffer(
+                self._buffer, self._offsets[start:stop+1])
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError, "sequence index out of range"
+        return DNASequenceView(self, index)
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield DNASequenceView(self, index)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    @property
+    def seq_lens(self):
+        return np.diff(self._offsets)
+
+    @property
+    def nbytes(self):
+        return self._buffer.nbytes + self._offsets.nbytes
+
+    def get_seq_len(self, index):
+        return int(self._offsets[index+1] - self._offsets[index])
+
+    def get_seq_bytes(self, index):
+        """Return a uint8 view of sequence index's characters.
+
+        """
+        return self._buffer[self._offsets[index]:self._offsets[index+1]]
+
+    def get_seq(self, index):
+        return self.get_seq_bytes(index).tostring()
+
+    def get_coded_seq(self, index, encoding_type):
+        assert encoding_type in EncodingType.__slots__
+        if encoding_type == EncodingType.ONE_HOT:
+            with profiling.stage('encode') as stage:
+                rv = ONE_HOT_ENCODING_TABLE.take(
+                    self.get_seq_bytes(index), axis=0).view(OneHotCodedDNASeq)
+                stage.add_array(rv)
+            return rv
+        elif encoding_type in (EncodingType.ONE_HOT_PLUS_SHAPE,
+                               EncodingType.DINUCLEOTIDE):
+            return encode_sequence(self.get_seq(index), encoding_type)
+        assert False, 'Should be unreachable'
+
+    def iter_one_hot_coded_seqs(self):
+        return self.iter_coded_seqs(EncodingType.ONE_HOT)
+
+    def iter_coded_seqs(self, encoding_type):
+        for index in xrange(len(self)):
+            yield self.get_coded_seq(index, encoding_type)
+
+    @classmethod
+    def _from_buffer(cls, buf, offsets):
+        rv = cls.__new__(cls)
+        rv._buffer = buf
+        rv._offsets = offsets
+        return rv
+
+    def __init__(self, seqs):
+        seqs = [str(seq) for seq in seqs]
+        self._offsets = np.zeros(len(seqs)+1, dtype=np.int64)
+        np.cumsum([len(seq) for seq in seqs], out=self._offsets[1:])
+        # np.frombuffer shares memory with the joined string
+        self._buffer = np.frombuffer("".join(seqs), dtype=np.uint8)
+
 class FixedLengthDNASequences(DNASequences):
     """Container for DNASequence objects of equal lengths.
 
@@ -114,90 +409,290 @@ class FixedLengthDNASequences(DNASequences):
     DNASequences class. 
     """
 
-    max_bs_len = 200
-    max_fft_seq_len = 500000
-    
     def __iter__(self):
-        for seq, coded_seq in izip(self._seqs, self.one_hot_coded_seqs):
-            yield DNASequence(seq, coded_seq.view(OneHotCodedDNASeq))
+        for index in xrange(len(self)):
+            yield DNASequenceView(self, index)
         return
 
+    def get_seq_len(self, index):
+        return self.seq_len
+
+    def get_seq(self, index):
+        return self._seqs[index]
+
+    def get_coded_seq(self, index, encoding_type):
+        assert encoding_type in EncodingType.__slots__
+        if encoding_type == EncodingType.ONE_HOT:
+            return self.one_hot_coded_seqs[index].view(OneHotCodedDNASeq)
+        elif encoding_type == EncodingType.ONE_HOT_PLUS_SHAPE:
+            return self.one_hot_plus_shape_coded_seqs[index].view(
+                OneHotPlusShapeCodedDNASeq)
+        elif encoding_type == EncodingType.DINUCLEOTIDE:
+            return self.dinucleotide_coded_seqs[index].view(
+                DinucleotideCodedDNASeq)
+        assert False, 'Should be unreachable'
+
     def iter_one_hot_coded_seqs(self):
         return (x.view(OneHotCodedDNASeq) for x in self.one_hot_coded_seqs)
 
-    def _naive_score_binding_sites(self, model, direction):
+    @property
+    def one_hot_plus_shape_coded_seqs(self):
+        """Encode all of the sequences with shape features in one batch.
+
+        The encoding is built on first use, and then cached.
+        """
+        profiling.record_cache_lookup(
+            'encode.shape', self._one_hot_plus_shape_coded_seqs is not None)
+        if self._one_hot_plus_shape_coded_seqs is None:
+            with profiling.stage('encode') as stage:
+                self._one_hot_plus_shape_coded_seqs = \
+                    one_hot_plus_shape_encode_sequences(self._seqs)
+                stage.add_array(self._one_hot_plus_shape_coded_seqs)
+        return self._one_hot_plus_shape_coded_seqs
+
+    @property
+    def dinucleotide_coded_seqs(self):
+        """Encode all of the sequences as dinucleotides in one batch.
+
+        The encoding is built on first use, and then cached.
+        """
+        if self._dinucleotide_coded_seqs is None:
+            with profiling.stage('encode') as stage:
+                self._dinucleotide_coded_seqs = \
+                    dinucleotide_encode_sequences(self._seqs)
+                stage.add_array(self._dinucleotide_coded_seqs)
+        return self._dinucleotide_coded_seqs
+
+    def get_coded_seqs(self, encoding_type):
+        """Return the (num_seqs, seq_len, num_channels) encoded sequences.
+
+        """
+        assert encoding_type in EncodingType.__slots__
+        if encoding_type == EncodingType.ONE_HOT:
+            return self.one_hot_coded_seqs
+        elif encoding_type == EncodingType.ONE_HOT_PLUS_SHAPE:
+            return self.one_hot_plus_shape_coded_seqs
+        elif encoding_type == EncodingType.DINUCLEOTIDE:
+            return self.dinucleotide_coded_seqs
+        assert False, 'Should be unreachable'
+
+    def iter_coded_seqs(self, encoding_type):
+        assert encoding_type in EncodingType.__slots__
+        if encoding_type == EncodingType.ONE_HOT:
+            return self.iter_one_hot_coded_seqs()
+        elif encoding_type == EncodingType.ONE_HOT_PLUS_SHAPE:
+            return (x.view(OneHotPlusShapeCodedDNASeq) 
+                    for x in self.one_hot_plus_shape_coded_seqs)
+        elif encoding_type == EncodingType.DINUCLEOTIDE:
+            return (x.view(DinucleotideCodedDNASeq) 
+                    for x in self.dinucleotide_coded_seqs)
+        assert False, 'Should be unreachable'
+
+    def _naive_score_binding_sites(
+            self, model, direction, out=None, workspace=None):
         """Score binding sites by looping over all sequences.
         
         """
-        return np.array(
-            DNASequences.score_binding_sites(self, model, direction))
+        if out is not None:
+            DNASequences.score_binding_sites(
+                self, model, direction, out, workspace)
+            return out
+        return np.array(DNASequences.score_binding_sites(
+            self, model, direction, workspace=workspace))
 
-    def _clever_score_binding_sites(self, model, reverse_comp):
-        """Score binding sites by a cached fft convolve.
+    def _batch_score_binding_sites(
+            self, model, direction, out=None, workspace=None):
+        """Score binding sites with a single fft over all of the sequences.
 
-        Only works when the sequence length is less than 10kb
-        and the binsing site length is less than 
-        self.max_bs_len (200 bp).
-        
-        This has been disabled because it doesn't appear to work
-        in a multi-threaded environment and the speedup is minimal
-        over the naive implmentation. 
         """
-        assert isinstance(model, ConvolutionalDNABindingModel)
-        n_channels = model.shape[1]
-        assert n_channels == self.one_hot_coded_seqs.shape[2]
-        assert model.binding_site_len < self.max_bs_len
-        convolutional_filter = model.convolutional_filter
-        if reverse_comp: 
-            convolutional_filter = np.flipud(np.fliplr(convolutional_filter))
-        h_freq = rfftn(
+        return score_coded_seqs_with_convolutional_filter(
+            self.get_coded_seqs(model.encoding_type), 
             model.convolutional_filter, 
-            (self.freq_one_hot_coded_seqs.shape[1], n_channels))
-        conv_freq = self.freq_one_hot_coded_seqs*h_freq[None,:,:]
-        return irfftn(conv_freq)[:len(self), :self.seq_len, n_channels-1]
+            direction, out, workspace)
 
-    def score_binding_sites(self, model, direction):
+    def score_binding_sites(self, model, direction, out=None, workspace=None):
         """Score binding sites using model for each sequence in self.
 
+        The sequences are either scored in one batch or one at a time, 
+        depending on which is faster (see signal.choose_convolve_strategy).
+
         Input:
         model: a ConvolutionalDNABindingModel
         direction: ScoreDirection.(FWD, REV, MAX)
+        out: optional (num_seqs, seq_len-bs_len+1) array to write the scores to
+        workspace: optional ScoringWorkspace to reuse temporary arrays from
 
-        returns: numpy array of binding site scores, shape (num_seqs, seq_len-bs_len)
+        returns: numpy array of binding site scores, shape (num_seqs, seq_len-bs_len+1)
         """
-        if (self.freq_one_hot_coded_seqs is None
-            or model.motif_len > self.max_bs_len 
-            or self.seq_len > self.max_fft_seq_len):
-            return self._naive_score_binding_sites(model, direction)
-        else:
-            if direction == ScoreDirection.FWD:
-                return self._clever_score_binding_sites(
-                    model, reverse_comp=True)
-            elif direction == ScoreDirection.RC:
-                return self._clever_score_binding_sites(
-                    model, reverse_comp=False)
-            elif direction == ScoreDirection.MAX:
-                fwd_scores = self._clever_score_binding_sites(
-                    model, reverse_comp=True)
-                rc_scores = self._clever_score_binding_sites(
-                    model, reverse_comp=False)
-                # take the in-place maximum
-                return np.maximum(fwd_scores, rc_scores, fwd_scores) 
+        with profiling.stage('score.fixed_length_seqs'):
+            strategy = choose_convolve_strategy(
+                self.seq_len, model.motif_len, len(self))
+            if strategy == ConvolveStrategy.BATCH:
+                return self._batch_score_binding_sites(
+                    model, direction, out, workspace)
+            return self._naive_score_binding_sites(
+                model, direction, out, workspace)
     
-    def _init_freq_one_hot_coded_seqs(self):
-        """Perform a fft on the array of coded sequences.
+    def _prepare_blas_scoring(self, models, direction):
+        """Stack the model filters, and pad the sequences for the BLAS engine.
 
-        Currently disabled because the optimization isnt being used. 
+        Returns the padded (num_seqs, padded_len, num_channels) sequences,
+        the (max_motif_len*num_channels, num_filters) filter matrix and the
+        motif lengths.
         """
-        return None
-        if self.seq_len > self.max_fft_seq_len:
-            return None
-        fshape = ( 
-            next_good_fshape(len(self)), 
-            next_good_fshape(self.seq_len+self.max_bs_len-1), 
-            self.one_hot_coded_seqs.shape[2] 
-        )
-        return rfftn(self.one_hot_coded_seqs, fshape)
+        encoding_types = set(mo.encoding_type for mo in models)
+        if len(encoding_types) != 1:
+            raise ValueError, "All of the models must have the same encoding type"
+        coded_seqs = self.get_coded_seqs(encoding_types.pop())
+        num_seqs, seq_len, num_channels = coded_seqs.shape
+        motif_lens = np.array([mo.motif_len for mo in models])
+        max_motif_len, min_motif_len = motif_lens.max(), motif_lens.min()
+        if max_motif_len > seq_len:
+            raise ValueError, "Models can't be longer than the sequences"
+
+        # stack the filters into a (max_motif_len*num_channels, num_models)
+        # matrix, zero padding the shorter filters on the right. For MAX, the
+        # reverse complement filters are stacked after the forward filters.
+        filters = []
+        if direction in (ScoreDirection.FWD, ScoreDirection.MAX):
+            filters.extend(mo.convolutional_filter for mo in models)
+        if direction in (ScoreDirection.RC, ScoreDirection.MAX):
+            filters.extend(
+                reverse_complement_convolutional_filter(mo.convolutional_filter)
+                for mo in models)
+        stacked_filters = np.zeros(
+            (len(filters), max_motif_len, num_channels), dtype='float32')
+        for i, filt in enumerate(filters):
+            stacked_filters[i,:len(filt)] = filt
+        stacked_filters = stacked_filters.reshape(len(filters), -1).T
+
+        # pad the sequences so that the binding sites of the shorter models
+        # near the end of the sequences have a full window
+        padded_seqs = coded_seqs
+        if max_motif_len > min_motif_len:
+            padded_seqs = np.zeros(
+                (num_seqs, seq_len + max_motif_len - min_motif_len,
+                 num_channels), dtype=coded_seqs.dtype)
+            padded_seqs[:,:seq_len] = coded_seqs
+        padded_seqs = np.ascontiguousarray(padded_seqs, dtype='float32')
+        return padded_seqs, stacked_filters, motif_lens
+
+    def _iter_blas_score_blocks(self, coded_seqs, filters, num_models,
+                                num_sites, direction, max_memory,
+                                whole_seqs=False):
+        """Score the padded sequences with the stacked filters in blocks.
+
+        Yields (seq_start, seq_stop, site_start, site_stop, scores) tuples,
+        where scores is a (num_models, num_block_seqs, num_block_sites)
+        array. Blocks contain every binding site of their sequences when
+        whole_seqs is True, even if that exceeds max_memory.
+        """
+        num_seqs, padded_len, num_channels = coded_seqs.shape
+        window_len = filters.shape[0]
+        # the bytes needed for the windows and scores of one binding site
+        site_bytes = 4*(window_len + 2*filters.shape[1])
+        block_size = max(1, max_memory//site_bytes)
+        # the binding site windows are a strided view of the sequences, so
+        # they're only copied (by reshape) one block at a time
+        windows = np.lib.stride_tricks.as_strided(
+            coded_seqs,
+            shape=(num_seqs, num_sites, window_len),
+            strides=(coded_seqs.strides[0], coded_seqs.strides[1],
+                     coded_seqs.strides[2]))
+        # block over whole sequences when they fit in the budget, and over
+        # the binding sites of one sequence otherwise
+        if num_sites <= block_size or whole_seqs:
+            seqs_per_block = max(1, block_size//num_sites)
+            block_size = num_sites
+        else:
+            seqs_per_block = 1
+        for seq_start in xrange(0, num_seqs, seqs_per_block):
+            seq_stop = min(num_seqs, seq_start+seqs_per_block)
+            for start in xrange(0, num_sites, block_size):
+                stop = min(num_sites, start+block_size)
+                block_windows = windows[seq_start:seq_stop,start:stop]
+                scores = np.dot(block_windows.reshape(-1, window_len), filters)
+                if direction == ScoreDirection.MAX:
+                    scores = np.maximum(
+                        scores[:,:num_models], scores[:,num_models:])
+                yield seq_start, seq_stop, start, stop, scores.T.reshape(
+                    num_models, seq_stop-seq_start, stop-start)
+        return
+
+    def score_models_binding_sites(
+            self, models, direction, max_memory=DEFAULT_BLAS_MEMORY_BUDGET):
+        """Score every sequence with every model with BLAS matrix multiplies.
+
+        The binding site windows of the sequences are a strided
+        (num_seqs, num_sites, max_motif_len*num_channels) view, so scoring
+        every model is a single matrix multiply against the stacked (zero
+        padded) model filters. The multiply is done in blocks so that the
+        copied windows and the scores use at most about max_memory bytes.
+        This is much faster than convolving each model separately when there
+        are many short models.
+
+        Input:
+        models: an iterable of ConvolutionalDNABindingModels that share an
+                encoding type
+        direction: ScoreDirection.(FWD, REV, MAX)
+
+        returns: list of (num_seqs, seq_len-bs_len+1) binding site score
+                 arrays, one for each model
+        """
+        assert direction in ScoreDirection.__slots__
+        models = list(models)
+        if len(models) == 0:
+            return []
+        with profiling.stage('score.blas') as stage:
+            padded_seqs, filters, motif_lens = self._prepare_blas_scoring(
+                models, direction)
+            num_sites = self.seq_len - motif_lens.min() + 1
+            out = np.empty((len(models), len(self), num_sites), dtype='float32')
+            stage.add_array(out)
+            for seq_start, seq_stop, start, stop, scores in \
+                    self._iter_blas_score_blocks(
+                        padded_seqs, filters, len(models), num_sites,
+                        direction, max_memory):
+                out[:,seq_start:seq_stop,start:stop] = scores
+        return [ out[i,:,:self.seq_len-motif_len+1]
+                 for i, motif_len in enumerate(motif_lens) ]
+
+    def aggregate_models_binding_sites(
+            self, models, aggregator, direction=ScoreDirection.MAX,
+            max_memory=DEFAULT_BLAS_MEMORY_BUDGET):
+        """Score every sequence with every model, and aggregate the scores.
+
+        This fuses aggregation into score_models_binding_sites - each block
+        of scores is aggregated as soon as it's computed, so the full score
+        arrays are never stored.
+
+        Input:
+        aggregator: an aggregation.RegionScoreAggregator
+
+        returns: (num_models, num_seqs, aggregator.num_stats) array
+        """
+        assert direction in ScoreDirection.__slots__
+        models = list(models)
+        if len(models) == 0:
+            return np.empty((0, len(self), aggregator.num_stats), dtype='float32')
+        with profiling.stage('score.blas_aggregate'):
+            padded_seqs, filters, motif_lens = self._prepare_blas_scoring(
+                models, direction)
+            num_sites = self.seq_len - motif_lens.min() + 1
+            out = np.empty(
+                (len(models), len(self), aggregator.num_stats), dtype='float32')
+            model_groups = [ (np.nonzero(motif_lens == motif_len)[0],
+                              self.seq_len - motif_len + 1)
+                             for motif_len in np.unique(motif_lens) ]
+            for seq_start, seq_stop, start, stop, scores in \
+                    self._iter_blas_score_blocks(
+                        padded_seqs, filters, len(models), num_sites,
+                        direction, max_memory, whole_seqs=True):
+                # only aggregate each model's valid binding sites
+                for model_indices, model_num_sites in model_groups:
+                    out[model_indices,seq_start:seq_stop] = aggregator.aggregate(
+                        scores[model_indices,:,:model_num_sites])
+        return out
 
     def __init__(self, seqs):
         self._seqs = list(seqs)
@@ -206,13 +701,111 @@ class FixedLengthDNASequences(DNASequences):
         assert self._seq_lens.max() == self._seq_lens.min()
         self.seq_len = self._seq_lens[0]
 
-        self.one_hot_coded_seqs = one_hot_encode_sequences(self._seqs)
-        self.freq_one_hot_coded_seqs = self._init_freq_one_hot_coded_seqs()
+        with profiling.stage('encode') as stage:
+            self.one_hot_coded_seqs = one_hot_encode_sequences(self._seqs)
+            stage.add_array(self.one_hot_coded_seqs)
+        self._one_hot_plus_shape_coded_seqs = None
+        self._dinucleotide_coded_seqs = None
+
+def _dinucleotide_suffix_scores(filt, best, arg_best):
+    """Find the best (e.g. best=np.max) binding site of a dinucleotide filter.
+
+    Returns the best suffix scores (see ModelSummary) and the best sequence.
+    """
+    motif_len = filt.shape[0]
+    pair_scores = np.asarray(filt, dtype='float32').reshape(motif_len, 4, 4)
+    # scores[p,a] is the best score of positions p and above when base p is a
+    scores = np.zeros((motif_len+1, 4), dtype='float32')
+    for p in xrange(motif_len-1, -1, -1):
+        scores[p] = best(pair_scores[p] + scores[p+1][None,:], axis=1)
+    bases = [arg_best(scores[0]),]
+    for p in xrange(motif_len-1):
+        bases.append(arg_best(pair_scores[p,bases[-1]] + scores[p+1]))
+    return best(scores, axis=1), "".join('ACGT'[x] for x in bases)
+
+class ModelSummary(object):
+    """Summary statistics of a convolutional filter.
+
+    Only the base channels are used, so for one-hot-plus-shape filters the
+    scores ignore the shape features. For dinucleotide filters the best and
+    worst binding sites are found by dynamic programming over the base pairs.
+
+    min_score, max_score, mean_score: the min, max and mean binding site score
+    consensus_seq    : the sequence of the highest scoring binding site
+    rc_filter        : the reverse complement filter
+    suffix_max_scores: (motif_len+1,) array - entry i is the max score of
+                       positions i and above (for pruning partial sites)
+    suffix_min_scores: same as suffix_max_scores for the min score
+    filter_hash      : the sha1 hex digest of the float32 filter
+    """
+    __slots__ = ['min_score', 'max_score', 'mean_score', 'consensus_seq',
+                 'rc_filter', 'suffix_max_scores', 'suffix_min_scores',
+                 'filter_hash']
+
+    def __init__(self, filt):
+        if filt.shape[1] == 16:
+            self.suffix_max_scores, self.consensus_seq = \
+                _dinucleotide_suffix_scores(filt, np.max, np.argmax)
+            self.suffix_min_scores = _dinucleotide_suffix_scores(
+                filt, np.min, np.argmin)[0]
+            # every base pair is equally likely in a random sequence
+            self.mean_score = float(np.asarray(filt).mean(1).sum())
+        else:
+            base_filt = np.asarray(filt[:,:4], dtype='float32')
+            position_max = base_filt.max(1)
+            position_min = base_filt.min(1)
+            self.suffix_max_scores = np.concatenate(
+                (np.cumsum(position_max[::-1])[::-1], [0])).astype('float32')
+            self.suffix_min_scores = np.concatenate(
+                (np.cumsum(position_min[::-1])[::-1], [0])).astype('float32')
+            self.mean_score = float(base_filt.mean(1).sum())
+            self.consensus_seq = "".join(
+                'ACGT'[x] for x in np.argmax(base_filt, axis=1))
+        self.max_score = float(self.suffix_max_scores[0])
+        self.min_score = float(self.suffix_min_scores[0])
+        self.rc_filter = reverse_complement_convolutional_filter(filt)
+        self.filter_hash = hashlib.sha1(
+            np.ascontiguousarray(filt, dtype='float32').tostring()
+            + str(filt.shape)).hexdigest()
+
+class ModelSummaries(object):
+    """The ModelSummary fields of a set of models, stacked into arrays.
+
+    The suffix score arrays are zero padded to the longest motif.
+    """
+    def __init__(self, models):
+        summaries = [mo.summary for mo in models]
+        self._summaries = summaries
+        self.motif_lens = np.array([mo.motif_len for mo in models])
+        for key in ('min_score', 'max_score', 'mean_score'):
+            setattr(self, key + 's', np.array(
+                [getattr(x, key) for x in summaries], dtype='float32'))
+        self.consensus_seqs = [x.consensus_seq for x in summaries]
+        self.filter_hashes = np.array([x.filter_hash for x in summaries])
+        max_motif_len = self.motif_lens.max() if len(models) > 0 else 0
+        for key in ('suffix_max_scores', 'suffix_min_scores'):
+            values = np.zeros((len(models), max_motif_len+1), dtype='float32')
+            for i, summary in enumerate(summaries):
+                suffix_scores = getattr(summary, key)
+                values[i,:len(suffix_scores)] = suffix_scores
+            setattr(self, key, values)
 
 class DNABindingModels(object):
     """Container for DNABindingModel objects
 
     """
+    @property
+    def summaries(self):
+        """The stacked summaries of every model (see ModelSummaries).
+
+        The arrays are rebuilt when any of the models changes.
+        """
+        if ( self._summaries is None
+             or any(x is not mo.summary for x, mo in zip(
+                 self._summaries._summaries, self._models)) ):
+            self._summaries = ModelSummaries(self._models)
+        return self._summaries
+
     def __getitem__(self, index):
         return self._models[index]
     
@@ -222,12 +815,96 @@ class DNABindingModels(object):
     def __iter__(self):
         return iter(self._models)
     
+    def build_low_rank_approximation(
+            self, max_error=DEFAULT_MAX_ERROR, rank=None):
+        """Factorize the model filters into a shared low rank basis.
+
+        The basis is used by score_binding_sites(..., approximate=True). The
+        bound on each model's absolute score error is stored in
+        approximation_errors.
+        """
+        self._low_rank_basis = LowRankFilterBasis(
+            [mo.convolutional_filter for mo in self], max_error, rank)
+        return self._low_rank_basis
+
+    @property
+    def approximation_errors(self):
+        if self._low_rank_basis is None:
+            return None
+        return self._low_rank_basis.errors
+
+    def build_energetic_models(self, include_shape=False):
+        """Convert every PWMBindingModel to an EnergeticDNABindingModel.
+
+        """
+        if not all(isinstance(mo, PWMBindingModel) for mo in self):
+            raise TypeError, "build_energetic_models requires PWMBindingModels"
+        rv = [None]*len(self)
+        for indices, models in _iter_motif_len_groups(self._models):
+            ref_energies, ddg_arrays = build_energies_from_pwms(
+                np.array([mo.pwm for mo in models]), include_shape)
+            for i, mo, ref_energy, ddg_array in zip(
+                    indices, models, ref_energies, ddg_arrays):
+                rv[i] = EnergeticDNABindingModel(
+                    ref_energy, ddg_array, **mo.meta_data)
+        return DNABindingModels(rv)
+
+    def build_pwm_models(self, chem_pots):
+        """Convert every EnergeticDNABindingModel to a PWMBindingModel.
+
+        chem_pots is a scalar, or a sequence with one value per model.
+        """
+        if not all(isinstance(mo, EnergeticDNABindingModel) for mo in self):
+            raise TypeError, "build_pwm_models requires EnergeticDNABindingModels"
+        for mo in self:
+            _check_one_base_per_row(mo.ddg_array.shape[1], 'build_pwm_models')
+        chem_pots = np.broadcast_to(
+            np.asarray(chem_pots, dtype=float), (len(self),))
+        rv = [None]*len(self)
+        for indices, models in _iter_motif_len_groups(self._models):
+            pwms = build_pwms_from_energies(
+                np.array([mo.ref_energy for mo in models]),
+                np.array([mo.ddg_array[:,:4] for mo in models]),
+                chem_pots[indices])
+            for i, mo, pwm in zip(indices, models, pwms):
+                rv[i] = PWMBindingModel(pwm, **mo.meta_data)
+        return DNABindingModels(rv)
+
+    def score_binding_sites(self, seq, direction, approximate=False,
+                            workspace=None):
+        """Score all binding sites in seq with every model.
+
+        When approximate is True the scores are reconstructed from the low
+        rank basis (see build_low_rank_approximation), which is much faster
+        for large model libraries. The exact scoring reuses the temporary
+        arrays of workspace (a ScoringWorkspace) if it's provided.
+
+        returns: a list of binding site score arrays, one for each model
+        """
+        assert direction in ScoreDirection.__slots__
+        if not approximate or len(self) == 0:
+            return [mo.score_binding_sites(seq, direction, workspace=workspace)
+                    for mo in self]
+        if self._low_rank_basis is None:
+            self.build_low_rank_approximation()
+        if isinstance(seq, str):
+            coded_seq = encode_sequence(seq, EncodingType.ONE_HOT)
+        elif isinstance(seq, (DNASequence, DNASequenceView)):
+            coded_seq = seq.get_coded_seq(EncodingType.ONE_HOT)
+        else:
+            coded_seq = seq
+        with profiling.stage('score.low_rank'):
+            return self._low_rank_basis.score_coded_seq(coded_seq, direction)
+
     def __init__(self, models):
         self._models = list(models)
         assert all(isinstance(mo, DNABindingModel) for mo in models)
+        self._low_rank_basis = None
+        self._summaries = None
 
     @property
     def yaml_str(self):
+        import yaml
         return yaml.dump( [dict(mo._build_repr_dict()) for mo in self] )
 
     def save(self, ofstream):
@@ -274,13 +951,52 @@ class ConvolutionalDNABindingModel(DNABindingModel):
     """
     model_type = 'ConvolutionalDNABindingModel'
     
+    @property
+    def convolutional_filter(self):
+        return self._convolutional_filter
+
+    @convolutional_filter.setter
+    def convolutional_filter(self, convolutional_filter):
+        """Set the filter, and invalidate the cached summary.
+
+        The stored filter is read-only - to change a model, assign a new
+        filter.
+        """
+        assert len(convolutional_filter.shape) == 2
+        if convolutional_filter.shape[1] == 4:
+            self.encoding_type = EncodingType.ONE_HOT
+        elif convolutional_filter.shape[1] == 10:
+            self.encoding_type = EncodingType.ONE_HOT_PLUS_SHAPE
+        elif convolutional_filter.shape[1] == 16:
+            # row p scores the base pair (p, p+1), so the last row would
+            # score the base after the binding site
+            if (convolutional_filter[-1] != 0).any():
+                raise ValueError, "The last row of a dinucleotide filter must be zero"
+            self.encoding_type = EncodingType.DINUCLEOTIDE
+        else:
+            raise TypeError, "Unrecognized ddg_array type - expecting one-hot (Nx4), one-hot-plus-shape (NX10) or dinucleotide (Nx16)"
+        convolutional_filter = convolutional_filter.view()
+        convolutional_filter.flags.writeable = False
+        self._convolutional_filter = convolutional_filter
+        self.binding_site_len = convolutional_filter.shape[0]
+        self.shape = convolutional_filter.shape
+        self._summary = None
+
+    @property
+    def summary(self):
+        """The ModelSummary of the filter, computed on first use.
+
+        """
+        if self._summary is None:
+            self._summary = ModelSummary(self.convolutional_filter)
+        return self._summary
+
     @property
     def consensus_seq(self):
         """Return the sequence of the highest scoring binding site.
 
         """
-        return "".join( 'ACGT'[x] for x in np.argmax(
-            self.convolutional_filter, axis=1) )
+        return self.summary.consensus_seq
 
     @property
     def motif_len(self):
@@ -292,69 +1008,157 @@ class ConvolutionalDNABindingModel(DNABindingModel):
         Additional meta data can be passed as keyward arguments.
         """
         DNABindingModel._init_meta_data(self, kwargs)
-
-        assert len(convolutional_filter.shape) == 2
-
-        if convolutional_filter.shape[1] == 4:
-            self.encoding_type = 'ONE_HOT'
-        elif convolutional_filter.shape[1] == 10:
-            self.encoding_type = 'ONE_HOT_PLUS_SHAPE'
-        else:
-            raise TypeError, "Unrecognized ddg_array type - expecting one-hot (Nx4) or one-hot-plus-shape (NX10)"
-
-        self.binding_site_len = convolutional_filter.shape[0]
         self.convolutional_filter = convolutional_filter
-        self.shape = self.convolutional_filter.shape
 
-    def score_binding_sites(self, seq, direction):
+    def score_binding_sites(self, seq, direction, out=None, workspace=None):
         """Score all binding sites in seq.
         
+        The scores are written to out if it's provided, and temporary arrays
+        are taken from workspace (a ScoringWorkspace) if it's provided.
         """
         assert direction in ScoreDirection.__slots__
+        with profiling.stage('score'):
+            return self._score_binding_sites(seq, direction, out, workspace)
+
+    def _score_binding_sites(self, seq, direction, out=None, workspace=None):
         if isinstance(seq, str):
-            coded_seq = one_hot_encode_sequence(seq)
-        elif isinstance(seq, DNASequence):
-            coded_seq = seq.one_hot_coded_seq
-        elif isinstance(seq, OneHotCodedDNASeq):
+            coded_seq = encode_sequence(seq, self.encoding_type)
+        elif isinstance(seq, (DNASequence, DNASequenceView)):
+            coded_seq = seq.get_coded_seq(self.encoding_type)
+        elif isinstance(seq, (OneHotCodedDNASeq, OneHotPlusShapeCodedDNASeq,
+                              DinucleotideCodedDNASeq)):
             coded_seq = seq
         else:
             assert False, "Unrecognized sequence type '%s'" % str(type(seq))
+        if coded_seq.shape[1] != self.shape[1]:
+            raise TypeError, \
+                "Sequence has %i encoding channels but the model expects %i" % (
+                    coded_seq.shape[1], self.shape[1])
         return score_coded_seq_with_convolutional_filter(
-            coded_seq, self.convolutional_filter, direction=direction)
+            coded_seq, self.convolutional_filter, direction=direction,
+            rc_filt=self.summary.rc_filter, out=out, workspace=workspace)
+
+    def _build_repr_dict(self):
+        rv = OrderedDict()
+        rv['model_type'] = self.model_type
+        for key, value in self.iter_meta_data():
+            rv[key] = value
+        rv['encoding_type'] = self.encoding_type
+        rv['convolutional_filter'] = self.convolutional_filter.tolist()
+        return rv
 
-    def score_seqs_binding_sites(self, seqs, direction):
+    def score_seqs_binding_sites(self, seqs, direction, out=None, 
+                                 workspace=None):
         """Score all binding sites in all sequences.
 
+        out is an optional sequence of per sequence score arrays (e.g. the
+        list returned by a previous call, or the rows of a 2D array) to 
+        write the scores to.
         """
         rv = []
-        for one_hot_coded_seq in seqs.iter_one_hot_coded_seqs():
-            rv.append(self.score_binding_sites(one_hot_coded_seq, direction))
+        for i, coded_seq in enumerate(seqs.iter_coded_seqs(self.encoding_type)):
+            rv.append(self.score_binding_sites(
+                coded_seq, direction, None if out is None else out[i], 
+                workspace))
         return rv
 
+    def build_binding_site_scores(self, seqs, workspace=None):
+        """Score both strands of seqs, and keep the best score and strand.
+
+        seqs is a sequence string, a list of them, or a DNASequences 
+        container. The forward scores are written straight into the result
+        buffer, and the reverse complement scores into a temporary array 
+        (taken from workspace if it's provided).
+
+        returns: a BindingSiteScores
+        """
+        from binding_site_scores import BindingSiteScores
+        if isinstance(seqs, str):
+            seqs = [seqs,]
+        if not isinstance(seqs, DNASequences):
+            seqs = DNASequences(seqs)
+        num_sites = np.maximum(
+            np.asarray(seqs.seq_lens) - self.motif_len + 1, 0)
+        offsets = np.zeros(len(num_sites)+1, dtype='int64')
+        np.cumsum(num_sites, out=offsets[1:])
+        scores = np.empty(offsets[-1], dtype='float32')
+        is_rc = np.empty(offsets[-1], dtype=bool)
+        if isinstance(seqs, FixedLengthDNASequences):
+            blocks = [(seqs, scores.reshape(len(seqs), -1), 
+                       is_rc.reshape(len(seqs), -1)),]
+        else:
+            blocks = [(seq, scores[start:stop], is_rc[start:stop])
+                      for seq, start, stop in zip(
+                          seqs, offsets[:-1], offsets[1:])
+                      if stop > start]
+        with profiling.stage('score.strands'):
+            for block_seqs, fwd_scores, block_is_rc in blocks:
+                if fwd_scores.size == 0: continue
+                rc_scores = None
+                if workspace is not None:
+                    rc_scores = workspace.buffer(
+                        'rc_scores', fwd_scores.shape, fwd_scores.dtype)
+                if isinstance(block_seqs, FixedLengthDNASequences):
+                    block_seqs.score_binding_sites(
+                        self, ScoreDirection.FWD, fwd_scores, workspace)
+                    rc_scores = block_seqs.score_binding_sites(
+                        self, ScoreDirection.RC, rc_scores, workspace)
+                else:
+                    self.score_binding_sites(
+                        block_seqs, ScoreDirection.FWD, fwd_scores, workspace)
+                    rc_scores = self.score_binding_sites(
+                        block_seqs, ScoreDirection.RC, rc_scores, workspace)
+                # ties go to the forward strand
+                np.greater(rc_scores, fwd_scores, block_is_rc)
+                np.maximum(fwd_scores, rc_scores, fwd_scores)
+        return BindingSiteScores(scores, offsets, is_rc, self.motif_len)
+
+    def build_kmer_score_table(self, k=None, direction=ScoreDirection.MAX):
+        """Return the max binding site score of every k-mer.
+
+        See kmer.build_kmer_score_table.
+        """
+        import kmer
+        return kmer.build_kmer_score_table(self, k, direction)
+
 class PWMBindingModel(ConvolutionalDNABindingModel):
     model_type = 'PWMbindingModel'
     
-    def __init__(self, pwm, *args, **kwargs):
-        self.pwm = np.array(pwm, dtype='float32')
-        if not (self.pwm.sum(1).round(6) == 1.0).all():
+    @property
+    def pwm(self):
+        return self._pwm
+
+    @pwm.setter
+    def pwm(self, pwm):
+        pwm = np.array(pwm, dtype='float32')
+        if not (pwm.sum(1).round(6) == 1.0).all():
             raise TypeError, "PWM rows must sum to one."
-        if self.pwm.shape[1] != 4:
+        if pwm.shape[1] != 4:
             raise TypeError, "PWMs must have dimension NX4."
-        convolutional_filter = -np.log2(
-            np.clip(1 - np.array(pwm), 1e-6, 1-1e-6))
-        ConvolutionalDNABindingModel.__init__(
-            self, convolutional_filter, *args, **kwargs)
+        pwm.flags.writeable = False
+        self._pwm = pwm
+        self.convolutional_filter = -np.log2(np.clip(1 - pwm, 1e-6, 1-1e-6))
+
+    def __init__(self, pwm, *args, **kwargs):
+        DNABindingModel._init_meta_data(self, kwargs)
+        self.pwm = pwm
         return 
 
+    def _build_repr_dict(self):
+        rv = OrderedDict()
+        rv['model_type'] = self.model_type
+        for key, value in self.iter_meta_data():
+            rv[key] = value
+        rv['encoding_type'] = self.encoding_type
+        # the rows need to sum to one, so we can't round the pwm entries
+        rv['pwm'] = self.pwm.tolist()
+        return rv
+
     def build_energetic_model(self, include_shape=False):
-        ref_energy = 0.0
-        energies = np.zeros(
-            (self.motif_len, 4 + (6 if include_shape else 0)),
-            dtype='float32')
-        for i, base_energies in enumerate(-self.convolutional_filter):
-            for j, base_energy in enumerate(base_energies):
-                energies[i, j] = base_energy
-        return EnergeticDNABindingModel(ref_energy, energies, **self.meta_data)
+        ref_energies, ddg_arrays = build_energies_from_pwms(
+            self.pwm[None,:,:], include_shape)
+        return EnergeticDNABindingModel(
+            ref_energies[0], ddg_arrays[0], **self.meta_data)
 
 class EnergeticDNABindingModel(ConvolutionalDNABindingModel):
     """A convolutional binding model where the binding site scores are the physical binding affinity.
@@ -363,25 +1167,55 @@ class EnergeticDNABindingModel(ConvolutionalDNABindingModel):
     model_type = 'EnergeticDNABindingModel'
 
     @property
-    def min_energy(self, ref_energy):
-        return self.ref_energy + self.ddg_array.min(1).sum()
+    def ref_energy(self):
+        return self._ref_energy
+
+    @ref_energy.setter
+    def ref_energy(self, ref_energy):
+        self._ref_energy = ref_energy
+        self._update_convolutional_filter()
 
     @property
-    def max_energy(self, ref_energy):
-        return self.ref_energy + self.ddg_array.max(1).sum()
+    def ddg_array(self):
+        return self._ddg_array
+
+    @ddg_array.setter
+    def ddg_array(self, ddg_array):
+        ddg_array = np.array(ddg_array, dtype='float32').view(DeltaDeltaGArray)
+        ddg_array.flags.writeable = False
+        self._ddg_array = ddg_array
+        self._update_convolutional_filter()
+
+    def _update_convolutional_filter(self):
+        # add the reference energy to every entry of the convolutional 
+        # filter, and then multiply by negative 1 (so that higher scores 
+        # correspond to higher binding affinity )
+        convolutional_filter = np.array(self._ddg_array)
+        convolutional_filter[0,:] += self._ref_energy
+        convolutional_filter *= -1
+        self.convolutional_filter = convolutional_filter
+
+    # the scores are negative energies, so the energy summaries are the
+    # negative of the score summaries
+    @property
+    def min_energy(self):
+        return -self.summary.max_score
+
+    @property
+    def max_energy(self):
+        return -self.summary.min_score
 
     @property
     def mean_energy(self):
-        return self.ref_energy + self.ddg_array.sum()/4
+        return -self.summary.mean_score
 
     def build_pwm(self, chem_pot):
-        pwm = np.zeros((4, self.motif_len), dtype=float)
-        mean_energy = ref_energy + chem_pot + self.mean_energy
-        for i, base_energies in enumerate(self.ddg_array):
-            base_mut_energies = mean_energy + base_energies.mean() - base_energies 
-            occs = logistic(base_mut_energies)
-            pwm[:,i] = occs/occs.sum()
-        return pwm
+        """Return the (4, motif_len) PWM of the bound sequences at chem_pot.
+
+        """
+        return build_pwms_from_energies(
+            np.array([self.ref_energy,]), self.ddg_array[None,:,:], chem_pot
+        )[0].T
 
     def _build_repr_dict(self):
         # first write the meta data
@@ -398,22 +1232,13 @@ class EnergeticDNABindingModel(ConvolutionalDNABindingModel):
         return rv
     
     def build_all_As_affinity_and_ddg_array(self):        
-        all_As_affinity, ddg_array = self.ref_energy, self.ddg_array
-        energies = np.zeros(
-            (self.motif_len, self.convolutional_filter.shape[1]-1),
-            dtype='float32')
-        for i, base_energies in enumerate(ddg_array):
-            # when needed, deal with the non-one-hot-coded features
-            if len(base_energies) > 4:
-                energies[i,3:] = base_energies[4:]
-            for j, base_energy in enumerate(base_energies[1:4]):
-                energies[i, j] = base_energy - base_energies[0]
-            all_As_affinity += base_energies[0]
-        return np.array([all_As_affinity,], dtype='float32')[0], \
-            energies.T.astype('float32').view(ReducedDeltaDeltaGArray)
+        all_As_affinities, ddg_arrays = build_all_As_affinities_and_ddg_arrays(
+            np.array([self.ref_energy,]), self.ddg_array[None,:,:])
+        return all_As_affinities[0], ddg_arrays[0]
     
     @property
     def yaml_str(self):
+        import yaml
         return yaml.dump(dict(self._build_repr_dict()))
 
     def save(self, ofstream):
@@ -423,26 +1248,124 @@ class EnergeticDNABindingModel(ConvolutionalDNABindingModel):
                  ref_energy,
                  ddg_array,
                  **kwargs):
-        # store the model params
-        self.ref_energy = ref_energy
-        self.ddg_array = np.array(ddg_array, dtype='float32').view(
-            DeltaDeltaGArray)
-        
-        # add the reference energy to every entry of the convolutional 
-        # filter, and then multiply by negative 1 (so that higher scores 
-        # correspond to higher binding affinity )
-        convolutional_filter = self.ddg_array.copy()
-        convolutional_filter[0,:] += ref_energy
-        convolutional_filter *= -1
-        ConvolutionalDNABindingModel.__init__(
-            self, convolutional_filter, **kwargs)
+        DNABindingModel._init_meta_data(self, kwargs)
+        # store the model params - setting ddg_array builds the filter
+        self._ref_energy = ref_energy
+        self.ddg_array = ddg_array
+
+################################################################################
+# Batch model conversion
+#
+# These operate on stacked (num_models, motif_len, num_channels) arrays of
+# models with the same motif length - the per model methods call them with a
+# stack of one model.
+
+def _check_one_base_per_row(num_channels, name):
+    # the PWM and energy helpers read the first 4 channels as the A, C, G and 
+    # T energies, which isn't true of the dinucleotide encoding
+    if num_channels == 16:
+        raise TypeError, "%s doesn't support dinucleotide models" % name
+
+def build_energies_from_pwms(pwms, include_shape=False):
+    """Return the reference energies and ddg arrays of stacked PWMs.
+
+    The energies are the negative of the PWM model convolutional filters,
+    with zero shape energies added when include_shape is True.
+    """
+    pwms = np.asarray(pwms, dtype='float32')
+    num_models, motif_len, num_bases = pwms.shape
+    ddg_arrays = np.zeros(
+        (num_models, motif_len, num_bases + (6 if include_shape else 0)),
+        dtype='float32')
+    ddg_arrays[:,:,:num_bases] = np.log2(np.clip(1 - pwms, 1e-6, 1-1e-6))
+    return np.zeros(num_models, dtype='float32'), ddg_arrays
+
+def build_pwms_from_energies(ref_energies, ddg_arrays, chem_pots):
+    """Return the (num_models, motif_len, 4) PWMs of stacked energy models.
+
+    At each position the base frequencies are proportional to the occupancy
+    of the consensus-shifted site with that base.
+
+    Input:
+    ref_energies: (num_models,) reference energies
+    ddg_arrays  : (num_models, motif_len, num_channels) ddg arrays - only the
+                  base channels are used
+    chem_pots   : the chemical potential - a scalar or (num_models,) array
+    """
+    ddg_arrays = np.asarray(ddg_arrays, dtype=float)
+    _check_one_base_per_row(ddg_arrays.shape[2], 'build_pwms_from_energies')
+    ddg_arrays = ddg_arrays[:,:,:4]
+    ref_energies = np.asarray(ref_energies, dtype=float)
+    mean_energies = ref_energies + ddg_arrays.sum((1,2))/4
+    offsets = np.asarray(chem_pots, dtype=float) + mean_energies
+    base_mut_energies = ( offsets[:,None,None]
+                          + ddg_arrays.mean(2)[:,:,None]
+                          - ddg_arrays )
+    occs = 1/(1 + np.exp(-base_mut_energies))
+    return occs/occs.sum(2)[:,:,None]
+
+def build_all_As_affinities_and_ddg_arrays(ref_energies, ddg_arrays):
+    """Re-parameterize stacked energy models relative to the all A sequence.
+
+    Returns the (num_models,) affinities of the all A sequences, and the
+    (num_models, num_channels-1, motif_len) ReducedDeltaDeltaGArrays of the
+    C, G and T energies relative to A followed by the shape energies.
+    """
+    ddg_arrays = np.asarray(ddg_arrays, dtype='float32')
+    _check_one_base_per_row(
+        ddg_arrays.shape[2], 'build_all_As_affinities_and_ddg_arrays')
+    all_As_affinities = (
+        np.asarray(ref_energies, dtype='float32') + ddg_arrays[:,:,0].sum(1))
+    num_models, motif_len, num_channels = ddg_arrays.shape
+    energies = np.empty(
+        (num_models, motif_len, num_channels-1), dtype='float32')
+    energies[:,:,:3] = ddg_arrays[:,:,1:4] - ddg_arrays[:,:,:1]
+    # the non-one-hot-coded features are kept as is
+    energies[:,:,3:] = ddg_arrays[:,:,4:]
+    return ( all_As_affinities.astype('float32'),
+             energies.transpose(0, 2, 1).view(ReducedDeltaDeltaGArray) )
+
+def _iter_motif_len_groups(models):
+    """Yield (model indices, models) for each group of equal length models.
+
+    """
+    indices = OrderedDict()
+    for i, model in enumerate(models):
+        indices.setdefault(model.motif_len, []).append(i)
+    for group_indices in indices.itervalues():
+        yield group_indices, [models[i] for i in group_indices]
+    return
+
+MODEL_TYPES = dict(
+    (model_class.model_type, model_class) for model_class in (
+        ConvolutionalDNABindingModel, 
+        PWMBindingModel, 
+        EnergeticDNABindingModel)
+)
+
+def build_binding_model_from_repr_dict(data):
+    """Build a binding model from the output of model._build_repr_dict().
+
+    """
+    data = dict(data)
+    object_type = MODEL_TYPES[data.pop('model_type')]
+    return object_type(**data)
 
 def load_binding_model(fname):
+    import yaml
     with open(fname) as fp:
         data = yaml.load(fp)
-        object_type = globals()[data['model_type']]
-        del data['model_type']
-        return object_type(**data)
+        return build_binding_model_from_repr_dict(data)
+
+def load_binding_models(fname):
+    """Load the models written by DNABindingModels.save.
+
+    """
+    import yaml
+    with open(fname) as fp:
+        return DNABindingModels(
+            build_binding_model_from_repr_dict(data) 
+            for data in yaml.load(fp))
 
 class ReducedDeltaDeltaGArray(np.ndarray):
     def calc_base_contributions(self):
@@ -466,9 +1389,12 @@ class ReducedDeltaDeltaGArray(np.ndarray):
         return ref_energy + base_contribs.max(1).sum()
 
     def reverse_complement(self):
-        rc_array = np.zeros(self.shape, dtype=self.dtype)
         ts_cont = float(self[2,:].sum())
-        rc_array[(0,1),:] = self[(1,0),:]
+        # copy once at the full shape (so the shape rows are kept), then swap
+        # rows 0 and 1 and zero row 2 in place
+        rc_array = np.array(self)
+        rc_array[(0,1),:] = rc_array[(1,0),:]
+        rc_array[2,:] = 0
         rc_array[:,:3] -= self[2,:3]
         return ts_cont, rc_array.view(DeltaDeltaGArray)[:,::-1]
 
@@ -512,16 +1438,20 @@ class ReducedDeltaDeltaGArray(np.ndarray):
 
 class DeltaDeltaGArray(np.ndarray):
     def calc_min_energy(self, ref_energy):
+        _check_one_base_per_row(self.shape[1], 'calc_min_energy')
         return ref_energy + self.min(1).sum()
 
     def calc_max_energy(self, ref_energy):
+        _check_one_base_per_row(self.shape[1], 'calc_max_energy')
         return ref_energy + self.max(1).sum()
 
     def reverse_complement(self):
-        return self[::-1,::-1].view(DeltaDeltaGArray)
+        return reverse_complement_convolutional_filter(self).view(
+            DeltaDeltaGArray)
 
     @property
     def base_portion(self):
+        _check_one_base_per_row(self.shape[1], 'base_portion')
         return self[:,:4]
     
     @property
@@ -538,6 +1468,7 @@ class DeltaDeltaGArray(np.ndarray):
         return self.shape[0]
 
     def consensus_seq(self):
+        _check_one_base_per_row(self.shape[1], 'consensus_seq')
         return "".join( 'ACGT'[x] for x in np.argmin(self, axis=1) )
 
     def summary_str(self, ref_energy):
@@ -584,6 +1515,7 @@ def est_chem_potential_from_affinities(
 
     min_u = -1000 
     max_u = 100+np.log(prot_conc/(R*T))
+    from scipy.optimize import brentq
     rv = brentq(f, min_u, max_u, xtol=1e-4)
     #print "Result: ", rv
     return rv
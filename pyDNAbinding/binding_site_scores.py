@@ -0,0 +1,181 @@
+"""Compact binding site score results with strand information.
+
+A BindingSiteScores stores the MAX binding site scores of a set of
+sequences in one contiguous float32 buffer - the scores of sequence i are
+scores[offsets[i]:offsets[i+1]] - and the strand that won each site as one
+bit per site. Per sequence scores and strands are views (or unpacked
+slices) of the buffers that are built when they're accessed, and the
+summaries (max scores, argmax positions, top sites, sites above a
+threshold, BED intervals) work on the whole buffer at once.
+
+Build one with ConvolutionalDNABindingModel.build_binding_site_scores.
+
+Example:
+
+scores = model.build_binding_site_scores(seqs)
+sites = scores.top_sites(100)
+print scores.to_bed(sites, regions),
+"""
+import numpy as np
+
+# the fields of the site arrays returned by top_sites and sites_above
+SITE_DTYPE = np.dtype([('seq_index', 'int64'), ('position', 'int64'),
+                       ('is_rc', 'bool'), ('score', 'float32')])
+
+class BindingSiteScores(object):
+    """The MAX binding site scores and winning strands of a set of sequences.
+
+    """
+    __slots__ = ['scores', 'offsets', 'motif_len', '_packed_is_rc']
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        """Return a view of the scores of sequence index.
+
+        """
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError, "sequence index out of range"
+        return self.scores[self.offsets[index]:self.offsets[index+1]]
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    @property
+    def num_sites(self):
+        """The number of binding sites of each sequence.
+
+        """
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        return ( self.scores.nbytes + self.offsets.nbytes
+                 + self._packed_is_rc.nbytes )
+
+    def _unpack_is_rc(self, start, stop):
+        # unpack only the bytes that hold the bits of [start, stop)
+        packed = self._packed_is_rc[start//8:(stop + 7)//8]
+        return np.unpackbits(packed)[start%8:start%8 + stop - start].view(bool)
+
+    @property
+    def is_rc(self):
+        """Whether the reverse complement strand won each binding site.
+
+        """
+        return self._unpack_is_rc(0, len(self.scores))
+
+    def strands(self, index):
+        """Return True for the sites of sequence index that the RC strand won.
+
+        """
+        if index < 0:
+            index += len(self)
+        return self._unpack_is_rc(self.offsets[index], self.offsets[index+1])
+
+    def _segment_starts(self):
+        # the buffer offsets of the sequences with at least one binding site
+        has_sites = self.num_sites > 0
+        return has_sites, self.offsets[:-1][has_sites]
+
+    def max_scores(self):
+        """Return the max score of every sequence (-inf if it has no sites).
+
+        """
+        rv = np.full(len(self), -np.inf, dtype='float32')
+        has_sites, starts = self._segment_starts()
+        if len(starts) > 0:
+            rv[has_sites] = np.maximum.reduceat(self.scores, starts)
+        return rv
+
+    def argmax_positions(self):
+        """Return the position of every sequence's best site (-1 if it has
+        no sites).
+
+        Ties go to the first position.
+        """
+        rv = np.full(len(self), -1, dtype='int64')
+        has_sites, starts = self._segment_starts()
+        if len(starts) == 0:
+            return rv
+        seq_indices = np.repeat(np.arange(len(self)), self.num_sites)
+        positions = np.arange(len(self.scores)) - self.offsets[seq_indices]
+        is_max = self.scores == self.max_scores()[seq_indices]
+        rv[has_sites] = np.minimum.reduceat(
+            np.where(is_max, positions, len(self.scores)), starts)
+        return rv
+
+    def _build_sites(self, indices):
+        sites = np.empty(len(indices), dtype=SITE_DTYPE)
+        sites['seq_index'] = np.searchsorted(
+            self.offsets, indices, side='right') - 1
+        sites['position'] = indices - self.offsets[sites['seq_index']]
+        # gather the strand bits without unpacking the whole bit array
+        sites['is_rc'] = (self._packed_is_rc[indices//8]
+                          >> (7 - indices%8)) & 1
+        sites['score'] = self.scores[indices]
+        return sites
+
+    def top_sites(self, k):
+        """Return the k highest scoring sites, from the highest score down.
+
+        Returns a SITE_DTYPE array.
+        """
+        k = min(k, len(self.scores))
+        if k == 0:
+            return np.empty(0, dtype=SITE_DTYPE)
+        indices = np.argpartition(self.scores, len(self.scores) - k)[-k:]
+        indices = indices[np.argsort(-self.scores[indices], kind='mergesort')]
+        return self._build_sites(indices)
+
+    def sites_above(self, threshold):
+        """Return the sites that score above threshold, in sequence order.
+
+        Returns a SITE_DTYPE array.
+        """
+        return self._build_sites(np.flatnonzero(self.scores > threshold))
+
+    def bed_intervals(self, sites, regions=None, name='.'):
+        """Return the (contig, start, stop, name, score, strand) of sites.
+
+        regions is a list of the (contig, start, ...) of each sequence - by
+        default the sequences are named seqN and start at 0.
+        """
+        if regions is None:
+            contigs = ['seq%i' % i for i in xrange(len(self))]
+            region_starts = np.zeros(len(self), dtype='int64')
+        else:
+            contigs = [region[0] for region in regions]
+            region_starts = np.array(
+                [region[1] for region in regions], dtype='int64')
+        starts = region_starts[sites['seq_index']] + sites['position']
+        return [(contigs[seq_index], start, start + self.motif_len, name,
+                 score, '-' if is_rc else '+')
+                for seq_index, start, score, is_rc in zip(
+                        sites['seq_index'].tolist(), starts.tolist(),
+                        sites['score'].tolist(), sites['is_rc'].tolist())]
+
+    def to_bed(self, sites, regions=None, name='.'):
+        """Return sites as BED6 lines (see bed_intervals).
+
+        """
+        return "".join(
+            "%s\t%i\t%i\t%s\t%.5e\t%s\n" % interval
+            for interval in self.bed_intervals(sites, regions, name))
+
+    def __init__(self, scores, offsets, is_rc, motif_len):
+        """Store the scores and strands.
+
+        scores and is_rc are the concatenated per sequence scores and RC
+        strand indicators, and offsets the (num_seqs+1) sequence offsets.
+        """
+        self.scores = np.ascontiguousarray(scores, dtype='float32')
+        self.offsets = np.asarray(offsets, dtype='int64')
+        if len(is_rc) != len(self.scores) or self.offsets[-1] != len(self.scores):
+            raise ValueError, "The scores, strands and offsets don't match"
+        self.motif_len = motif_len
+        self._packed_is_rc = np.packbits(np.asarray(is_rc, dtype=bool))
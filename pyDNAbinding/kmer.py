@@ -0,0 +1,136 @@
+"""Score every k-mer with a convolutional binding model.
+
+K-mers are indexed by sum(base_code[i]*4**(k-1-i)), with A, C, G, T coded
+0, 1, 2, 3 (the same indexing as the shape pentamer table), so a k-mer
+score table is a dense array with 4**k entries.
+
+The table is built by accumulating the filter one position at a time, so
+building it costs O(4**k) rather than scoring 4**k sequences. When k is
+longer than the motif, the score of a k-mer is the maximum over every
+placement of the binding site inside it.
+
+Example:
+
+table = build_kmer_score_table(model, 10)
+scores = score_seq_with_kmer_table('ACGTACGTACGTAC', table)
+"""
+import numpy as np
+
+from sequence import code_encode_sequence, UNKNOWN_BASE
+
+# above this the table doesn't fit comfortably in memory (4**13 floats is 256MB)
+MAX_KMER_LEN = 13
+
+def kmer_index(kmer):
+    """Return the index of kmer in a k-mer score table.
+
+    """
+    index = 0
+    for base in kmer.upper():
+        index = 4*index + 'ACGT'.index(base)
+    return index
+
+def kmer_from_index(index, k):
+    """Return the k-mer with index 'index' (the inverse of kmer_index).
+
+    """
+    bases = []
+    for i in xrange(k):
+        bases.append('ACGT'[index%4])
+        index //= 4
+    return "".join(reversed(bases))
+
+def kmer_len_from_table(kmer_scores):
+    k = int(round(np.log(len(kmer_scores))/np.log(4)))
+    if 4**k != len(kmer_scores):
+        raise ValueError, "K-mer tables must have 4**k entries, found %i" % (
+            len(kmer_scores))
+    return k
+
+def _accumulate_filter_scores(filt):
+    """Return the score of every motif_len-mer under filt (forward strand).
+
+    """
+    scores = np.array(filt[0], dtype='float32')
+    for base_scores in filt[1:]:
+        # appending a base multiplies the index by 4 and adds the base code
+        scores = (scores[:,None] + base_scores[None,:]).ravel()
+    return scores
+
+def build_kmer_score_table(model, k=None, direction='MAX'):
+    """Return the (4**k,) float32 array of the score of every k-mer.
+
+    Input:
+    model    : a convolutional binding model with a one-hot (Nx4) filter
+    k        : the k-mer length, at least the motif length (default: the
+               motif length)
+    direction: FWD, RC or MAX (see score_coded_seq_with_convolutional_filter)
+
+    Entry kmer_index(kmer) is the maximum score over all of the binding sites
+    in kmer, which is the same as model.score_binding_sites(kmer,
+    direction).max().
+    """
+    filt = np.asarray(model.convolutional_filter, dtype='float32')
+    if filt.shape[1] != 4:
+        raise TypeError, "K-mer tables can only be built for one-hot (Nx4) filters"
+    assert direction in ('FWD', 'RC', 'MAX')
+    motif_len = filt.shape[0]
+    if k is None:
+        k = motif_len
+    if k < motif_len:
+        raise ValueError, "k (%i) must be at least the motif length (%i)" % (
+            k, motif_len)
+    if k > MAX_KMER_LEN:
+        raise ValueError, "k (%i) must be at most %i" % (k, MAX_KMER_LEN)
+
+    if direction == 'FWD':
+        motif_scores = _accumulate_filter_scores(filt)
+    elif direction == 'RC':
+        motif_scores = _accumulate_filter_scores(filt[::-1,::-1])
+    else:
+        motif_scores = np.maximum(
+            _accumulate_filter_scores(filt),
+            _accumulate_filter_scores(filt[::-1,::-1]))
+    if k == motif_len:
+        return motif_scores
+
+    # the binding site at offset i of a k-mer is the middle axis of the
+    # (4**i, 4**motif_len, 4**(k-motif_len-i)) shaped table
+    kmer_scores = np.empty(4**k, dtype='float32')
+    kmer_scores.fill(-np.inf)
+    for offset in xrange(k-motif_len+1):
+        view = kmer_scores.reshape(
+            4**offset, 4**motif_len, 4**(k-motif_len-offset))
+        np.maximum(view, motif_scores[None,:,None], out=view)
+    return kmer_scores
+
+def kmer_indices(coded_seq, k):
+    """Return the table index of every k-mer in a base coded sequence.
+
+    Input:
+    coded_seq: uint8 array of base codes (see sequence.code_encode_sequence)
+
+    Returns the (len(coded_seq)-k+1,) int64 array of indices, and a boolean
+    array that is False for k-mers that contain an unknown base.
+    """
+    n_kmers = max(0, len(coded_seq) - k + 1)
+    indices = np.zeros(n_kmers, dtype=np.int64)
+    is_known = np.ones(n_kmers, dtype=bool)
+    for offset in xrange(k):
+        codes = coded_seq[offset:offset+n_kmers]
+        indices *= 4
+        indices += codes & 3
+        is_known &= (codes != UNKNOWN_BASE)
+    return indices, is_known
+
+def score_seq_with_kmer_table(seq, kmer_scores):
+    """Score every k-mer in seq by looking it up in kmer_scores.
+
+    Entry i is the score of the k-mer starting at base i. K-mers that
+    contain an unknown base (e.g. N) are scored NaN.
+    """
+    k = kmer_len_from_table(kmer_scores)
+    indices, is_known = kmer_indices(code_encode_sequence(seq), k)
+    scores = kmer_scores.take(indices)
+    scores[~is_known] = np.nan
+    return scores
@@ -0,0 +1,130 @@
+"""Approximate the scores of many models with a small shared filter basis.
+
+Motif libraries are highly redundant, so the stacked (zero padded) filters
+of a model library are well approximated by a low rank factorization:
+
+filters[i] ~= sum_k coefs[i,k]*basis[k]
+
+Since scoring is linear in the filter, a sequence can be scored by every
+model by convolving it with the basis filters once, and then multiplying
+the basis scores by the coefficient matrix.
+
+For one-hot coded sequences every binding site score is a sum of one filter
+entry per position, so the score error of model i is bounded by the sum over
+positions of the largest absolute residual at that position. The rank is
+chosen as the smallest one where every model's bound is at most max_error.
+"""
+import numpy as np
+
+from signal import multichannel_convolve
+
+NUM_BASES = 4
+DEFAULT_MAX_ERROR = 0.01
+
+def calc_score_error_bounds(residuals):
+    """Return the maximum absolute score error for each residual filter.
+
+    """
+    return np.abs(residuals).max(2).sum(1)
+
+class LowRankFilterBasis(object):
+    """A shared basis for a set of one-hot convolutional filters.
+
+    Attributes:
+    basis     : (rank, max_motif_len, 4) basis filters
+    coefs     : (num_models, rank) coefficients of each model's filter
+    errors    : (num_models,) bound on the absolute score error of each model
+    motif_lens: (num_models,) motif length of each model
+    """
+    @property
+    def rank(self):
+        return self.basis.shape[0]
+
+    def _score_basis(self, coded_seq):
+        """Score the binding sites at every position with the basis filters.
+
+        The sequence is zero padded so that every model's binding sites are
+        scored - the padding contributes nothing to the model scores (it only
+        overlaps the padding of the shorter filters).
+        """
+        padded_seq = np.zeros(
+            (len(coded_seq) + self.max_motif_len - 1, coded_seq.shape[1]),
+            dtype='float32')
+        padded_seq[:len(coded_seq)] = coded_seq
+        basis_scores = np.empty((self.rank, len(coded_seq)), dtype='float32')
+        for i, filt in enumerate(self.basis):
+            basis_scores[i] = multichannel_convolve(
+                padded_seq, np.fliplr(np.flipud(filt)), mode='valid')
+        return basis_scores
+
+    def score_coded_seq(self, coded_seq, direction):
+        """Approximately score coded_seq with every model.
+
+        Returns a list of num_models binding site score arrays, in the same
+        format as ConvolutionalDNABindingModel.score_binding_sites.
+        """
+        assert direction in ('FWD', 'RC', 'MAX')
+        if coded_seq.shape[1] != NUM_BASES:
+            raise TypeError, "Low rank scoring requires one-hot (Nx4) coded sequences"
+        seq_len = len(coded_seq)
+        num_sites = np.maximum(seq_len - self.motif_lens + 1, 0)
+        if direction in ('FWD', 'MAX'):
+            fwd_scores = np.dot(self.coefs, self._score_basis(coded_seq))
+        if direction in ('RC', 'MAX'):
+            # score the reverse complement sequence with the forward filters,
+            # and then map the positions back to the forward strand
+            rc_scores = np.dot(
+                self.coefs, self._score_basis(coded_seq[::-1,::-1]))
+        rv = []
+        for i, model_num_sites in enumerate(num_sites):
+            if direction != 'RC':
+                scores = fwd_scores[i,:model_num_sites]
+            if direction != 'FWD':
+                model_rc_scores = rc_scores[i,:model_num_sites][::-1]
+                if direction == 'RC':
+                    scores = model_rc_scores
+                else:
+                    scores = np.maximum(scores, model_rc_scores)
+            rv.append(scores)
+        return rv
+
+    def __init__(self, filters, max_error=DEFAULT_MAX_ERROR, rank=None):
+        """Factorize filters.
+
+        Input:
+        filters  : list of (motif_len, 4) convolutional filters
+        max_error: the largest allowed score error for any model
+        rank     : use this rank instead of choosing it from max_error
+        """
+        if len(filters) == 0:
+            raise ValueError, "A low rank basis needs at least one filter"
+        for filt in filters:
+            if filt.shape[1] != NUM_BASES:
+                raise TypeError, "Low rank approximations require one-hot (Nx4) filters"
+        self.motif_lens = np.array([len(filt) for filt in filters])
+        self.max_motif_len = self.motif_lens.max()
+        stacked_filters = np.zeros(
+            (len(filters), self.max_motif_len, NUM_BASES), dtype='float64')
+        for i, filt in enumerate(filters):
+            stacked_filters[i,:len(filt)] = filt
+        flat_filters = stacked_filters.reshape(len(filters), -1)
+
+        U, S, Vt = np.linalg.svd(flat_filters, full_matrices=False)
+        max_rank = len(S)
+        if rank is None:
+            # choose the smallest rank that meets the error bound
+            for rank in xrange(1, max_rank+1):
+                residuals = flat_filters - np.dot(U[:,:rank]*S[:rank], Vt[:rank])
+                errors = calc_score_error_bounds(
+                    residuals.reshape(stacked_filters.shape))
+                if errors.max() <= max_error:
+                    break
+        rank = min(rank, max_rank)
+        self.coefs = (U[:,:rank]*S[:rank]).astype('float32')
+        self.basis = Vt[:rank].reshape(
+            (rank, self.max_motif_len, NUM_BASES)).astype('float32')
+        residuals = flat_filters - np.dot(
+            self.coefs, self.basis.reshape(rank, -1))
+        self.errors = calc_score_error_bounds(
+            residuals.reshape(stacked_filters.shape))
+        self.max_error = max_error
@@ -0,0 +1,226 @@
+"""Binary binding model library format.
+
+A model library stores many binding models in a single file:
+
+header: 8 byte magic string, uint32 version, uint32 padding, uint64 index
+        length (all little endian)
+index : a json encoded list with one entry per model, storing the model
+        type, meta data, scalar parameters, and the offset and shape of
+        the model's array in the data section
+data  : the model arrays stored contiguously as little endian float32,
+        starting at the first 64 byte boundary after the index
+
+The data section is memory mapped and models are only built when they are
+accessed, so opening a library with thousands of models just parses the
+index. Arrays are stored as float32 (the dtype that the models use) so
+round trips through the library are lossless.
+"""
+import os
+import json
+import struct
+
+from collections import OrderedDict
+
+import numpy as np
+
+from binding_model import (
+    DNABindingModels, MODEL_TYPES, ConvolutionalDNABindingModel,
+    PWMBindingModel, EnergeticDNABindingModel, load_binding_models )
+
+MODEL_LIBRARY_MAGIC = 'PYDNABML'
+MODEL_LIBRARY_VERSION = 1
+_header_struct = struct.Struct('<8sIIQ')
+DATA_ALIGNMENT = 64
+DATA_DTYPE = np.dtype('<f4')
+# the meta data fields that models can be looked up by
+INDEXED_KEYS = ('motif_id', 'tf_name', 'tf_id')
+
+# the name of the array that each model type is built from, keyed by the
+# model_type strings that MODEL_TYPES (and so the loader) uses. Every other
+# entry in the model's repr dict is either meta data or a scalar parameter.
+MODEL_ARRAY_NAMES = {
+    ConvolutionalDNABindingModel.model_type: 'convolutional_filter',
+    PWMBindingModel.model_type: 'pwm',
+    EnergeticDNABindingModel.model_type: 'ddg_array'
+}
+
+def _get_model_array(model, array_name):
+    if array_name == 'ddg_array':
+        return model.ddg_array
+    elif array_name == 'pwm':
+        return model.pwm
+    elif array_name == 'convolutional_filter':
+        return model.convolutional_filter
+    assert False, "Unrecognized array name '%s'" % array_name
+
+def _to_str(data):
+    """Convert the unicode strings produced by json.loads to str.
+
+    This is only done for the entries that are accessed, because converting
+    the full index is much slower than parsing it.
+    """
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    elif isinstance(data, list):
+        return [_to_str(x) for x in data]
+    elif isinstance(data, dict):
+        return dict(
+            (_to_str(key), _to_str(value)) for key, value in data.iteritems())
+    return data
+
+def save_binding_model_library(models, fname):
+    """Write models to fname in the binary model library format.
+
+    """
+    index = []
+    arrays = []
+    offset = 0
+    for model in models:
+        array_name = MODEL_ARRAY_NAMES[model.model_type]
+        array = np.ascontiguousarray(
+            _get_model_array(model, array_name), dtype=DATA_DTYPE)
+        params = model._build_repr_dict()
+        del params['model_type']
+        del params[array_name]
+        # the encoding type is determined by the array's shape
+        params.pop('encoding_type', None)
+        if 'ref_energy' in params:
+            params['ref_energy'] = float(params['ref_energy'])
+        index.append(OrderedDict([
+            ('model_type', model.model_type),
+            ('params', params),
+            ('array_name', array_name),
+            ('shape', list(array.shape)),
+            ('offset', offset)
+        ]))
+        arrays.append(array)
+        offset += array.size
+
+    index_str = json.dumps(index)
+    data_start = _header_struct.size + len(index_str)
+    padding = -data_start % DATA_ALIGNMENT
+    with open(fname, 'wb') as ofp:
+        ofp.write(_header_struct.pack(
+            MODEL_LIBRARY_MAGIC, MODEL_LIBRARY_VERSION, 0, len(index_str)))
+        ofp.write(index_str)
+        ofp.write('\0'*padding)
+        for array in arrays:
+            ofp.write(array.tostring())
+    return
+
+def is_binding_model_library(fname):
+    with open(fname, 'rb') as fp:
+        return fp.read(len(MODEL_LIBRARY_MAGIC)) == MODEL_LIBRARY_MAGIC
+
+class BindingModelLibrary(object):
+    """A lazily loaded collection of binding models stored in a model library.
+
+    Models are built the first time that they are accessed and then cached.
+    """
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, index):
+        if index not in self._models:
+            self._models[index] = self._build_model(self._index[index])
+        return self._models[index]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def _build_model(self, entry):
+        start = entry['offset']
+        stop = start + int(np.prod(entry['shape']))
+        array = self._data[start:stop].reshape(entry['shape'])
+        params = _to_str(entry['params'])
+        params[_to_str(entry['array_name'])] = array
+        return MODEL_TYPES[entry['model_type']](**params)
+
+    @property
+    def motif_ids(self):
+        return [_to_str(entry['params'].get('motif_id'))
+                for entry in self._index]
+
+    @property
+    def tf_names(self):
+        return [_to_str(entry['params'].get('tf_name'))
+                for entry in self._index]
+
+    def _find_indices(self, key, values):
+        if isinstance(values, str): values = [values,]
+        key_indices = self._key_indices[key]
+        indices = set()
+        for value in values:
+            indices.update(key_indices.get(value, []))
+        # return the models in library order
+        return sorted(indices)
+
+    def get_model(self, motif_id):
+        """Return the model with motif id motif_id.
+
+        """
+        indices = self._key_indices['motif_id'].get(motif_id, [])
+        if len(indices) == 0:
+            raise KeyError, "No model with motif_id '%s'" % motif_id
+        if len(indices) > 1:
+            raise ValueError, "%i models have motif_id '%s'" % (
+                len(indices), motif_id)
+        return self[indices[0]]
+
+    def get_models(self, tf_names=None, tf_ids=None, motif_ids=None):
+        """Return a DNABindingModels object with the matching models.
+
+        Follows the conventions of the DB loaders - at most one of tf_names,
+        tf_ids, and motif_ids can be set, and if none are set then every
+        model is returned.
+        """
+        filters = [(key, values) for key, values in (
+                       ('tf_name', tf_names),
+                       ('tf_id', tf_ids),
+                       ('motif_id', motif_ids))
+                   if values is not None]
+        if len(filters) > 1:
+            raise ValueError, "only one of tf_ids, tf_names, and motif_ids can can be set."
+        if len(filters) == 0:
+            indices = range(len(self))
+        else:
+            indices = self._find_indices(*filters[0])
+        return DNABindingModels(self[i] for i in indices)
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, 'rb') as fp:
+            magic, version, _, index_len = _header_struct.unpack(
+                fp.read(_header_struct.size))
+            if magic != MODEL_LIBRARY_MAGIC:
+                raise ValueError, "'%s' is not a binding model library" % fname
+            if version != MODEL_LIBRARY_VERSION:
+                raise ValueError, \
+                    "Unsupported model library version '%i'" % version
+            self._index = json.loads(fp.read(index_len))
+        # map the values of the indexed meta data fields to model indices, so
+        # that lookups don't scan the index
+        self._key_indices = dict((key, {}) for key in INDEXED_KEYS)
+        for i, entry in enumerate(self._index):
+            for key in INDEXED_KEYS:
+                value = entry['params'].get(key)
+                if value is not None:
+                    self._key_indices[key].setdefault(value, []).append(i)
+        data_start = _header_struct.size + index_len
+        data_start += -data_start % DATA_ALIGNMENT
+        num_entries = max(
+            0, os.path.getsize(fname) - data_start)//DATA_DTYPE.itemsize
+        if num_entries == 0:
+            self._data = np.zeros(0, dtype=DATA_DTYPE)
+        else:
+            self._data = np.memmap(
+                fname, dtype=DATA_DTYPE, mode='r',
+                offset=data_start, shape=(num_entries,))
+        self._models = {}
+
+def convert_yaml_to_binding_model_library(yaml_fname, library_fname):
+    save_binding_model_library(load_binding_models(yaml_fname), library_fname)
+
+def convert_binding_model_library_to_yaml(library_fname, ofstream):
+    BindingModelLibrary(library_fname).get_models().save(ofstream)
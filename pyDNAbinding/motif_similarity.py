@@ -0,0 +1,138 @@
+"""Compare and cluster binding models by the similarity of their filters.
+
+The similarity of two models is the maximum, over every relative offset and
+both strands, of the cosine similarity of their (zero padded) aligned
+filters. The base channels of each filter position are centered first, so
+that position independent terms (e.g. the reference energy) and the scale
+of the filter don't matter - PWM and energetic models can be compared
+directly.
+
+Each offset is a single matrix multiply over all pairs of models, so
+comparing a library of thousands of models takes seconds. The clusters of
+similar models can then be reduced to representative models before
+scanning, e.g.:
+
+models = select_representative_models(models, min_similarity=0.8)
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from binding_model import DNABindingModels
+
+NUM_BASES = 4
+
+# (num_models, num_models) arrays - the best similarity, the position in
+# model i that base 0 of model j aligns to, and whether model j's reverse
+# complement was aligned
+MotifSimilarities = namedtuple(
+    'MotifSimilarities', ['similarity', 'offsets', 'is_rc'])
+
+def _normalized_filters(models):
+    """Return the centered, unit norm base filters of models.
+
+    Returns the forward and reverse complement filters as
+    (num_models, max_motif_len, 4) zero padded arrays.
+    """
+    max_motif_len = max(model.motif_len for model in models)
+    fwd_filters = np.zeros(
+        (len(models), max_motif_len, NUM_BASES), dtype='float32')
+    rc_filters = np.zeros_like(fwd_filters)
+    for i, model in enumerate(models):
+        filt = np.asarray(
+            model.convolutional_filter[:,:NUM_BASES], dtype='float32')
+        filt = filt - filt.mean(1)[:,None]
+        norm = np.sqrt((filt**2).sum())
+        if norm > 0:
+            filt /= norm
+        fwd_filters[i,:model.motif_len] = filt
+        rc_filters[i,:model.motif_len] = filt[::-1,::-1]
+    return fwd_filters, rc_filters
+
+def calc_motif_similarities(models, other_models=None):
+    """Compare every model in models against every model in other_models.
+
+    other_models defaults to models (all-vs-all).
+
+    Returns a MotifSimilarities tuple of (len(models), len(other_models))
+    arrays.
+    """
+    models = list(models)
+    other_models = models if other_models is None else list(other_models)
+    num_models = len(models)
+    if num_models == 0 or len(other_models) == 0:
+        shape = (num_models, len(other_models))
+        return MotifSimilarities(np.zeros(shape, dtype='float32'),
+                                 np.zeros(shape, dtype=int),
+                                 np.zeros(shape, dtype=bool))
+    all_fwd_filters, all_rc_filters = _normalized_filters(
+        models + other_models)
+    fwd_filters = all_fwd_filters[:num_models]
+    other_fwd_filters = all_fwd_filters[num_models:]
+    other_rc_filters = all_rc_filters[num_models:]
+    max_motif_len = fwd_filters.shape[1]
+
+    similarity = np.empty(
+        (num_models, len(other_models)), dtype='float32')
+    similarity.fill(-np.inf)
+    offsets = np.zeros(similarity.shape, dtype=int)
+    is_rc = np.zeros(similarity.shape, dtype=bool)
+    for offset in xrange(-max_motif_len+1, max_motif_len):
+        # align base 0 of the other filters with base 'offset' of filters
+        overlap = max_motif_len - abs(offset)
+        start, other_start = max(0, offset), max(0, -offset)
+        fwd = fwd_filters[:,start:start+overlap].reshape(num_models, -1)
+        for rc, other_filters in ((False, other_fwd_filters),
+                                  (True, other_rc_filters)):
+            other = other_filters[
+                :,other_start:other_start+overlap].reshape(len(other_models), -1)
+            offset_similarity = np.dot(fwd, other.T)
+            is_better = offset_similarity > similarity
+            similarity[is_better] = offset_similarity[is_better]
+            offsets[is_better] = offset
+            is_rc[is_better] = rc
+    return MotifSimilarities(similarity, offsets, is_rc)
+
+def cluster_models(models, min_similarity=0.8, similarities=None):
+    """Cluster models so that every cluster's average similarity is high.
+
+    The clusters are built by average linkage hierarchical clustering on
+    1 - similarity, and cut at 1 - min_similarity.
+
+    Returns a list of clusters, each a list of model indices ordered by their
+    mean similarity to the rest of the cluster (so the first index is the
+    cluster's representative model).
+    """
+    models = list(models)
+    if len(models) == 0:
+        return []
+    if len(models) == 1:
+        return [[0,]]
+    if similarities is None:
+        similarities = calc_motif_similarities(models).similarity
+    from scipy.cluster.hierarchy import linkage, fcluster
+    from scipy.spatial.distance import squareform
+    distances = 1 - np.clip(similarities, -1, 1).astype(float)
+    # make the distance matrix exactly symmetric with a 0 diagonal
+    distances = (distances + distances.T)/2
+    np.fill_diagonal(distances, 0)
+    labels = fcluster(
+        linkage(squareform(distances, checks=False), method='average'),
+        1 - min_similarity, criterion='distance')
+    clusters = []
+    for label in np.unique(labels):
+        members = np.nonzero(labels == label)[0]
+        mean_similarity = similarities[np.ix_(members, members)].mean(1)
+        clusters.append(
+            [int(x) for x in members[np.argsort(-mean_similarity, kind='mergesort')]])
+    # order the clusters by their first member, so the output is deterministic
+    clusters.sort(key=lambda x: min(x))
+    return clusters
+
+def select_representative_models(models, min_similarity=0.8):
+    """Return one representative model from each cluster of similar models.
+
+    """
+    models = list(models)
+    clusters = cluster_models(models, min_similarity)
+    return DNABindingModels([models[cluster[0]] for cluster in clusters])
@@ -1,19 +1,16 @@
+import os
 import re
 
 from math import ceil
 
 from itertools import izip
 
-from matplotlib import pyplot
-from matplotlib.patches import PathPatch
-from matplotlib.path import Path
-
-from shapely.wkt import loads as load_wkt
+import numpy as np
 
-from shapely import affinity
-from shapely.geometry import asLineString
+from misc import R, T
 
-import numpy as np
+# matplotlib and shapely are slow to import, so they're imported by the 
+# functions that use them
 
 ################################################################################
 # copied from descartes
@@ -48,6 +45,7 @@ class Polygon(object):
 def PolygonPath(polygon):
     """Constructs a compound matplotlib path from a Shapely or GeoJSON-like
     geometric object"""
+    from matplotlib.path import Path
     this = Polygon(polygon)
     assert this.geom_type == 'Polygon'
     def coding(ob):
@@ -80,6 +78,7 @@ def PolygonPatch(polygon, **kwargs):
       >>> axis.add_patch(patch)
 
     """
+    from matplotlib.patches import PathPatch
     return PathPatch(PolygonPath(polygon), **kwargs)
 
 #
@@ -143,11 +142,11 @@ T_data = """POLYGON((
 25.5684 -1.422, 25.5684 51.5569, 6.781 51.5569, 6.781 58.3746
 ))"""
 
-def standardize_polygons_str(data_str):
-    """Given a POLYGON string, standardize the coordinates to a 1x1 grid.
+def parse_polygons_str(data_str):
+    """Given a POLYGON string, return the coordinates on a 1x1 grid.
 
     Input : data_str (taken from above)
-    Output: tuple of polygon objects 
+    Output: list of (num_vertices, 2) polygon vertex arrays
     """
     # find all of the polygons in the letter (for instance an A
     # needs to be constructed from 2 polygons)
@@ -161,25 +160,46 @@ def standardize_polygons_str(data_str):
         polygons_data.append(data)
 
     # standardize the coordinates
-    min_coords = np.vstack(data.min(0) for data in polygons_data).min(0)
-    max_coords = np.vstack(data.max(0) for data in polygons_data).max(0)
+    min_coords = np.vstack([data.min(0) for data in polygons_data]).min(0)
+    max_coords = np.vstack([data.max(0) for data in polygons_data]).max(0)
     for data in polygons_data:
         data[:,] -= min_coords
         data[:,] /= (max_coords - min_coords)
 
+    return polygons_data
+
+def standardize_polygons_str(data_str):
+    """Given a POLYGON string, standardize the coordinates to a 1x1 grid.
+
+    Input : data_str (taken from above)
+    Output: tuple of polygon objects 
+    """
+    from shapely.wkt import loads as load_wkt
     polygons = []
-    for data in polygons_data:
+    for data in parse_polygons_str(data_str):
         polygons.append(load_wkt(
             "POLYGON((%s))" % ",".join(" ".join(map(str, x)) for x in data)))
 
     return tuple(polygons)
 
 
+# the letter polygons are built the first time that they're needed
 letters_polygons = {}
-letters_polygons['A'] = standardize_polygons_str(A_data)
-letters_polygons['C'] = standardize_polygons_str(C_data)
-letters_polygons['G'] = standardize_polygons_str(G_data)
-letters_polygons['T'] = standardize_polygons_str(T_data)
+def load_letters_polygons():
+    if len(letters_polygons) == 0:
+        letters_polygons['A'] = standardize_polygons_str(A_data)
+        letters_polygons['C'] = standardize_polygons_str(C_data)
+        letters_polygons['G'] = standardize_polygons_str(G_data)
+        letters_polygons['T'] = standardize_polygons_str(T_data)
+    return letters_polygons
+
+# the letter vertex arrays are built the first time that they're needed
+letters_vertices = {}
+def load_letters_vertices():
+    if len(letters_vertices) == 0:
+        for letter, data_str in izip('ACGT', (A_data, C_data, G_data, T_data)):
+            letters_vertices[letter] = parse_polygons_str(data_str)
+    return letters_vertices
 
 colors = dict(izip(
     'ACGT', (('red', 'white'), ('blue',), ('orange',), ('green',))
@@ -189,7 +209,8 @@ def add_letter_to_axis(ax, let, x, y, height):
     """Add 'let' with position x,y and height height to matplotlib axis 'ax'.
     
     """
-    for polygon, color in izip(letters_polygons[let], colors[let]):
+    from shapely import affinity
+    for polygon, color in izip(load_letters_polygons()[let], colors[let]):
         new_polygon = affinity.scale(
             polygon, yfact=height)
         new_polygon = affinity.translate(
@@ -199,28 +220,77 @@ def add_letter_to_axis(ax, let, x, y, height):
         ax.add_patch(patch)
     return
 
-def plot_bases(letter_heights, ylab='bits'):
+################################################################################
+# Vectorized logos
+#
+# Every letter polygon of a logo is placed with one array operation per
+# polygon type, and the polygons of each color are joined into one compound
+# path, so a logo is a single PathCollection of 5 paths regardless of its
+# length.
+#
+
+# matplotlib.path.Path codes (matplotlib is slow to import)
+MOVETO, LINETO = 1, 2
+
+def logo_paths(letter_heights, x_offset=0.5):
+    """Return the (color, vertices, codes) compound paths of a logo.
+
+    Letter i is drawn in [x_offset+i, x_offset+i+1), and the letters at each
+    position are stacked from the shortest to the tallest. The paths are in
+    drawing order.
+    """
+    letter_heights = np.asarray(letter_heights, dtype=float)
+    assert letter_heights.ndim == 2 and letter_heights.shape[1] == 4
+    assert letter_heights.min() >= 0
+    # stack the letters in order of height (ties are broken by letter, like
+    # sorting (height, letter) pairs)
+    order = np.argsort(letter_heights, axis=1, kind='mergesort')
+    positions = np.arange(len(letter_heights))[:,None]
+    sorted_heights = letter_heights[positions, order]
+    y_offsets = np.empty_like(letter_heights)
+    y_offsets[positions, order] = sorted_heights.cumsum(1) - sorted_heights
+
+    paths = []
+    for i, letter in enumerate('ACGT'):
+        is_drawn = letter_heights[:,i] > 0
+        xs = x_offset + np.flatnonzero(is_drawn)
+        heights, ys = letter_heights[is_drawn,i], y_offsets[is_drawn,i]
+        for polygon, color in izip(load_letters_vertices()[letter],
+                                   colors[letter]):
+            # the unit square letter, scaled to height and moved into place
+            vertices = np.empty((len(xs), len(polygon), 2))
+            vertices[:,:,0] = polygon[:,0] + xs[:,None]
+            vertices[:,:,1] = polygon[:,1]*heights[:,None] + ys[:,None]
+            codes = np.full((len(xs), len(polygon)), LINETO, dtype='uint8')
+            codes[:,0] = MOVETO
+            paths.append((color, vertices.reshape(-1, 2), codes.ravel()))
+    return paths
+
+def logo_path_collection(letter_heights, x_offset=0.5):
+    """Return a logo as a matplotlib PathCollection (see logo_paths).
+
+    """
+    from matplotlib.path import Path
+    from matplotlib.collections import PathCollection
+    paths = logo_paths(letter_heights, x_offset)
+    path_colors = [color for color, vertices, codes in paths]
+    return PathCollection(
+        [Path(vertices, codes) for color, vertices, codes in paths],
+        facecolors=path_colors, edgecolors=path_colors)
+
+def plot_logo(ax, letter_heights, ylab='bits'):
     """Plot the N letters with heights taken from the Nx4 matrix letter_heights.
 
     Inputs: 
+    ax: matplotlib axis to draw on
     letter_heights: Nx4 matrix containing non-negative letter heights for N bases
     ylab: x axis label
     """
-    assert letter_heights.shape[1] == 4
-    assert letter_heights.min() >= 0
-    
-    fig = pyplot.figure()
-
+    letter_heights = np.asarray(letter_heights)
     x_range = [1, letter_heights.shape[0]]
-    y_range = [0, int(ceil(letter_heights.sum(1).max()))]
+    y_range = [0, max(1, int(ceil(letter_heights.sum(1).max())))]
 
-    ax = fig.add_subplot(111)
-    for x_pos, heights in enumerate(letter_heights):
-        letters_and_heights = sorted(izip(heights, 'ACGT'))
-        y_pos = 0.0
-        for height, letter in letters_and_heights:
-            add_letter_to_axis(ax, letter, 0.5+x_pos, y_pos, height)
-            y_pos += height
+    ax.add_collection(logo_path_collection(letter_heights))
 
     ax.set_xlabel('pos')
     ax.set_ylabel(ylab)
@@ -232,8 +302,99 @@ def plot_bases(letter_heights, ylab='bits'):
     ax.set_yticks(range(*y_range) + [y_range[-1]])
 
     ax.set_aspect(1)
+    return ax
+
+def plot_bases(letter_heights, ylab='bits'):
+    """Plot the N letters with heights taken from the Nx4 matrix letter_heights.
+
+    Inputs: 
+    letter_heights: Nx4 matrix containing non-negative letter heights for N bases
+    ylab: x axis label
+    """
+    from matplotlib import pyplot
+    fig = pyplot.figure()
+    plot_logo(fig.add_subplot(111), letter_heights, ylab)
+    return fig
+
+################################################################################
+# Batch rendering
+
+def model_base_frequencies(model, temperature=R*T):
+    """Return the (motif_len, 4) base frequencies of model's binding sites.
+
+    PWM models return their PWM. For other models the frequencies at each
+    position are proportional to exp(score/temperature), which for energetic
+    models (scores in kcal/mol) is the Boltzmann distribution of the bases.
+    """
+    pwm = getattr(model, 'pwm', None)
+    if pwm is not None:
+        return np.asarray(pwm, dtype=float)
+    filt = np.asarray(model.convolutional_filter, dtype=float)
+    if filt.shape[1] == 16:
+        raise ValueError, "Logos of dinucleotide models aren't supported"
+    # the base channels come first (the rest are shape channels)
+    scores = filt[:,:4]/temperature
+    freqs = np.exp(scores - scores.max(1)[:,None])
+    return freqs/freqs.sum(1)[:,None]
+
+def information_content_heights(freqs):
+    """Return the letter heights (in bits) of (motif_len, 4) base frequencies.
+
+    """
+    freqs = np.asarray(freqs, dtype=float)
+    entropies = -(freqs*np.log2(np.where(freqs > 0, freqs, 1))).sum(1)
+    return freqs*(2 - entropies)[:,None]
+
+def _render_logo(fname, letter_heights, title, dpi):
+    # use the Agg canvas directly, so that the workers don't depend on the
+    # pyplot backend or keep references to the figures
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=(max(4, 0.5*len(letter_heights)+1), 3))
+    FigureCanvasAgg(fig)
+    ax = plot_logo(fig.add_subplot(111), letter_heights)
+    if title is not None:
+        ax.set_title(title)
+    fig.savefig(fname, dpi=dpi, bbox_inches='tight')
+    return fname
+
+def _render_logos_worker(args):
+    return [_render_logo(*x) for x in args]
+
+def render_logos(models, outdir, processes=1, fmt='png', dpi=100,
+                 temperature=R*T, chunk_size=50):
+    """Render the information content logo of every model into outdir.
+
+    The logos are named after the models' motif_id (or model_N if the model
+    doesn't have one), and are rendered in chunks of chunk_size models by
+    processes worker processes.
+
+    Returns the logo file names, in the order of models.
+    """
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    jobs = []
+    for i, model in enumerate(models):
+        name = str(getattr(model, 'motif_id', 'model_%i' % i))
+        jobs.append((os.path.join(outdir, "%s.%s" % (name, fmt)),
+                     information_content_heights(
+                         model_base_frequencies(model, temperature)),
+                     getattr(model, 'tf_name', None),
+                     dpi))
+    chunks = [jobs[i:i+chunk_size] for i in xrange(0, len(jobs), chunk_size)]
+    if processes > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_render_logos_worker, chunks)
+        finally:
+            pool.terminate()
+    else:
+        results = map(_render_logos_worker, chunks)
+    return [fname for chunk in results for fname in chunk]
 
 def example():
+    from matplotlib import pyplot
     pwm = np.array([[0,0,0.01,1], [2,5.2,1,1]])
     plot_bases(pwm)
     pyplot.show()
@@ -241,4 +402,4 @@ def example():
 if __name__ == '__main__':
     example()
 
-__all__ = [add_letter_to_axis, plot_bases]
+__all__ = [add_letter_to_axis, plot_bases, plot_logo, render_logos]
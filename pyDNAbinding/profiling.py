@@ -0,0 +1,206 @@
+"""Opt-in per-stage timing instrumentation.
+
+The scoring code is instrumented with named stages (e.g. 'encode',
+'signal.transform', 'score.strand_max'). When profiling is enabled, each
+stage records its call count, wall time, the time spent outside of nested
+stages (self time - for the top level 'score' stages this is the python
+overhead), the number of bytes allocated for its results, and cache hits
+and misses. When profiling is disabled, stage() returns a shared no-op
+context manager, so the instrumentation costs a function call per stage.
+
+Example:
+
+with profiling.profile() as stats:
+    seqs.score_binding_sites(model, 'MAX')
+print profiling.report(stats)
+
+Profiling can also be enabled for the whole process by setting the
+PYDNABINDING_PROFILE environment variable, and the statistics dumped with
+report() or sent to a metrics sink with export_metrics().
+"""
+import os
+import time
+import threading
+
+from contextlib import contextmanager
+
+_enabled = os.environ.get('PYDNABINDING_PROFILE', '') not in ('', '0')
+_registry = {}
+_registry_lock = threading.Lock()
+_thread_state = threading.local()
+
+class StageStats(object):
+    """Statistics accumulated over all of the calls to a stage.
+
+    """
+    __slots__ = ['name', 'calls', 'total_time', 'self_time', 'bytes_allocated',
+                 'cache_hits', 'cache_misses']
+
+    @property
+    def cache_hit_rate(self):
+        lookups = self.cache_hits + self.cache_misses
+        return None if lookups == 0 else float(self.cache_hits)/lookups
+
+    def as_dict(self):
+        return dict((key, getattr(self, key)) for key in (
+            'calls', 'total_time', 'self_time', 'bytes_allocated',
+            'cache_hits', 'cache_misses', 'cache_hit_rate'))
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.total_time = 0.0
+        self.self_time = 0.0
+        self.bytes_allocated = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+def _get_stats(name):
+    try:
+        return _registry[name]
+    except KeyError:
+        with _registry_lock:
+            return _registry.setdefault(name, StageStats(name))
+
+class _NullStage(object):
+    """The stage returned when profiling is disabled.
+
+    """
+    __slots__ = []
+    def __enter__(self): return self
+    def __exit__(self, *args): return False
+    def add_bytes(self, nbytes): pass
+    def add_array(self, array): pass
+
+_NULL_STAGE = _NullStage()
+
+class _Stage(object):
+    __slots__ = ['name', 'start', 'child_time', 'nbytes']
+
+    def add_bytes(self, nbytes):
+        self.nbytes += nbytes
+
+    def add_array(self, array):
+        self.nbytes += getattr(array, 'nbytes', 0)
+
+    def __enter__(self):
+        stack = getattr(_thread_state, 'stack', None)
+        if stack is None:
+            stack = _thread_state.stack = []
+        stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.time() - self.start
+        stack = _thread_state.stack
+        stack.pop()
+        if len(stack) > 0:
+            stack[-1].child_time += elapsed
+        stats = _get_stats(self.name)
+        with _registry_lock:
+            stats.calls += 1
+            stats.total_time += elapsed
+            stats.self_time += elapsed - self.child_time
+            stats.bytes_allocated += self.nbytes
+        return False
+
+    def __init__(self, name):
+        self.name = name
+        self.child_time = 0.0
+        self.nbytes = 0
+
+def stage(name):
+    """Return a context manager that records the time spent in stage 'name'.
+
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name)
+
+def record_cache_lookup(name, hit):
+    """Record a cache hit (or miss if hit is False) for the cache 'name'.
+
+    """
+    if not _enabled: return
+    stats = _get_stats(name)
+    with _registry_lock:
+        if hit: stats.cache_hits += 1
+        else: stats.cache_misses += 1
+    return
+
+def enable():
+    global _enabled
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def is_enabled():
+    return _enabled
+
+def reset():
+    with _registry_lock:
+        _registry.clear()
+
+def get_stats():
+    """Return a dict mapping stage names to a copy of their StageStats.
+
+    """
+    with _registry_lock:
+        rv = {}
+        for name, stats in _registry.iteritems():
+            copy = StageStats(name)
+            for key in StageStats.__slots__:
+                setattr(copy, key, getattr(stats, key))
+            rv[name] = copy
+        return rv
+
+@contextmanager
+def profile(reset_stats=True):
+    """Enable profiling within a with block.
+
+    Yields a dict that is filled with the stage statistics when the
+    block exits.
+    """
+    was_enabled = _enabled
+    if reset_stats: reset()
+    enable()
+    stats = {}
+    try:
+        yield stats
+    finally:
+        if not was_enabled: disable()
+        stats.update(get_stats())
+
+def report(stats=None):
+    """Return a table of the stage statistics, sorted by total time.
+
+    """
+    if stats is None:
+        stats = get_stats()
+    lines = ["%-28s %8s %10s %10s %12s %8s" % (
+        'stage', 'calls', 'total (s)', 'self (s)', 'bytes', 'cache hit')]
+    for stage_stats in sorted(
+            stats.values(), key=lambda x: -x.total_time):
+        hit_rate = stage_stats.cache_hit_rate
+        lines.append("%-28s %8i %10.4f %10.4f %12i %8s" % (
+            stage_stats.name, stage_stats.calls, stage_stats.total_time,
+            stage_stats.self_time, stage_stats.bytes_allocated,
+            '-' if hit_rate is None else "%.1f%%" % (100*hit_rate)))
+    return "\n".join(lines)
+
+def export_metrics(sink, stats=None, prefix='pyDNAbinding.'):
+    """Send every statistic to sink(metric_name, value).
+
+    Metric names are PREFIX + STAGE_NAME + '.' + STATISTIC, e.g.
+    pyDNAbinding.encode.total_time
+    """
+    if stats is None:
+        stats = get_stats()
+    for name, stage_stats in sorted(stats.iteritems()):
+        for key, value in sorted(stage_stats.as_dict().iteritems()):
+            if value is None: continue
+            sink(prefix + name + '.' + key, value)
+    return
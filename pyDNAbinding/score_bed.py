@@ -0,0 +1,405 @@
+"""Score the regions in a BED file with a set of binding models.
+
+The regions are read, scored and written in fixed size chunks, so memory use
+doesn't depend on the number of regions, and the output is always in the
+order of the BED file (and then the order of the models). After every chunk
+a checkpoint is saved, so re-running an interrupted command resumes after
+the last finished chunk.
+
+Output formats:
+tsv.gz: one line per (region, model) with the region, the model ids and the
+        aggregated scores (see aggregation.RegionScoreAggregator)
+npz   : a directory with one chunk_NNNNNN.npz file per chunk containing the
+        regions and a (num_regions, num_models, num_stats) score array
+
+Example:
+
+score_binding_sites_from_bed peaks.bed --genome hg19.genome.fa \\
+    --models models.yaml --output scores.tsv.gz
+"""
+import os
+import sys
+import gzip
+import json
+import argparse
+import itertools
+import collections
+import multiprocessing
+
+import numpy as np
+
+from binding_model import FixedLengthDNASequences, load_binding_models
+from model_library import BindingModelLibrary, is_binding_model_library
+from aggregation import (
+    RegionScoreAggregator, AGGREGATION_STATS, DEFAULT_STATS,
+    DEFAULT_QUANTILES )
+
+DEFAULT_CHUNK_SIZE = 10000
+OUTPUT_FORMATS = ('tsv.gz', 'npz')
+
+################################################################################
+# Genome access
+
+class IndexedFastaFile(object):
+    """Random access to the sequences in a FASTA file.
+
+    This is used when pysam isn't installed. The file is indexed with its
+    .fai index (see samtools faidx) if it exists, and otherwise by scanning
+    the file once. references and lengths match pysam.FastaFile.
+    """
+    @property
+    def references(self):
+        return list(self._index)
+
+    @property
+    def lengths(self):
+        return [x[0] for x in self._index.itervalues()]
+
+    def _build_index(self):
+        index = collections.OrderedDict()
+        with open(self.fname) as fp:
+            name, offset, length, line_bases, line_len = None, 0, 0, 0, 0
+            while True:
+                line = fp.readline()
+                if line == '' or line.startswith('>'):
+                    if name is not None:
+                        index[name] = (length, offset, line_bases, line_len)
+                    if line == '': break
+                    name = line[1:].split()[0]
+                    offset, length, line_bases = fp.tell(), 0, 0
+                    continue
+                if line_bases == 0:
+                    line_bases, line_len = len(line.rstrip()), len(line)
+                length += len(line.rstrip())
+        return index
+
+    def _load_index(self):
+        index = collections.OrderedDict()
+        with open(self.fname + '.fai') as fp:
+            for line in fp:
+                name, length, offset, line_bases, line_len = line.split()[:5]
+                index[name] = (int(length), int(offset),
+                               int(line_bases), int(line_len))
+        return index
+
+    def fetch(self, contig, start, stop):
+        """Return the sequence in [start, stop) of contig.
+
+        """
+        length, offset, line_bases, line_len = self._index[contig]
+        start, stop = max(0, start), min(length, stop)
+        if stop <= start: return ''
+        first_line, last_line = start//line_bases, (stop-1)//line_bases
+        self._fp.seek(offset + first_line*line_len)
+        data = self._fp.read((last_line - first_line + 1)*line_len)
+        seq = data.replace('\n', '').replace('\r', '')
+        return seq[start - first_line*line_bases:stop - first_line*line_bases]
+
+    def close(self):
+        self._fp.close()
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._index = ( self._load_index()
+                        if os.path.exists(fname + '.fai')
+                        else self._build_index() )
+        self._fp = open(fname)
+
+def open_genome(fname):
+    try:
+        import pysam
+    except ImportError:
+        return IndexedFastaFile(fname)
+    return pysam.FastaFile(fname)
+
+################################################################################
+# Scoring
+
+def load_models(fname):
+    if is_binding_model_library(fname):
+        return list(BindingModelLibrary(fname))
+    return list(load_binding_models(fname))
+
+def iter_regions(fname):
+    with open(fname) as fp:
+        for line in fp:
+            if line.startswith(('#', 'track', 'browser')) or line.strip() == '':
+                continue
+            data = line.split()
+            yield (data[0], int(data[1]), int(data[2]))
+    return
+
+def iter_region_chunks(fname, chunk_size):
+    regions = iter_regions(fname)
+    while True:
+        chunk = list(itertools.islice(regions, chunk_size))
+        if len(chunk) == 0: break
+        yield chunk
+    return
+
+def score_regions(genome, regions, models, aggregator):
+    """Score every region with every model.
+
+    The regions are grouped by length, and each group is scored and
+    aggregated in a single pass (see
+    FixedLengthDNASequences.aggregate_models_binding_sites).
+
+    Returns a (num_regions, num_models, num_stats) array of aggregated
+    scores. The scores of models that are longer than a region are NaN.
+    """
+    seqs = [genome.fetch(contig, start, stop).upper()
+            for contig, start, stop in regions]
+    rv = np.full(
+        (len(regions), len(models), aggregator.num_stats), np.nan,
+        dtype='float32')
+    seq_indices = {}
+    for seq_index, seq in enumerate(seqs):
+        seq_indices.setdefault(len(seq), []).append(seq_index)
+    model_indices = {}
+    for model_index, model in enumerate(models):
+        model_indices.setdefault(model.encoding_type, []).append(model_index)
+    for seq_len, group_seq_indices in sorted(seq_indices.iteritems()):
+        if seq_len == 0: continue
+        group_seqs = FixedLengthDNASequences(
+            [seqs[i] for i in group_seq_indices])
+        for encoding_type, group_model_indices in sorted(
+                model_indices.iteritems()):
+            group_model_indices = [i for i in group_model_indices
+                                   if models[i].motif_len <= seq_len]
+            if len(group_model_indices) == 0: continue
+            scores = group_seqs.aggregate_models_binding_sites(
+                [models[i] for i in group_model_indices], aggregator, 'MAX')
+            rv[np.ix_(group_seq_indices, group_model_indices)] = \
+                scores.transpose(1, 0, 2)
+    return rv
+
+# the genome, models and aggregator used by the worker processes
+_worker_genome = None
+_worker_models = None
+_worker_aggregator = None
+
+def _init_worker(genome_fname, models_fname, aggregator):
+    global _worker_genome, _worker_models, _worker_aggregator
+    _worker_genome = open_genome(genome_fname)
+    _worker_models = load_models(models_fname)
+    _worker_aggregator = aggregator
+
+def _score_chunk_worker(regions):
+    return regions, score_regions(
+        _worker_genome, regions, _worker_models, _worker_aggregator)
+
+def iter_pool_results(pool, func, items, max_pending):
+    """Yield func(item) for every item, in order, from the pool's workers.
+
+    At most max_pending items are submitted ahead of the results that have
+    been consumed, so (unlike Pool.imap) the items are read lazily and memory
+    use doesn't grow with the number of items.
+    """
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
+    return
+
+################################################################################
+# Output
+
+def format_tsv_lines(regions, models, scores, genome_name):
+    lines = []
+    for region, region_scores in zip(regions, scores):
+        for model, model_scores in zip(models, region_scores):
+            lines.append("\t".join(
+                [str(x) for x in region]
+                + [str(getattr(model, key, 'NA'))
+                   for key in ('tf_name', 'tf_id', 'motif_id')]
+                + [genome_name,]
+                + ["%.5e" % x for x in model_scores]))
+    return "".join(line + "\n" for line in lines)
+
+class ScoresWriter(object):
+    """Write the chunk scores, and checkpoint after every chunk.
+
+    The checkpoint stores the number of finished chunks and, for tsv.gz, the
+    size of the output file - on resume the file is truncated to this size,
+    which drops any partially written chunk. Each chunk is written as a
+    separate gzip member, so the resumed file is still a valid gzip file.
+    """
+    @property
+    def checkpoint_fname(self):
+        return self.output_fname.rstrip('/') + '.checkpoint'
+
+    def _save_checkpoint(self, num_chunks, output_size):
+        tmp_fname = self.checkpoint_fname + '.tmp'
+        with open(tmp_fname, 'w') as ofp:
+            json.dump({'config': self.config,
+                       'num_chunks': num_chunks,
+                       'output_size': output_size}, ofp)
+        os.rename(tmp_fname, self.checkpoint_fname)
+
+    def _load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_fname):
+            return None
+        with open(self.checkpoint_fname) as fp:
+            checkpoint = json.load(fp)
+        if checkpoint['config'] != self.config:
+            raise ValueError, "The checkpoint '%s' is for a different set of arguments - remove it to start over" % (
+                self.checkpoint_fname)
+        return checkpoint
+
+    def write_chunk(self, regions, scores):
+        if self.output_format == 'tsv.gz':
+            with open(self.output_fname, 'ab') as ofp:
+                with gzip.GzipFile(fileobj=ofp, mode='wb') as gz_ofp:
+                    gz_ofp.write(format_tsv_lines(
+                        regions, self.models, scores, self.genome_name))
+            output_size = os.path.getsize(self.output_fname)
+        else:
+            chunk_fname = os.path.join(
+                self.output_fname, 'chunk_%06i.npz' % self.num_chunks)
+            # np.savez adds the .npz suffix to the tmp file name
+            tmp_fname = chunk_fname + '.tmp'
+            np.savez(tmp_fname,
+                     contigs=np.array([x[0] for x in regions]),
+                     starts=np.array([x[1] for x in regions]),
+                     stops=np.array([x[2] for x in regions]),
+                     scores=scores)
+            os.rename(tmp_fname + '.npz', chunk_fname)
+            output_size = None
+        self.num_chunks += 1
+        self._save_checkpoint(self.num_chunks, output_size)
+
+    def finish(self):
+        if self.output_format == 'npz':
+            with open(os.path.join(self.output_fname, 'models.json'), 'w') as ofp:
+                json.dump({'motif_ids': [str(getattr(mo, 'motif_id', 'NA'))
+                                         for mo in self.models],
+                           'stats': self.stat_names}, ofp, indent=2)
+        os.unlink(self.checkpoint_fname)
+
+    def __init__(self, output_fname, output_format, models, genome_name,
+                 stat_names, config):
+        assert output_format in OUTPUT_FORMATS
+        self.output_fname = output_fname
+        self.output_format = output_format
+        self.models = models
+        self.genome_name = genome_name
+        self.stat_names = stat_names
+        self.config = config
+        self.num_chunks = 0
+
+        checkpoint = self._load_checkpoint()
+        output_size = None
+        if checkpoint is not None:
+            self.num_chunks = checkpoint['num_chunks']
+            output_size = checkpoint['output_size']
+        if output_format == 'tsv.gz':
+            # drop everything after the last finished chunk
+            if output_size is None:
+                output_size = 0
+            if os.path.exists(output_fname):
+                with open(output_fname, 'r+b') as ofp:
+                    ofp.truncate(output_size)
+        elif not os.path.exists(output_fname):
+            os.makedirs(output_fname)
+        self._save_checkpoint(self.num_chunks, output_size)
+
+################################################################################
+# Command line interface
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Score the regions in a BED file with binding models.')
+    parser.add_argument('regions', help='BED file of regions to score')
+    parser.add_argument('--genome', required=True,
+        help='FASTA file of the genome')
+    parser.add_argument('--genome-name',
+        help='genome name for the output (default: the FASTA file name)')
+    parser.add_argument('--models',
+        help='YAML or binding model library file of models (default: load the models from the DB)')
+    parser.add_argument('--output', required=True,
+        help='output file (tsv.gz) or directory (npz)')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS,
+        default='tsv.gz')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+        help='number of regions to score at a time')
+    parser.add_argument('--processes', type=int, default=1,
+        help='number of chunks to score in parallel')
+    parser.add_argument('--stats', nargs='+', choices=AGGREGATION_STATS,
+        default=DEFAULT_STATS,
+        help='statistics to aggregate the region scores into (default: %s)'
+             % " ".join(DEFAULT_STATS))
+    parser.add_argument('--top-k', type=int, default=5,
+        help='number of binding sites to average for top_k_mean')
+    parser.add_argument('--threshold', type=float, default=0.0,
+        help='score threshold for count_above')
+    parser.add_argument('--quantiles', type=float, nargs='+',
+        default=DEFAULT_QUANTILES)
+    parser.add_argument('--quantile-window', type=int, default=1,
+        help='take the max score over windows of this many positions before computing quantiles')
+    args = parser.parse_args(argv)
+    if args.processes > 1 and args.models is None:
+        # the worker processes load the models from the models file
+        parser.error("--processes requires --models")
+    return args
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    if args.models is None:
+        from DB import load_binding_models_from_db
+        models = load_binding_models_from_db()
+    else:
+        models = load_models(args.models)
+    genome_name = args.genome_name
+    if genome_name is None:
+        genome_name = os.path.basename(args.genome).split('.')[0]
+    aggregator = RegionScoreAggregator(
+        args.stats, args.top_k, args.threshold, args.quantiles,
+        args.quantile_window)
+    config = {'regions': os.path.abspath(args.regions),
+              'genome': os.path.abspath(args.genome),
+              'models': (None if args.models is None
+                         else os.path.abspath(args.models)),
+              'output_format': args.output_format,
+              'chunk_size': args.chunk_size,
+              'stats': aggregator.stat_names,
+              'top_k': aggregator.top_k,
+              'threshold': aggregator.threshold,
+              'quantiles': list(aggregator.quantiles),
+              'quantile_window': aggregator.quantile_window}
+    writer = ScoresWriter(
+        args.output, args.output_format, models, genome_name,
+        aggregator.stat_names, config)
+
+    chunks = itertools.islice(
+        iter_region_chunks(args.regions, args.chunk_size),
+        writer.num_chunks, None)
+    if writer.num_chunks > 0:
+        print >> sys.stderr, "Resuming after chunk %i" % writer.num_chunks
+    if args.processes > 1:
+        pool = multiprocessing.Pool(
+            args.processes, _init_worker,
+            (args.genome, args.models, aggregator))
+        # the results are returned in order, so the output is deterministic
+        results = iter_pool_results(
+            pool, _score_chunk_worker, chunks, 2*args.processes)
+    else:
+        genome = open_genome(args.genome)
+        pool = None
+        results = ((regions, score_regions(genome, regions, models, aggregator))
+                   for regions in chunks)
+    try:
+        for regions, scores in results:
+            writer.write_chunk(regions, scores)
+            print >> sys.stderr, "Finished chunk %i (%i regions)" % (
+                writer.num_chunks, len(regions))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    writer.finish()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
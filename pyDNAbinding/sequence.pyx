@@ -48,6 +48,13 @@ for character_code in range(256):
     for offset, value in enumerate(values):
         base_prbs[character_code*4 + offset] = value
 
+# the same lookup table as a (256, 4) numpy array, so that arrays of character 
+# codes can be encoded with a single take (ONE_HOT_ENCODING_TABLE[codes])
+ONE_HOT_ENCODING_TABLE = np.zeros((256, NUM_BASES), dtype=DTYPE)
+for character_code in range(256):
+    if chr(character_code) in encoding:
+        ONE_HOT_ENCODING_TABLE[character_code] = encoding[chr(character_code)]
+
 # END build lookup table
 ################################################################################
 
@@ -128,6 +135,143 @@ class OneHotCodedDNASeq(np.ndarray):
 def one_hot_encode_sequence(sequence):
     return one_hot_encode_sequences((sequence,))[0,].view(OneHotCodedDNASeq)
 
+################################################################################
+# Build 'base_codes' lookup table mapping DNA characters to integer base codes.
+# A, C, G and T (upper or lower case) map to 0, 1, 2 and 3 respectively, and
+# every other character maps to UNKNOWN_BASE_CODE. These are the codes that the
+# k-mer based encoders (e.g. the pentamer shape lookup) index with.
+
+DEF UNKNOWN_BASE_CODE = 4
+UNKNOWN_BASE = UNKNOWN_BASE_CODE
+
+cdef np.uint8_t *base_codes = [UNKNOWN_BASE_CODE]*256
+for code, base in enumerate('ACGT'):
+    base_codes[ord(base)] = code
+    base_codes[ord(base.lower())] = code
+
+# END build lookup table
+################################################################################
+
+@cython.boundscheck(False)
+cdef int code_encode_c_sequences(char** sequences,
+                                 int num_sequences,
+                                 int sequence_length,
+                                 np.uint8_t* coded_sequences):
+    cdef char* sequence
+    cdef char base
+    cdef int position, sequence_index
+    for sequence_index in range(num_sequences):
+        sequence = sequences[sequence_index]
+        for position in range(sequence_length):
+            base = sequence[position]
+            # if we reach a null, then we have exhausted this string
+            if base == 0: break
+            coded_sequences[sequence_index*sequence_length + position] = \
+                base_codes[<unsigned char> base]
+    return 0
+
+def code_encode_sequences(sequences):
+    """Encode sequences as a (num_seqs, max_seq_len) array of uint8 base codes.
+
+    Positions past the end of shorter sequences are set to UNKNOWN_BASE.
+    """
+    cdef char** c_sequences = NULL;
+    cdef int seq_length, num_seqs
+    cdef np.ndarray[np.uint8_t, ndim=2] coded_sequences
+
+    try:
+        num_seqs, seq_length = convert_py_string_to_c_string(
+            sequences, &c_sequences)
+        coded_sequences = np.empty((num_seqs, seq_length), dtype=np.uint8)
+        coded_sequences.fill(UNKNOWN_BASE_CODE)
+        code_encode_c_sequences(
+            c_sequences, num_seqs, seq_length,
+            <np.uint8_t*> coded_sequences.data)
+        return coded_sequences
+    finally:
+        free(c_sequences)
+
+def code_encode_sequence(sequence):
+    return code_encode_sequences((sequence,))[0,]
+
+################################################################################
+# Dinucleotide encoding
+#
+# Position i of a dinucleotide coded sequence is the joint distribution of the
+# base pair (i, i+1) - channel 4*a + b stores prb(base i = a)*prb(base i+1 = b),
+# where the base prbs are the one hot encoding above. The last position has no
+# following base, and so it's all zeros.
+
+DEF NUM_DINUCLEOTIDES = 16
+
+# the reverse complement of the pair in channel 4*a + b is the pair in channel
+# DINUCLEOTIDE_RC_CHANNEL_ORDER[4*a + b] = 4*(3-b) + (3-a)
+DINUCLEOTIDE_RC_CHANNEL_ORDER = tuple(
+    4*(3-(i%4)) + (3-(i//4)) for i in range(NUM_DINUCLEOTIDES))
+
+class DinucleotideCodedDNASeq(np.ndarray):
+    pass
+
+@cython.boundscheck(False)
+cdef int dinucleotide_encode_c_sequences(char** sequences,
+                                         int num_sequences,
+                                         int sequence_length,
+                                         DTYPE_t* coded_sequences):
+    cdef char* sequence
+    cdef DTYPE_t* left_prbs
+    cdef DTYPE_t* right_prbs
+    cdef DTYPE_t* coded_pair
+    cdef unsigned char left_base, right_base
+    cdef np.uint8_t left_code, right_code
+    cdef int position, sequence_index, i, j
+    for sequence_index in range(num_sequences):
+        sequence = sequences[sequence_index]
+        for position in range(sequence_length-1):
+            left_base = <unsigned char> sequence[position]
+            right_base = <unsigned char> sequence[position+1]
+            # if we reach a null, then we have exhausted this string
+            if left_base == 0 or right_base == 0: break
+            coded_pair = ( coded_sequences 
+                           + sequence_index*sequence_length*NUM_DINUCLEOTIDES
+                           + position*NUM_DINUCLEOTIDES )
+            left_code = base_codes[left_base]
+            right_code = base_codes[right_base]
+            if left_code != UNKNOWN_BASE_CODE and right_code != UNKNOWN_BASE_CODE:
+                # the common case - a single unambiguous pair
+                coded_pair[NUM_BASES*left_code + right_code] = 1
+                continue
+            left_prbs = base_prbs + left_base*NUM_BASES
+            right_prbs = base_prbs + right_base*NUM_BASES
+            for i in range(NUM_BASES):
+                for j in range(NUM_BASES):
+                    coded_pair[NUM_BASES*i + j] = left_prbs[i]*right_prbs[j]
+    return 0
+
+def dinucleotide_encode_sequences(sequences):
+    """Encode sequences as a (num_seqs, max_seq_len, 16) float32 array.
+
+    Positions past the end of shorter sequences are all zeros.
+    """
+    cdef char** c_sequences = NULL;
+    cdef int seq_length, num_seqs
+    cdef np.ndarray[DTYPE_t, ndim=3] coded_sequences
+
+    try:
+        num_seqs, seq_length = convert_py_string_to_c_string(
+            sequences, &c_sequences)
+        coded_sequences = np.zeros(
+            (num_seqs, seq_length, NUM_DINUCLEOTIDES), dtype=DTYPE)
+        dinucleotide_encode_c_sequences(
+            c_sequences, num_seqs, seq_length, 
+            <DTYPE_t*> coded_sequences.data)
+        return coded_sequences
+    finally:
+        free(c_sequences)
+
+def dinucleotide_encode_sequence(sequence):
+    return dinucleotide_encode_sequences((sequence,))[0,].view(
+        DinucleotideCodedDNASeq)
+
 def profile( seq_len, n_seq, n_test_iterations ):
     """Test the speed of the one-hot-encoding implementation.
 
@@ -144,8 +288,174 @@ def profile( seq_len, n_seq, n_test_iterations ):
     return 
 
 ################################################################################
+# Random and shuffled sequences
+#
+# These are built directly as uint8 base code arrays (see code_encode_sequences),
+# and only converted to strings by decode_coded_seqs. They take a seed or a 
+# np.random.RandomState, and use numpy's global random state when it's None.
+
+CODED_BASES = np.frombuffer(b'ACGTN', dtype='S1')
+DEF NUM_CODES = 5
+
+def _get_random_state(random_state):
+    if random_state is None:
+        return np.random.mtrand._rand
+    if isinstance(random_state, np.random.RandomState):
+        return random_state
+    return np.random.RandomState(random_state)
+
+def decode_coded_seqs(coded_seqs):
+    """Convert a (num_seqs, seq_len) array of base codes to a list of strings.
 
-import random
-def sample_random_seqs(n_sims, seq_len):
-    return ["".join(random.choice('ACGT') for j in xrange(seq_len))
-            for i in xrange(n_sims)]
+    """
+    coded_seqs = np.asarray(coded_seqs, dtype=np.uint8)
+    num_seqs, seq_len = coded_seqs.shape
+    if seq_len == 0:
+        return ['']*num_seqs
+    return CODED_BASES[coded_seqs].view('S%i' % seq_len).ravel().tolist()
+
+def sample_random_coded_seqs(num_seqs, seq_len, gc_content=0.5, 
+                             random_state=None):
+    """Sample (num_seqs, seq_len) uint8 base codes of iid random sequences.
+
+    G and C each have probability gc_content/2, and A and T 
+    (1-gc_content)/2.
+    """
+    random_state = _get_random_state(random_state)
+    at_prb = (1 - gc_content)/2.
+    cum_prbs = np.array(
+        [at_prb, 0.5, 0.5 + gc_content/2.], dtype='float64')
+    return np.searchsorted(
+        cum_prbs, random_state.random_sample((num_seqs, seq_len)), 
+        side='right').astype(np.uint8)
+
+def sample_random_seqs(n_sims, seq_len, gc_content=0.5, random_state=None):
+    return decode_coded_seqs(sample_random_coded_seqs(
+        n_sims, seq_len, gc_content, random_state))
+
+# the number of sequences shuffled with each block of random numbers
+DEF SHUFFLE_BLOCK_SIZE = 1024
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int _dinucleotide_shuffle_coded_seq(np.uint8_t[:] coded_seq,
+                                         double[:,:] keys,
+                                         np.int64_t[:] ordered_targets,
+                                         np.uint8_t[:] shuffled,
+                                         object random_state) except -1:
+    cdef int num_edges = coded_seq.shape[0] - 1
+    cdef int i, j, code, step
+    cdef np.uint8_t source, vertex, final_code = coded_seq[num_edges]
+    cdef np.int64_t tmp
+    cdef np.int64_t counts[NUM_CODES]
+    cdef np.int64_t starts[NUM_CODES]
+    cdef np.int64_t next_edge[NUM_CODES]
+    cdef np.int64_t last_edges[NUM_CODES]
+    cdef double best_keys[NUM_CODES]
+    cdef double[:] new_keys
+    cdef bint is_tree
+
+    for code in range(NUM_CODES):
+        counts[code] = 0
+    for i in range(num_edges):
+        counts[coded_seq[i]] += 1
+    starts[0] = 0
+    for code in range(1, NUM_CODES):
+        starts[code] = starts[code-1] + counts[code-1]
+
+    # pick a random last edge out of each base - the one with the largest key
+    # - until the last edges form a tree rooted at the final base
+    while True:
+        for code in range(NUM_CODES):
+            best_keys[code] = -1
+            last_edges[code] = -1
+        for i in range(num_edges):
+            if keys[0,i] > best_keys[coded_seq[i]]:
+                best_keys[coded_seq[i]] = keys[0,i]
+                last_edges[coded_seq[i]] = i
+        is_tree = True
+        for code in range(NUM_CODES):
+            vertex = code
+            for step in range(NUM_CODES):
+                if vertex == final_code or last_edges[vertex] == -1: break
+                vertex = coded_seq[last_edges[vertex]+1]
+            if vertex != final_code and last_edges[vertex] != -1:
+                is_tree = False
+        if is_tree: break
+        new_keys = random_state.random_sample(num_edges)
+        keys[0,:] = new_keys
+
+    # fill each base's edge block with the other edges, shuffle them (with
+    # Fisher-Yates), and then add the last edge at the end of the block
+    for code in range(NUM_CODES):
+        next_edge[code] = starts[code]
+    for i in range(num_edges):
+        source = coded_seq[i]
+        if i == last_edges[source] and source != final_code: continue
+        ordered_targets[next_edge[source]] = coded_seq[i+1]
+        next_edge[source] += 1
+    for code in range(NUM_CODES):
+        for i in range(next_edge[code] - starts[code] - 1, 0, -1):
+            j = <int> (keys[1,starts[code]+i]*(i+1))
+            tmp = ordered_targets[starts[code]+i]
+            ordered_targets[starts[code]+i] = ordered_targets[starts[code]+j]
+            ordered_targets[starts[code]+j] = tmp
+        if code != final_code and last_edges[code] != -1:
+            ordered_targets[next_edge[code]] = coded_seq[last_edges[code]+1]
+
+    # walk the edges
+    for code in range(NUM_CODES):
+        next_edge[code] = starts[code]
+    vertex = coded_seq[0]
+    shuffled[0] = vertex
+    for i in range(num_edges):
+        source = vertex
+        vertex = ordered_targets[next_edge[source]]
+        next_edge[source] += 1
+        shuffled[i+1] = vertex
+    return 0
+
+def dinucleotide_shuffle_coded_seqs(coded_seqs, random_state=None):
+    """Shuffle each row of coded_seqs, preserving its dinucleotide counts.
+
+    Input: a (num_seqs, seq_len) array of base codes (unknown bases are 
+    shuffled like a fifth base). The first and last bases are preserved.
+
+    This is the Altschul-Erickson algorithm, as described by Kandel et al.
+    A shuffle is an Eulerian walk over the dinucleotide edges of the 
+    sequence. We pick a random last edge out of each base, and keep the
+    choice when the last edges form a tree rooted at the final base (which
+    guarantees that the walk uses every edge). The other edges out of each
+    base are visited in random order.
+    """
+    random_state = _get_random_state(random_state)
+    coded_seqs = np.ascontiguousarray(coded_seqs, dtype=np.uint8)
+    num_seqs, seq_len = coded_seqs.shape
+    if seq_len < 3:
+        return coded_seqs.copy()
+    if coded_seqs.max() >= NUM_CODES:
+        raise ValueError, "Invalid base code"
+    shuffled = np.empty((num_seqs, seq_len), dtype=np.uint8)
+    ordered_targets = np.empty(seq_len-1, dtype=np.int64)
+    for block_start in range(0, num_seqs, SHUFFLE_BLOCK_SIZE):
+        block_stop = min(num_seqs, block_start + SHUFFLE_BLOCK_SIZE)
+        keys = random_state.random_sample(
+            (block_stop - block_start, 2, seq_len-1))
+        for i in range(block_start, block_stop):
+            _dinucleotide_shuffle_coded_seq(
+                coded_seqs[i], keys[i-block_start], ordered_targets, 
+                shuffled[i], random_state)
+    return shuffled
+
+def dinucleotide_shuffle_seqs(seqs, random_state=None):
+    """Return dinucleotide preserving shuffles of the sequence strings seqs.
+
+    Unknown characters are shuffled as N's.
+    """
+    random_state = _get_random_state(random_state)
+    rv = []
+    for seq in seqs:
+        rv.extend(decode_coded_seqs(dinucleotide_shuffle_coded_seqs(
+            code_encode_sequences((seq,)), random_state)))
+    return rv
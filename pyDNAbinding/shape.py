@@ -0,0 +1,176 @@
+"""Encode DNA sequences with one-hot plus DNA shape features.
+
+Shape features are looked up by the pentamer centered on each base (the
+DNAshape approach). The 6 shape channels are, in order:
+
+ProT, MGW, LHelT, RHelT, LRoll, RRoll
+
+HelT and Roll are base step features - the L (R) channel stores the value
+for the step between a base and its 5' (3') neighbor.
+
+The lookup table is a (1024, 6) float32 array indexed by the pentamer code
+sum(base_code[i]*4**(4-i)), with A, C, G, T coded 0, 1, 2, 3.
+"""
+import os
+
+import numpy as np
+
+from sequence import (
+    one_hot_encode_sequences, code_encode_sequences, UNKNOWN_BASE )
+import profiling
+
+SHAPE_FEATURES = ('ProT', 'MGW', 'LHelT', 'RHelT', 'LRoll', 'RRoll')
+NUM_SHAPE_FEATURES = len(SHAPE_FEATURES)
+SHAPE_KMER_LEN = 5
+NUM_PENTAMERS = 4**SHAPE_KMER_LEN
+
+# the reverse complement strand swaps the left and right base step features
+RC_SHAPE_FEATURE_ORDER = (0, 1, 3, 2, 5, 4)
+
+SHAPE_TABLE_ENV_VARIABLE = 'PYDNABINDING_SHAPE_TABLE'
+_default_shape_table = None
+
+class OneHotPlusShapeCodedDNASeq(np.ndarray):
+    pass
+
+def pentamer_index(pentamer):
+    """Return the row of the shape table that stores pentamer's features.
+
+    """
+    assert len(pentamer) == SHAPE_KMER_LEN
+    index = 0
+    for base in pentamer.upper():
+        index = 4*index + 'ACGT'.index(base)
+    return index
+
+def build_shape_table(pentamer_shapes):
+    """Build a shape lookup table from a dictionary of pentamer shapes.
+
+    Input:
+    pentamer_shapes: dict mapping each of the 1024 pentamers to its
+                     NUM_SHAPE_FEATURES shape values
+
+    Returns: (1024, NUM_SHAPE_FEATURES) float32 array
+    """
+    shape_table = np.empty((NUM_PENTAMERS, NUM_SHAPE_FEATURES), dtype='float32')
+    observed = np.zeros(NUM_PENTAMERS, dtype=bool)
+    for pentamer, values in pentamer_shapes.iteritems():
+        if len(values) != NUM_SHAPE_FEATURES:
+            raise ValueError, "Expected %i shape features for '%s', found %i" % (
+                NUM_SHAPE_FEATURES, pentamer, len(values))
+        index = pentamer_index(pentamer)
+        shape_table[index,:] = values
+        observed[index] = True
+    if not observed.all():
+        raise ValueError, "Missing shape features for %i pentamers" % (
+            NUM_PENTAMERS - observed.sum())
+    return shape_table
+
+def load_shape_table(fname):
+    """Load a shape lookup table from a whitespace delimited text file.
+
+    Each non-comment line contains a pentamer followed by its ProT, MGW,
+    LHelT, RHelT, LRoll and RRoll values.
+    """
+    pentamer_shapes = {}
+    with open(fname) as fp:
+        for line in fp:
+            line = line.strip()
+            if line == '' or line.startswith('#'): continue
+            data = line.split()
+            pentamer_shapes[data[0]] = [float(x) for x in data[1:]]
+    return build_shape_table(pentamer_shapes)
+
+def set_default_shape_table(shape_table):
+    """Set the shape table used when one isn't explicitly passed.
+
+    shape_table can be a (1024, NUM_SHAPE_FEATURES) array or a filename to
+    load it from.
+    """
+    global _default_shape_table
+    if isinstance(shape_table, str):
+        shape_table = load_shape_table(shape_table)
+    shape_table = np.asarray(shape_table, dtype='float32')
+    assert shape_table.shape == (NUM_PENTAMERS, NUM_SHAPE_FEATURES)
+    _default_shape_table = shape_table
+    return
+
+def get_shape_table(shape_table=None):
+    """Return shape_table, falling back to the default shape table.
+
+    The default table is loaded from the file named by the
+    PYDNABINDING_SHAPE_TABLE environment variable the first time it's needed.
+    """
+    if shape_table is not None:
+        return shape_table
+    if (_default_shape_table is None
+            and SHAPE_TABLE_ENV_VARIABLE in os.environ):
+        set_default_shape_table(os.environ[SHAPE_TABLE_ENV_VARIABLE])
+    if _default_shape_table is None:
+        raise ValueError, \
+            "No shape table has been loaded - call set_default_shape_table or set %s" \
+                % SHAPE_TABLE_ENV_VARIABLE
+    return _default_shape_table
+
+def shape_encode_coded_seqs(coded_seqs, shape_table=None, out=None):
+    """Look up the shape features for an array of base coded sequences.
+
+    The first and last 2 bases of each sequence, and bases whose pentamer
+    contains an unknown base, don't have a defined shape and are set to the
+    mean of the shape table.
+
+    Input:
+    coded_seqs: (num_seqs, seq_len) uint8 array of base codes
+    out: optional (num_seqs, seq_len, NUM_SHAPE_FEATURES) array to store the
+         features in (e.g. a slice of a one-hot plus shape encoded array)
+
+    Returns: (num_seqs, seq_len, NUM_SHAPE_FEATURES) float32 array
+    """
+    with profiling.stage('encode.shape'):
+        return _shape_encode_coded_seqs(coded_seqs, shape_table, out)
+
+def _shape_encode_coded_seqs(coded_seqs, shape_table, out):
+    shape_table = get_shape_table(shape_table)
+    num_seqs, seq_len = coded_seqs.shape
+    if out is None:
+        out = np.empty(
+            (num_seqs, seq_len, NUM_SHAPE_FEATURES), dtype='float32')
+    out[...] = shape_table.mean(0)
+    n_pentamers = seq_len - SHAPE_KMER_LEN + 1
+    if n_pentamers <= 0:
+        return out
+
+    # build the pentamer index of every position in one pass per offset
+    indices = np.zeros((num_seqs, n_pentamers), dtype=np.int32)
+    is_known = np.ones((num_seqs, n_pentamers), dtype=bool)
+    for offset in xrange(SHAPE_KMER_LEN):
+        codes = coded_seqs[:,offset:offset+n_pentamers]
+        indices *= 4
+        indices += codes & 3
+        is_known &= (codes != UNKNOWN_BASE)
+
+    flank = SHAPE_KMER_LEN//2
+    out[:,flank:flank+n_pentamers][is_known] = shape_table[indices[is_known]]
+    return out
+
+def one_hot_plus_shape_encode_sequences(sequences, shape_table=None):
+    """Encode sequences with 4 one-hot channels followed by 6 shape channels.
+
+    Returns: (num_seqs, seq_len, 10) float32 array
+    """
+    shape_table = get_shape_table(shape_table)
+    sequences = list(sequences)
+    one_hot_coded_seqs = one_hot_encode_sequences(sequences)
+    num_seqs, seq_len, num_bases = one_hot_coded_seqs.shape
+    encoded_seqs = np.empty(
+        (num_seqs, seq_len, num_bases + NUM_SHAPE_FEATURES), dtype='float32')
+    encoded_seqs[:,:,:num_bases] = one_hot_coded_seqs
+    shape_encode_coded_seqs(
+        code_encode_sequences(sequences),
+        shape_table,
+        out=encoded_seqs[:,:,num_bases:])
+    return encoded_seqs
+
+def one_hot_plus_shape_encode_sequence(sequence, shape_table=None):
+    return one_hot_plus_shape_encode_sequences(
+        (sequence,), shape_table)[0,].view(OneHotPlusShapeCodedDNASeq)
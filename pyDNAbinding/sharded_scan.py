@@ -0,0 +1,410 @@
+"""Scan whole genomes with a model library, sharded across workers and nodes.
+
+A scan directory (on storage that every node can see) holds:
+
+manifest.json: the scan arguments, the contigs and the work units. A unit is
+               a (contig chunk, model block) pair - the binding sites that
+               start in [start, stop) of the contig, scored with the models
+               [model_start, model_stop) of the model file
+queue.sqlite : the state of every unit. Workers claim units with a lease,
+               renew the lease while they score, and mark the unit done
+               once its output is in place. A unit whose lease expires (the
+               worker crashed, or its node went down) is claimed again by
+               the next worker that asks for work
+units/       : one unit_NNNNNN.npy (num_block_models, stop-start) float32
+               array of MAX binding site scores per finished unit. Units are
+               written to a temporary file and renamed, so a unit file is
+               always complete
+tracks/      : after the merge, one CONTIG.npy (num_models, contig_len)
+               array per contig, and models.json with the model ids. Binding
+               sites that run off the end of the contig are NaN
+
+SQLite relies on the file system's locks - use a file system with working
+POSIX locks (eg. not an NFS mount with locking disabled).
+
+Example:
+
+scan_genome_sharded init scan/ --genome hg19.genome.fa --models models.yaml
+scan_genome_sharded worker scan/ # on every node, as many times as needed
+scan_genome_sharded merge scan/
+"""
+import os
+import sys
+import time
+import json
+import socket
+import sqlite3
+import argparse
+
+import numpy as np
+
+from score_bed import open_genome, load_models
+import profiling
+
+DEFAULT_SCAN_CHUNK_SIZE = 1000000
+DEFAULT_MODEL_BLOCK_SIZE = 32
+DEFAULT_LEASE_SECONDS = 600
+DEFAULT_POLL_SECONDS = 10
+DEFAULT_MAX_ATTEMPTS = 3
+
+################################################################################
+# Manifest
+
+def manifest_fname(scan_dir):
+    return os.path.join(scan_dir, 'manifest.json')
+
+def unit_fname(scan_dir, unit_id):
+    return os.path.join(scan_dir, 'units', 'unit_%06i.npy' % unit_id)
+
+def build_units(contigs, num_models, chunk_size, model_block_size):
+    """Return the (contig, start, stop, model_start, model_stop) work units.
+
+    contigs is a list of (name, length) pairs.
+    """
+    units = []
+    for contig, contig_len in contigs:
+        for start in xrange(0, contig_len, chunk_size):
+            stop = min(start + chunk_size, contig_len)
+            for model_start in xrange(0, num_models, model_block_size):
+                units.append((contig, start, stop, model_start,
+                              min(model_start + model_block_size, num_models)))
+    return units
+
+def init_scan(scan_dir, genome_fname, models_fname,
+              chunk_size=DEFAULT_SCAN_CHUNK_SIZE,
+              model_block_size=DEFAULT_MODEL_BLOCK_SIZE):
+    """Write the manifest and the work queue of a new scan.
+
+    Initializing an existing scan with the same arguments does nothing.
+    """
+    config = {'genome': os.path.abspath(genome_fname),
+              'models': os.path.abspath(models_fname),
+              'chunk_size': chunk_size,
+              'model_block_size': model_block_size}
+    if os.path.exists(manifest_fname(scan_dir)):
+        if load_manifest(scan_dir)['config'] != config:
+            raise ValueError, "The scan in '%s' was started with different arguments - remove it to start over" % scan_dir
+        return
+    genome = open_genome(genome_fname)
+    contigs = zip(genome.references, genome.lengths)
+    models = load_models(models_fname)
+    units = build_units(contigs, len(models), chunk_size, model_block_size)
+    for dirname in (scan_dir, os.path.join(scan_dir, 'units')):
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+    queue = WorkQueue(scan_dir)
+    queue.add_units(len(units))
+    queue.close()
+    # the manifest is written last, so that it marks a finished init
+    # (the temporary file name is unique, so concurrent inits don't collide)
+    tmp_fname = "%s.%s.tmp" % (
+        manifest_fname(scan_dir), default_worker_id().replace('/', '_'))
+    with open(tmp_fname, 'w') as ofp:
+        json.dump({'config': config,
+                   'contigs': contigs,
+                   'motif_ids': [str(getattr(mo, 'motif_id', 'NA'))
+                                 for mo in models],
+                   'max_motif_len': max(mo.motif_len for mo in models),
+                   'units': units}, ofp)
+    os.rename(tmp_fname, manifest_fname(scan_dir))
+
+def load_manifest(scan_dir):
+    with open(manifest_fname(scan_dir)) as fp:
+        return json.load(fp)
+
+################################################################################
+# Work queue
+
+class WorkQueue(object):
+    """The lease based queue of the scan units, stored in queue.sqlite.
+
+    Every method is a single transaction, so any number of processes on any
+    number of nodes can share the queue.
+    """
+    def _execute(self, query, args=()):
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = self._conn.execute(query, args)
+            rv = cursor.fetchall(), cursor.rowcount
+        except:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+        return rv
+
+    def add_units(self, num_units):
+        """Add units 0 to num_units-1 to the queue.
+
+        Units that are already in the queue are left as they are, so an
+        interrupted (or concurrent) init can be re-run.
+        """
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO units (unit_id) VALUES (?)",
+                ((i,) for i in xrange(num_units)))
+        except:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+
+    def claim(self, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """Lease the next unit to worker_id.
+
+        Returns the unit id, or None if there isn't a unit to claim.
+        """
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            row = self._conn.execute(
+                """SELECT unit_id FROM units
+                   WHERE status = 'pending'
+                      OR (status = 'running' AND lease_expires < ?
+                          AND attempts < ?)
+                   ORDER BY unit_id LIMIT 1""",
+                (now, self.max_attempts)).fetchone()
+            if row is not None:
+                self._conn.execute(
+                    """UPDATE units SET status = 'running', worker = ?,
+                       lease_expires = ?, attempts = attempts + 1
+                       WHERE unit_id = ?""",
+                    (worker_id, now + lease_seconds, row[0]))
+        except:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+        return None if row is None else row[0]
+
+    def renew(self, unit_id, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """Extend worker_id's lease on unit_id.
+
+        Returns False if the lease was lost (it expired and another worker
+        claimed the unit, or the unit is done).
+        """
+        return self._execute(
+            """UPDATE units SET lease_expires = ?
+               WHERE unit_id = ? AND worker = ? AND status = 'running'""",
+            (time.time() + lease_seconds, unit_id, worker_id))[1] == 1
+
+    def finish(self, unit_id):
+        self._execute(
+            "UPDATE units SET status = 'done' WHERE unit_id = ?", (unit_id,))
+
+    def num_remaining(self):
+        """The number of units that aren't done and may still be finished.
+
+        """
+        return self._execute(
+            """SELECT COUNT(*) FROM units
+               WHERE status != 'done'
+                 AND (attempts < ? OR lease_expires >= ?)""",
+            (self.max_attempts, time.time()))[0][0][0]
+
+    def status(self):
+        """Return the number of pending, running, done and failed units.
+
+        A unit failed if its lease expired max_attempts times.
+        """
+        rows = self._execute(
+            """SELECT status, attempts >= ? AND lease_expires < ?, COUNT(*)
+               FROM units GROUP BY 1, 2""",
+            (self.max_attempts, time.time()))[0]
+        rv = dict.fromkeys(('pending', 'running', 'done', 'failed'), 0)
+        for status, is_failed, count in rows:
+            if status == 'running' and is_failed:
+                status = 'failed'
+            rv[status] += count
+        return rv
+
+    def attempts(self, unit_id):
+        return self._execute(
+            "SELECT attempts FROM units WHERE unit_id = ?", (unit_id,))[0][0][0]
+
+    def close(self):
+        self._conn.close()
+
+    def __init__(self, scan_dir, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 timeout=60.0):
+        self.max_attempts = max_attempts
+        # isolation_level=None turns off the implicit transactions, so that
+        # the claims can take the write lock before they read
+        self._conn = sqlite3.connect(
+            os.path.join(scan_dir, 'queue.sqlite'), timeout=timeout,
+            isolation_level=None)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS units (
+                   unit_id INTEGER PRIMARY KEY,
+                   status TEXT NOT NULL DEFAULT 'pending',
+                   worker TEXT,
+                   lease_expires REAL NOT NULL DEFAULT 0,
+                   attempts INTEGER NOT NULL DEFAULT 0 )""")
+
+################################################################################
+# Workers
+
+def score_unit(genome, models, unit, max_motif_len, out, renew_lease=None):
+    """Write the MAX binding site scores of unit to out.
+
+    renew_lease is called after every model, and the scoring stops early if
+    it returns False. Returns False if the scoring stopped early.
+    """
+    contig, start, stop, model_start, model_stop = unit
+    seq = genome.fetch(contig, start, stop + max_motif_len - 1).upper()
+    for i, model in enumerate(models[model_start:model_stop]):
+        out[i] = np.nan
+        if len(seq) >= model.motif_len:
+            scores = model.score_binding_sites(seq, 'MAX')
+            num_sites = min(stop - start, len(scores))
+            out[i,:num_sites] = scores[:num_sites]
+        if renew_lease is not None and not renew_lease():
+            return False
+    return True
+
+def default_worker_id():
+    return "%s:%i" % (socket.gethostname(), os.getpid())
+
+def run_worker(scan_dir, worker_id=None, lease_seconds=DEFAULT_LEASE_SECONDS,
+               poll_seconds=DEFAULT_POLL_SECONDS,
+               max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Claim and score units until every unit is finished.
+
+    While other workers hold leases the worker keeps polling, so that it
+    picks up the units of workers that crash. Returns the number of units
+    this worker finished.
+    """
+    if worker_id is None:
+        worker_id = default_worker_id()
+    manifest = load_manifest(scan_dir)
+    genome = open_genome(manifest['config']['genome'])
+    models = load_models(manifest['config']['models'])
+    queue = WorkQueue(scan_dir, max_attempts)
+    num_finished = 0
+    try:
+        while True:
+            unit_id = queue.claim(worker_id, lease_seconds)
+            if unit_id is None:
+                if queue.num_remaining() == 0: break
+                time.sleep(poll_seconds)
+                continue
+            unit = manifest['units'][unit_id]
+            fname = unit_fname(scan_dir, unit_id)
+            tmp_fname = "%s.%s.tmp" % (fname, worker_id.replace('/', '_'))
+            out = np.lib.format.open_memmap(
+                tmp_fname, mode='w+', dtype='float32',
+                shape=(unit[4] - unit[3], unit[2] - unit[1]))
+            with profiling.stage('scan') as stage:
+                is_finished = score_unit(
+                    genome, models, unit, manifest['max_motif_len'], out,
+                    lambda: queue.renew(unit_id, worker_id, lease_seconds))
+                stage.add_array(out)
+            out.flush()
+            del out
+            if not is_finished:
+                # another worker took over the unit
+                os.unlink(tmp_fname)
+                continue
+            os.rename(tmp_fname, fname)
+            queue.finish(unit_id)
+            num_finished += 1
+    finally:
+        queue.close()
+    return num_finished
+
+################################################################################
+# Merge
+
+def merge_scan(scan_dir):
+    """Assemble the unit scores into per contig tracks.
+
+    Returns the name of the tracks directory.
+    """
+    manifest = load_manifest(scan_dir)
+    queue = WorkQueue(scan_dir)
+    status = queue.status()
+    queue.close()
+    if status['done'] != len(manifest['units']):
+        raise ValueError, "The scan in '%s' isn't finished (%i of %i units are done)" % (
+            scan_dir, status['done'], len(manifest['units']))
+    tracks_dir = os.path.join(scan_dir, 'tracks')
+    if not os.path.exists(tracks_dir):
+        os.makedirs(tracks_dir)
+    num_models = len(manifest['motif_ids'])
+    units_by_contig = {}
+    for unit_id, unit in enumerate(manifest['units']):
+        units_by_contig.setdefault(unit[0], []).append(unit_id)
+    for contig, contig_len in manifest['contigs']:
+        fname = os.path.join(tracks_dir, contig + '.npy')
+        track = np.lib.format.open_memmap(
+            fname + '.tmp', mode='w+', dtype='float32',
+            shape=(num_models, contig_len))
+        for unit_id in units_by_contig.get(contig, []):
+            start, stop, model_start, model_stop = \
+                manifest['units'][unit_id][1:]
+            track[model_start:model_stop, start:stop] = np.load(
+                unit_fname(scan_dir, unit_id), mmap_mode='r')
+        track.flush()
+        del track
+        os.rename(fname + '.tmp', fname)
+    with open(os.path.join(tracks_dir, 'models.json'), 'w') as ofp:
+        json.dump({'motif_ids': manifest['motif_ids']}, ofp, indent=2)
+    return tracks_dir
+
+def load_track(scan_dir, contig):
+    return np.load(
+        os.path.join(scan_dir, 'tracks', contig + '.npy'), mmap_mode='r')
+
+################################################################################
+# Command line interface
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Scan a genome with binding models, sharded across workers.')
+    subparsers = parser.add_subparsers(dest='command')
+    init_parser = subparsers.add_parser(
+        'init', help='write the manifest and work queue of a scan')
+    init_parser.add_argument('scan_dir')
+    init_parser.add_argument('--genome', required=True,
+        help='FASTA file of the genome')
+    init_parser.add_argument('--models', required=True,
+        help='YAML or binding model library file of models')
+    init_parser.add_argument('--chunk-size', type=int,
+        default=DEFAULT_SCAN_CHUNK_SIZE,
+        help='number of bases per work unit')
+    init_parser.add_argument('--model-block-size', type=int,
+        default=DEFAULT_MODEL_BLOCK_SIZE,
+        help='number of models per work unit')
+    worker_parser = subparsers.add_parser(
+        'worker', help='score units until the scan is finished')
+    worker_parser.add_argument('scan_dir')
+    worker_parser.add_argument('--lease-seconds', type=float,
+        default=DEFAULT_LEASE_SECONDS,
+        help='seconds after the last lease renewal before a unit is handed to another worker')
+    worker_parser.add_argument('--poll-seconds', type=float,
+        default=DEFAULT_POLL_SECONDS)
+    worker_parser.add_argument('--max-attempts', type=int,
+        default=DEFAULT_MAX_ATTEMPTS,
+        help='number of expired leases before a unit is given up on')
+    for command in ('merge', 'status'):
+        subparsers.add_parser(command).add_argument('scan_dir')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    if args.command == 'init':
+        init_scan(args.scan_dir, args.genome, args.models, args.chunk_size,
+                  args.model_block_size)
+    elif args.command == 'worker':
+        num_finished = run_worker(
+            args.scan_dir, lease_seconds=args.lease_seconds,
+            poll_seconds=args.poll_seconds, max_attempts=args.max_attempts)
+        print >> sys.stderr, "Finished %i units" % num_finished
+    elif args.command == 'merge':
+        merge_scan(args.scan_dir)
+    else:
+        queue = WorkQueue(args.scan_dir)
+        print " ".join("%s=%i" % x for x in sorted(queue.status().items()))
+        queue.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,18 @@
+import os
 import math
+import json
 
 import numpy as np
-from numpy.fft import rfftn, irfftn
+from numpy.fft import rfftn, irfftn, rfft, irfft
+from numpy.lib.stride_tricks import as_strided
+
+import profiling
 
 OVERLAP_ADD_BLOCK_POWER = 10
+# the number of overlap-save blocks that are transformed together
+OVERLAP_SAVE_BATCH_SIZE = 64
+# only used when there is no convolve strategy table (see 
+# choose_convolve_strategy)
 USE_OVERLAP_ADD_MIN_LENGTH = 8192
 
 def _next_regular(target):
@@ -66,7 +75,70 @@ def next_good_fshape(x):
 def _transformed_fft_convolve(freq_h, freq_x):
     return irfftn(freq_x*freq_h)
 
-def multichannel_fftconvolve(x, h, mode='valid'):
+class ScoringWorkspace(object):
+    """Reusable scratch buffers for the convolution and scoring functions.
+
+    Scoring allocates temporary arrays (e.g. the reverse complement strand
+    scores and the frequency domain products) on every call. Passing the
+    same workspace to repeated calls - e.g. in a service that scores many
+    batches with the same configuration - reuses these buffers instead. 
+    The workspace is preallocated for scoring batch_size sequences of 
+    seq_len bases with filters of filter_len positions, and buffers grow
+    when a call needs more. numpy's fft functions always allocate their
+    results, so only the buffers around the transforms are reused.
+
+    A workspace must not be shared between threads, and arrays returned
+    by buffer() are only valid until the next call that uses the workspace.
+    """
+    @property
+    def nbytes(self):
+        return sum(buf.nbytes for buf in self._buffers.itervalues())
+
+    def buffer(self, name, shape, dtype='float64'):
+        """Return an uninitialized array of the given shape backed by the named buffer.
+
+        """
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape))*dtype.itemsize
+        buf = self._buffers.get(name)
+        profiling.record_cache_lookup(
+            'workspace', buf is not None and len(buf) >= nbytes)
+        if buf is None or len(buf) < nbytes:
+            buf = np.empty(nbytes, dtype='uint8')
+            self._buffers[name] = buf
+        return buf[:nbytes].view(dtype).reshape(shape)
+
+    def __init__(self, seq_len, filter_len, num_channels=4, batch_size=1):
+        self._buffers = {}
+        num_sites = max(1, seq_len - filter_len + 1)
+        # the second strand's scores (see score_coded_seq_with_convolutional_filter)
+        self.buffer('scores', (batch_size, num_sites))
+        self.buffer('direct.product', (num_sites,))
+        num_freqs = _overlap_save_block_len(filter_len)//2 + 1
+        self.buffer('product', (OVERLAP_SAVE_BATCH_SIZE, num_freqs, num_channels),
+                    dtype='complex128')
+        self.buffer('product_sum', (OVERLAP_SAVE_BATCH_SIZE, num_freqs),
+                    dtype='complex128')
+
+def _multiply_sum_channels(X, H, workspace=None):
+    """Return (X*H).sum(-1), using the workspace buffers if provided.
+
+    """
+    if workspace is None:
+        return (X*H).sum(-1)
+    shape = np.broadcast(X, H).shape
+    dtype = np.result_type(X.dtype, H.dtype)
+    product = np.multiply(X, H, out=workspace.buffer('product', shape, dtype))
+    return product.sum(
+        -1, out=workspace.buffer('product_sum', shape[:-1], dtype))
+
+def _copy_to_out(rv, out):
+    if out is None:
+        return rv
+    out[...] = rv
+    return out
+
+def multichannel_fftconvolve(x, h, mode='valid', out=None):
     x_len = x.shape[0]
     num_channels = h.shape[1]
     h_len = h.shape[0]
@@ -76,11 +148,13 @@ def multichannel_fftconvolve(x, h, mode='valid'):
 
     assert mode == 'valid'
     fshape = (int(2**math.ceil(np.log2((x_len + h_len - 1)))), num_channels)
-    x_fft = rfftn(x, fshape)
-    h_fft = rfftn(h, fshape)
-    ret = _transformed_fft_convolve(x_fft, h_fft)
+    with profiling.stage('signal.transform') as stage:
+        x_fft = rfftn(x, fshape)
+        h_fft = rfftn(h, fshape)
+        ret = _transformed_fft_convolve(x_fft, h_fft)
+        stage.add_bytes(x_fft.nbytes + h_fft.nbytes + ret.nbytes)
     
-    return ret[h_len-1:x_len, num_channels-1]
+    return _copy_to_out(ret[h_len-1:x_len, num_channels-1], out)
 
 def multichannel_overlap_add_fftconvolve(x, h, mode='valid'):
     """Given a signal x compute the convolution with h using the overlap-add algorithm.
@@ -114,14 +188,17 @@ def multichannel_overlap_add_fftconvolve(x, h, mode='valid'):
     N = int(2**math.ceil(np.log2(block_size+h_len-1)))
     step_size = N-h_len+1
     
-    H = rfftn(h,(N,num_channels))
     n_blocks = int(math.ceil(float(len(x))/step_size))
-    y = np.zeros((n_blocks+1)*step_size)
-    for block_index in xrange(n_blocks):
-        start = block_index*step_size
-        yt = irfftn( rfftn(x[start:start+step_size,:],(N, num_channels))*H, 
-                     (N, num_channels) )
-        y[start:start+N] += yt[:,num_channels-1]
+    with profiling.stage('signal.transform') as stage:
+        H = rfftn(h,(N,num_channels))
+        y = np.zeros((n_blocks+1)*step_size)
+        stage.add_bytes(H.nbytes + y.nbytes)
+        for block_index in xrange(n_blocks):
+            start = block_index*step_size
+            yt = irfftn( 
+                rfftn(x[start:start+step_size,:],(N, num_channels))*H, 
+                (N, num_channels) )
+            y[start:start+N] += yt[:,num_channels-1]
 
     #y = y[h_len:2*h_len+x_len-1]
     if mode == 'full':
@@ -131,13 +208,254 @@ def multichannel_overlap_add_fftconvolve(x, h, mode='valid'):
     elif mode == 'same':
         raise NotImplementedError, "'same' mode is not implemented"
 
-def multichannel_convolve(x, h, mode='valid'):
+def _overlap_save_block_len(h_len):
+    block_size = max(2**OVERLAP_ADD_BLOCK_POWER, h_len)
+    return int(2**math.ceil(np.log2(block_size+h_len-1)))
+
+def multichannel_overlap_save_max_convolve(x, hs, out=None, workspace=None):
+    """Convolve x with every filter in hs, and return the elementwise max.
+
+    This uses the overlap-save algorithm: x is split into overlapping blocks,
+    and the part of each block's circular convolution that doesn't wrap
+    around is written directly into the output. Every block is transformed
+    once and shared by all of the filters (e.g. the forward and reverse
+    complement filters of a model), and the blocks are read through a 
+    strided view of x, so the output is the only array as long as the signal.
+
+    Input:
+    x  : float array with dimensions (N, num_channel)
+    hs : list of float arrays with dimensions (filter_len, num_channel)
+    out: optional float array of length N-filter_len+1 to write the result to
+    workspace: optional ScoringWorkspace for the block products
+
+    Returns:
+    float array of length N-filter_len+1 (valid mode)
+    """
+    x_len, num_channels = x.shape
+    h_len = hs[0].shape[0]
+    assert all(h.shape == (h_len, num_channels) for h in hs)
+    assert x_len >= h_len, \
+        "The signal needs to be at least as long as the filter"
+    n_out = x_len - h_len + 1
+    if out is None:
+        out = np.empty(
+            n_out, dtype=np.result_type(x.dtype, hs[0].dtype, np.float64))
+    assert out.shape == (n_out,)
+
+    N = _overlap_save_block_len(h_len)
+    step_size = N-h_len+1
+    n_blocks = int(math.ceil(float(n_out)/step_size))
+    # block i is x[i*step_size:i*step_size+N] - the blocks that run off the
+    # end of x are zero padded by rfft
+    n_full_blocks = max(0, (x_len - N)//step_size + 1)
+    full_blocks = as_strided(
+        x, shape=(n_full_blocks, N, num_channels),
+        strides=(step_size*x.strides[0], x.strides[0], x.strides[1]))
+    with profiling.stage('signal.transform') as stage:
+        # channel c of the signal is paired with channel num_channels-c-1 of
+        # the filter (see multichannel_fftconvolve)
+        Hs = [rfft(h[:,::-1], N, axis=0) for h in hs]
+        stage.add_array(out)
+        start = 0
+        while start < n_blocks:
+            if start < n_full_blocks:
+                stop = min(start + OVERLAP_SAVE_BATCH_SIZE, n_full_blocks)
+                X = rfft(full_blocks[start:stop], N, axis=1)
+            else:
+                stop = start + 1
+                X = rfft(x[start*step_size:], N, axis=0)[None,:,:]
+            block_out = out[start*step_size:stop*step_size]
+            for i, H in enumerate(Hs):
+                y = irfft(_multiply_sum_channels(X, H[None,:,:], workspace),
+                          N, axis=1)[:,h_len-1:]
+                y = y.ravel()[:len(block_out)]
+                if i == 0:
+                    block_out[:] = y
+                else:
+                    np.maximum(block_out, y, block_out)
+            start = stop
+    return out
+
+def multichannel_overlap_save_convolve(
+        x, h, mode='valid', out=None, workspace=None):
+    """Calculate the convolution of x and h with the overlap-save algorithm.
+
+    This has the same semantics as multichannel_overlap_add_fftconvolve.
+    """
+    assert mode == 'valid'
+    return multichannel_overlap_save_max_convolve(x, [h,], out, workspace)
+
+def multichannel_direct_convolve(x, h, mode='valid', out=None, workspace=None):
+    """Calculate the convolution of x and h directly (without an fft).
+
+    This has the same semantics as multichannel_fftconvolve, and is fastest
+    for short signals and filters.
+    """
+    assert mode == 'valid'
+    x_len = x.shape[0]
+    h_len, num_channels = h.shape
+    assert x.shape[1] == num_channels
+    assert x_len >= h_len, \
+        "The signal needs to be at least as long as the filter"
+    # convolving with h is the same as correlating with h flipped along 
+    # both axes
+    g = h[::-1,::-1]
+    n_out = x_len - h_len + 1
+    with profiling.stage('signal.direct') as stage:
+        if out is None:
+            rv = np.zeros(
+                n_out, dtype=np.result_type(x.dtype, h.dtype, np.float64))
+            stage.add_array(rv)
+        else:
+            rv = out
+            rv.fill(0)
+        product = None
+        if workspace is not None:
+            product = workspace.buffer(
+                'direct.product', (n_out,), np.result_type(x.dtype, g.dtype))
+        for offset in xrange(h_len):
+            rv += np.dot(x[offset:offset+n_out], g[offset], out=product)
+    return rv
+
+def multichannel_batch_convolve(xs, h, mode='valid', out=None, workspace=None):
+    """Convolve every signal in a batch with h.
+
+    This has the same semantics as multichannel_fftconvolve, but performs
+    a single fft over the whole batch.
+
+    Input:
+    xs: float array with dimensions (num_signals, N, num_channel)
+    h: float array with dimensions (filter_len, num_channel)
+
+    Returns:
+    float array with dimensions (num_signals, N-filter_len+1)
+    """
+    assert mode == 'valid'
+    x_len = xs.shape[1]
+    h_len, num_channels = h.shape
+    assert xs.shape[2] == num_channels
+    assert x_len >= h_len, \
+        "The signal needs to be at least as long as the filter"
+    # the circular convolution of length >= x_len only wraps the first 
+    # h_len-1 entries, which aren't part of the valid output
+    n = next_good_fshape(x_len)
+    with profiling.stage('signal.transform') as stage:
+        xs_fft = rfft(xs, n, axis=1)
+        h_fft = rfft(h, n, axis=0)
+        # channel c of the signal is paired with channel num_channels-c-1 of
+        # the filter (see multichannel_fftconvolve)
+        freq = _multiply_sum_channels(
+            xs_fft[:,:,::-1], h_fft[None,:,:], workspace)
+        rv = irfft(freq, n, axis=1)[:,h_len-1:x_len]
+        stage.add_bytes(xs_fft.nbytes + h_fft.nbytes + freq.nbytes + rv.nbytes)
+    return _copy_to_out(rv, out)
+
+################################################################################
+# Convolve strategy selection
+#
+# The fastest convolution algorithm depends on the signal length, filter
+# length, batch size and the machine. pyDNAbinding.tuning times each 
+# strategy over a grid of these values and saves a table with the fastest 
+# strategy at each grid point. All of the scoring functions choose their
+# algorithm from this table, falling back to fixed rules when it doesn't exist.
+
+class ConvolveStrategy():
+    __slots__ = ['DIRECT', 'FFT', 'OVERLAP_ADD', 'BATCH']
+    DIRECT = 'DIRECT'
+    FFT = 'FFT'
+    OVERLAP_ADD = 'OVERLAP_ADD'
+    BATCH = 'BATCH'
+
+CONVOLVE_STRATEGY_TABLE_ENV_VARIABLE = 'PYDNABINDING_CONVOLVE_STRATEGY_TABLE'
+DEFAULT_CONVOLVE_STRATEGY_TABLE_FNAME = os.path.join(
+    os.path.expanduser('~'), '.cache', 'pyDNAbinding', 
+    'convolve_strategies.json')
+# use the batched fft when the batch has at most this many entries (only
+# used when there is no convolve strategy table)
+MAX_DEFAULT_BATCH_CONVOLVE_SIZE = 2**22
+
+_convolve_strategy_table = None
+_convolve_strategy_table_loaded = False
+
+def convolve_strategy_table_fname():
+    return os.environ.get(
+        CONVOLVE_STRATEGY_TABLE_ENV_VARIABLE, 
+        DEFAULT_CONVOLVE_STRATEGY_TABLE_FNAME)
+
+def set_convolve_strategy_table(table):
+    """Use table to choose convolution strategies.
+
+    table is a dict with keys 'seq_lens', 'filter_lens', 'batch_sizes' (the
+    grid) and 'strategies' - a nested list indexed by [batch size index]
+    [seq len index][filter len index]. If table is None the default rules
+    are used.
+    """
+    global _convolve_strategy_table, _convolve_strategy_table_loaded
+    if table is not None:
+        table = dict(table)
+        for key in ('seq_lens', 'filter_lens', 'batch_sizes'):
+            table[key] = np.log(np.array(table[key], dtype=float))
+        table['strategies'] = np.array(table['strategies'], dtype=str)
+    _convolve_strategy_table = table
+    _convolve_strategy_table_loaded = True
+    return
+
+def load_convolve_strategy_table(fname=None):
+    """Load the convolve strategy table written by pyDNAbinding.tuning.
+
+    If fname is None, load it from the default location (if it exists).
+    """
+    if fname is None:
+        fname = convolve_strategy_table_fname()
+        if not os.path.exists(fname):
+            set_convolve_strategy_table(None)
+            return
+    with open(fname) as fp:
+        set_convolve_strategy_table(json.load(fp))
+    return
+
+def _closest_grid_index(log_grid, value):
+    return int(np.abs(log_grid - math.log(max(value, 1))).argmin())
+
+def choose_convolve_strategy(seq_len, filter_len, batch_size=1):
+    """Return the fastest ConvolveStrategy for the given problem size.
+
+    """
+    with profiling.stage('signal.plan'):
+        return _choose_convolve_strategy(seq_len, filter_len, batch_size)
+
+def _choose_convolve_strategy(seq_len, filter_len, batch_size):
+    if not _convolve_strategy_table_loaded:
+        load_convolve_strategy_table()
+    table = _convolve_strategy_table
+    profiling.record_cache_lookup('signal.plan', table is not None)
+    if table is None:
+        if batch_size > 1 and (
+                batch_size*seq_len < MAX_DEFAULT_BATCH_CONVOLVE_SIZE
+                and seq_len < USE_OVERLAP_ADD_MIN_LENGTH):
+            return ConvolveStrategy.BATCH
+        if seq_len < USE_OVERLAP_ADD_MIN_LENGTH:
+            return ConvolveStrategy.FFT
+        return ConvolveStrategy.OVERLAP_ADD
+    return str(table['strategies'][
+        _closest_grid_index(table['batch_sizes'], batch_size),
+        _closest_grid_index(table['seq_lens'], seq_len),
+        _closest_grid_index(table['filter_lens'], filter_len)
+    ])
+
+def multichannel_convolve(x, h, mode='valid', out=None, workspace=None):
     """Calcualte the convolution between a signal and filter.
 
+    The algorithm is chosen with choose_convolve_strategy. The result is 
+    written to out if it's provided, and the temporary arrays are taken from
+    workspace (a ScoringWorkspace) if it's provided.
     """
     if mode != 'valid':
         raise NotImplementedError, "'%s' mode is not implemented" % mode
-    if x.shape[0] < USE_OVERLAP_ADD_MIN_LENGTH:
-        return multichannel_fftconvolve(x, h, mode)
+    strategy = choose_convolve_strategy(x.shape[0], h.shape[0])
+    if strategy == ConvolveStrategy.DIRECT:
+        return multichannel_direct_convolve(x, h, mode, out, workspace)
+    elif strategy == ConvolveStrategy.OVERLAP_ADD:
+        return multichannel_overlap_save_convolve(x, h, mode, out, workspace)
     else:
-        return multichannel_overlap_add_fftconvolve(x, h, mode)
+        return multichannel_fftconvolve(x, h, mode, out)
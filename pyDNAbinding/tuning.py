@@ -0,0 +1,138 @@
+"""Calibrate the convolution strategy table for the local machine.
+
+Times the direct, full fft, overlap-add and batched convolution strategies
+over a grid of (batch size, sequence length, filter length) values, and
+saves the fastest strategy at each grid point. The scoring functions load
+the table from signal.convolve_strategy_table_fname() (which can be set
+with the PYDNABINDING_CONVOLVE_STRATEGY_TABLE environment variable).
+
+To calibrate the local machine run:
+
+python -m pyDNAbinding.tuning
+"""
+import os
+import sys
+import json
+import argparse
+
+from collections import OrderedDict
+
+import numpy as np
+
+from signal import (
+    multichannel_direct_convolve, multichannel_fftconvolve,
+    multichannel_overlap_save_convolve, multichannel_batch_convolve,
+    ConvolveStrategy, set_convolve_strategy_table,
+    convolve_strategy_table_fname )
+from sequence import one_hot_encode_sequences
+from benchmark import time_benchmark, build_random_seqs
+
+DEFAULT_SEQ_LENS = (50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000,
+                    100000, 1000000)
+DEFAULT_FILTER_LENS = (6, 12, 20, 30)
+DEFAULT_BATCH_SIZES = (1, 10, 100, 1000)
+# skip the batched strategy when the batch has more than this many bases
+MAX_BATCH_BASES = 2**23
+MIN_TIME = 0.01
+
+SINGLE_SEQ_STRATEGIES = OrderedDict([
+    (ConvolveStrategy.DIRECT, multichannel_direct_convolve),
+    (ConvolveStrategy.FFT, multichannel_fftconvolve),
+    (ConvolveStrategy.OVERLAP_ADD, multichannel_overlap_save_convolve)
+])
+
+def time_strategies(seq_len, filter_len, batch_size, min_time=MIN_TIME):
+    """Return a dict mapping each strategy to the time to score the batch.
+
+    """
+    x = one_hot_encode_sequences(build_random_seqs(1, seq_len))[0]
+    h = np.random.RandomState(0).randn(filter_len, 4)
+    timings = OrderedDict()
+    for strategy, convolve in SINGLE_SEQ_STRATEGIES.iteritems():
+        # the sequences are scored one at a time, so just scale the time
+        timings[strategy] = batch_size*time_benchmark(
+            lambda: convolve(x, h), repeat=3, min_time=min_time)[0]
+    if batch_size > 1 and batch_size*seq_len <= MAX_BATCH_BASES:
+        xs = np.repeat(x[None,:,:], batch_size, axis=0)
+        timings[ConvolveStrategy.BATCH] = time_benchmark(
+            lambda: multichannel_batch_convolve(xs, h),
+            repeat=3, min_time=min_time)[0]
+    return timings
+
+def calibrate_convolve_strategies(seq_lens=DEFAULT_SEQ_LENS,
+                                  filter_lens=DEFAULT_FILTER_LENS,
+                                  batch_sizes=DEFAULT_BATCH_SIZES,
+                                  min_time=MIN_TIME,
+                                  verbose=False):
+    """Build the convolve strategy table for this machine.
+
+    Returns the table as a dict (see signal.set_convolve_strategy_table).
+    """
+    strategies = []
+    timings = []
+    for batch_size in batch_sizes:
+        strategies.append([])
+        timings.append([])
+        for seq_len in seq_lens:
+            strategies[-1].append([])
+            timings[-1].append([])
+            for filter_len in filter_lens:
+                if filter_len > seq_len:
+                    # these can't be scored, so we just need a place holder
+                    strategies[-1][-1].append(ConvolveStrategy.DIRECT)
+                    timings[-1][-1].append(None)
+                    continue
+                point_timings = time_strategies(
+                    seq_len, filter_len, batch_size, min_time)
+                best = min(point_timings, key=point_timings.get)
+                strategies[-1][-1].append(best)
+                timings[-1][-1].append(point_timings)
+                if verbose:
+                    print >> sys.stderr, "%6i %8i %4i %-12s %s" % (
+                        batch_size, seq_len, filter_len, best,
+                        " ".join("%s:%.2e" % x
+                                 for x in point_timings.iteritems()))
+    return OrderedDict([
+        ('seq_lens', list(seq_lens)),
+        ('filter_lens', list(filter_lens)),
+        ('batch_sizes', list(batch_sizes)),
+        ('strategies', strategies),
+        ('timings', timings)
+    ])
+
+def save_convolve_strategy_table(table, fname=None):
+    if fname is None:
+        fname = convolve_strategy_table_fname()
+    dirname = os.path.dirname(os.path.abspath(fname))
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(fname, 'w') as ofp:
+        json.dump(table, ofp, indent=2)
+    return fname
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Calibrate the convolution strategy table.')
+    parser.add_argument('--output',
+        help='write the table here (default: %s)'
+             % convolve_strategy_table_fname())
+    parser.add_argument('--min-time', type=float, default=MIN_TIME,
+        help='minimum time (in seconds) to run each timing loop for')
+    parser.add_argument('--quick', action='store_true',
+        help='only calibrate sequences up to 10kb')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    seq_lens = DEFAULT_SEQ_LENS
+    if args.quick:
+        seq_lens = [x for x in seq_lens if x <= 10000]
+    table = calibrate_convolve_strategies(
+        seq_lens=seq_lens, min_time=args.min_time, verbose=True)
+    fname = save_convolve_strategy_table(table, args.output)
+    set_convolve_strategy_table(table)
+    print >> sys.stderr, "Saved the convolve strategy table to '%s'" % fname
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
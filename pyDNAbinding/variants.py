@@ -0,0 +1,237 @@
+"""Score the effect of sequence variants on binding.
+
+Only the binding sites that overlap a variant change, so rather than
+rescoring whole regions we build the local reference and alternate
+sequences (the alleles plus motif_len-1 bases of flanking sequence on
+each side), and score them in one batch.
+
+For single base substitutions we don't need to rescore at all - the models
+are linear in the one-hot encoding, so the change in a binding site's score
+is the difference between the filter entries of the two bases (see
+saturation_mutagenesis).
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from binding_model import (
+    FixedLengthDNASequences, EncodingType, ScoreDirection,
+    score_coded_seqs_with_convolutional_filter,
+    score_coded_seq_with_convolutional_filter,
+    reverse_complement_convolutional_filter )
+from sequence import one_hot_encode_sequence
+from shape import SHAPE_KMER_LEN
+from misc import calc_occ
+
+# seq_id is the key of the reference sequence (e.g. an index or name), pos is
+# the 0-based position of the first reference base
+Variant = namedtuple('Variant', ['seq_id', 'pos', 'ref', 'alt'])
+
+# (num_variants, num_models) arrays of the max score of the binding sites
+# overlapping the variant in the reference and alternate sequence, and the
+# alt - ref difference
+VariantScores = namedtuple(
+    'VariantScores', ['ref_scores', 'alt_scores', 'deltas'])
+
+def load_variants(fname):
+    """Load variants from a VCF-like file.
+
+    Each non-header line contains the sequence id, the 1-based position, an
+    id (ignored), the reference allele and a comma separated list of
+    alternate alleles. Every alternate allele becomes its own Variant.
+    """
+    variants = []
+    with open(fname) as fp:
+        for line in fp:
+            if line.startswith('#') or line.strip() == '': continue
+            data = line.split()
+            seq_id, pos, ref, alts = data[0], int(data[1])-1, data[3], data[4]
+            for alt in alts.split(','):
+                variants.append(Variant(seq_id, pos, ref.upper(), alt.upper()))
+    return variants
+
+def _shape_flank(models):
+    # shape features depend on the neighboring bases, so a variant changes the
+    # shape encoding of the bases within SHAPE_KMER_LEN//2 of it. We need
+    # twice that flank so the changed bases are encoded with their neighbors.
+    if any(model.encoding_type == EncodingType.ONE_HOT_PLUS_SHAPE
+           for model in models):
+        return SHAPE_KMER_LEN//2
+    return 0
+
+def build_variant_alleles(seqs, variants, flank_len):
+    """Build the local reference and alternate sequences of each variant.
+
+    Returns the list of local sequences (all of the reference alleles and
+    then all of the alternate alleles), the position of the variant in each
+    local sequence, and the length of the allele in each local sequence.
+    """
+    local_seqs, starts, allele_lens = [], [], []
+    alt_seqs, alt_starts, alt_lens = [], [], []
+    for variant in variants:
+        seq = str(seqs[variant.seq_id])
+        pos, ref, alt = variant.pos, variant.ref, variant.alt
+        if pos < 0 or seq[pos:pos+len(ref)].upper() != ref.upper():
+            raise ValueError, "Reference allele '%s' doesn't match the sequence at %s:%i" % (
+                ref, variant.seq_id, pos)
+        start = max(0, pos - flank_len)
+        stop = min(len(seq), pos + len(ref) + flank_len)
+        left, right = seq[start:pos], seq[pos+len(ref):stop]
+        local_seqs.append(left + ref + right)
+        starts.append(len(left))
+        allele_lens.append(len(ref))
+        alt_seqs.append(left + alt + right)
+        alt_starts.append(len(left))
+        alt_lens.append(len(alt))
+    return ( local_seqs + alt_seqs,
+             np.array(starts + alt_starts, dtype=int),
+             np.array(allele_lens + alt_lens, dtype=int) )
+
+def score_variants(seqs, variants, models, direction=ScoreDirection.MAX):
+    """Score the change in binding caused by each variant.
+
+    Input:
+    seqs     : the reference sequences, indexable by the variants' seq_id
+               (e.g. a list or dict of strings, or a DNASequences object)
+    variants : an iterable of Variant tuples
+    models   : an iterable of ConvolutionalDNABindingModels
+    direction: the direction to score the binding sites in
+
+    Only the binding sites that overlap a variant are scored, so the cost is
+    O(num_variants*motif_len) rather than the total sequence length. A
+    deletion (empty alternate allele) is overlapped by the binding sites
+    that span the junction.
+
+    Returns a VariantScores tuple of (num_variants, num_models) arrays. Scores
+    are -inf (and the deltas NaN) when the sequence is shorter than the motif.
+    """
+    variants = list(variants)
+    models = list(models)
+    num_variants = len(variants)
+    if len(models) == 0:
+        raise ValueError, "score_variants needs at least one model"
+    shape_flank = _shape_flank(models)
+    max_motif_len = max(model.motif_len for model in models)
+    local_seqs, starts, allele_lens = build_variant_alleles(
+        seqs, variants, max_motif_len - 1 + 2*shape_flank)
+    seq_lens = np.array([len(seq) for seq in local_seqs])
+    # pad the local sequences to the same length so that they can be scored
+    # as a batch - the padding is never part of a binding site that we keep
+    padded_len = max(seq_lens.max(), max_motif_len)
+    local_seqs = FixedLengthDNASequences(
+        [seq + 'N'*(padded_len-len(seq)) for seq in local_seqs])
+
+    scores = np.empty((2*num_variants, len(models)), dtype='float32')
+    for model_index, model in enumerate(models):
+        site_scores = score_coded_seqs_with_convolutional_filter(
+            local_seqs.get_coded_seqs(model.encoding_type),
+            model.convolutional_filter,
+            direction)
+        # the binding sites starting in [min_start, max_start] overlap the
+        # allele (and the shape features that the allele changes)
+        flank = (shape_flank if
+                 model.encoding_type == EncodingType.ONE_HOT_PLUS_SHAPE else 0)
+        min_start = starts - model.motif_len + 1 - flank
+        max_start = np.minimum(
+            starts + allele_lens - 1 + flank, seq_lens - model.motif_len)
+        site_starts = np.arange(site_scores.shape[1])
+        overlaps = ( (site_starts[None,:] >= min_start[:,None])
+                     & (site_starts[None,:] <= max_start[:,None]) )
+        site_scores[~overlaps] = -np.inf
+        scores[:,model_index] = site_scores.max(1)
+
+    ref_scores, alt_scores = scores[:num_variants], scores[num_variants:]
+    with np.errstate(invalid='ignore'):
+        deltas = alt_scores - ref_scores
+    return VariantScores(ref_scores, alt_scores, deltas)
+
+class MutagenesisStatistic():
+    __slots__ = ['MAX', 'OCCUPANCY']
+    MAX = 'MAX'
+    OCCUPANCY = 'OCCUPANCY'
+
+def _mutated_site_scores(coded_seq, filt):
+    """Return the scores of the binding sites overlapping every substitution.
+
+    Returns a (seq_len, 4, motif_len) array - entry (i, b, o) is the score of
+    the binding site starting at i-o after base i is mutated to b (-inf for
+    binding sites that run off the sequence) - the original scores of the
+    same binding sites as a (seq_len, motif_len) array, and the original
+    scores of every binding site.
+    """
+    seq_len, motif_len = len(coded_seq), filt.shape[0]
+    scores = score_coded_seq_with_convolutional_filter(
+        coded_seq, filt, ScoreDirection.FWD)
+    site_starts = np.arange(seq_len)[:,None] - np.arange(motif_len)[None,:]
+    is_valid = (site_starts >= 0) & (site_starts < len(scores))
+    site_scores = np.where(
+        is_valid, scores[np.clip(site_starts, 0, len(scores)-1)], -np.inf)
+    # the change in score from replacing base i with base b, when base i is
+    # at offset o of the binding site
+    ref_base_scores = np.dot(coded_seq, filt.T)
+    deltas = filt.T[None,:,:] - ref_base_scores[:,None,:]
+    return site_scores[:,None,:] + deltas, site_scores, scores
+
+def saturation_mutagenesis(seq, models, statistic=MutagenesisStatistic.MAX,
+                           chem_pot=None, direction=ScoreDirection.MAX):
+    """Compute the effect of every single base substitution in seq.
+
+    Input:
+    seq      : the DNA sequence string
+    models   : an iterable of one-hot ConvolutionalDNABindingModels
+    statistic: MAX - the change in the max binding site score
+               OCCUPANCY - the change in the expected number of bound sites,
+               sum(calc_occ(chem_pot, -score)) over all binding sites
+    chem_pot : the chemical potential (required for OCCUPANCY)
+    direction: the strands to consider (FWD, RC or MAX for both)
+
+    Returns a (seq_len, 4, num_models) float32 array, where entry (i, b, m)
+    is the change in the statistic for model m when base i is mutated to
+    'ACGT'[b] (0 when b is the reference base). Only the binding sites that
+    overlap each base are rescored, directly from the filter.
+    """
+    assert statistic in MutagenesisStatistic.__slots__
+    assert direction in ScoreDirection.__slots__
+    if statistic == MutagenesisStatistic.OCCUPANCY and chem_pot is None:
+        raise ValueError, "The chemical potential is required to compute occupancy changes"
+    models = list(models)
+    coded_seq = np.asarray(one_hot_encode_sequence(seq), dtype='float32')
+    seq_len = len(coded_seq)
+    rv = np.zeros((seq_len, 4, len(models)), dtype='float32')
+    for model_index, model in enumerate(models):
+        filt = np.asarray(model.convolutional_filter, dtype='float32')
+        if filt.shape[1] != 4:
+            raise TypeError, "Saturation mutagenesis requires one-hot (Nx4) filters"
+        if model.motif_len > seq_len: continue
+        filts = []
+        if direction in (ScoreDirection.FWD, ScoreDirection.MAX):
+            filts.append(filt)
+        if direction in (ScoreDirection.RC, ScoreDirection.MAX):
+            filts.append(reverse_complement_convolutional_filter(filt))
+        strand_scores = [_mutated_site_scores(coded_seq, x) for x in filts]
+
+        if statistic == MutagenesisStatistic.OCCUPANCY:
+            for mut_scores, site_scores, scores in strand_scores:
+                # invalid binding sites have -inf scores, and so 0 occupancy
+                with np.errstate(over='ignore'):
+                    rv[:,:,model_index] += (
+                        calc_occ(chem_pot, -mut_scores).sum(2)
+                        - calc_occ(chem_pot, -site_scores).sum(1)[:,None] )
+            continue
+
+        # the max over the binding sites that don't overlap base i doesn't
+        # change, so we combine the prefix and suffix maxes with the max
+        # over the mutated binding sites
+        scores = np.array([x[2] for x in strand_scores]).max(0)
+        num_sites = len(scores)
+        prefix_max = np.concatenate(([-np.inf], np.maximum.accumulate(scores)))
+        suffix_max = np.concatenate(
+            (np.maximum.accumulate(scores[::-1])[::-1], [-np.inf]))
+        positions = np.arange(seq_len)
+        unchanged_max = np.maximum(
+            prefix_max[np.clip(positions-model.motif_len+1, 0, num_sites)],
+            suffix_max[np.clip(positions+1, 0, num_sites)])
+        mutated_max = np.array([x[0].max(2) for x in strand_scores]).max(0)
+        rv[:,:,model_index] = (
+            np.maximum(unchanged_max[:,None], mutated_max) - scores.max())
+    return rv
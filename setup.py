@@ -39,6 +39,12 @@ config = {
     'setup_requires': [],
     'install_requires': [ 'scipy', 'numpy' ],
     'scripts': [],
+    'entry_points': {
+        'console_scripts': [
+            'score_binding_sites_from_bed = pyDNAbinding.score_bed:main',
+            'scan_genome_sharded = pyDNAbinding.sharded_scan:main',
+        ]
+    },
     'name': 'pyDNAbinding'
 }
 
@@ -0,0 +1,128 @@
+import os
+import json
+import shutil
+import sqlite3
+import tempfile
+
+import numpy as np
+
+from pyDNAbinding import DB
+
+sqlite3.register_converter("ARRAY", json.loads)
+
+def build_test_db(fname):
+    conn = sqlite3.connect(fname)
+    cur = conn.cursor()
+    cur.execute("""CREATE TABLE related_motifs_mv (
+        tf_id TEXT, motif_id TEXT, tf_name TEXT, tf_species TEXT, rank INT)""")
+    cur.execute("CREATE TABLE pwms (motif_id TEXT, pwm ARRAY)")
+    cur.execute("""CREATE TABLE best_selex_models (
+        tf_id TEXT, selex_motif_id INT, tf_name TEXT, tf_species TEXT,
+        consensus_energy REAL, ddg_array ARRAY)""")
+    for i, tf_name in enumerate(('CTCF', 'MAX', 'YY1')):
+        cur.execute(
+            "INSERT INTO related_motifs_mv VALUES (?, ?, ?, 'Homo_sapiens', 1)",
+            ('T%i' % i, 'M%i' % i, tf_name))
+        cur.execute("INSERT INTO pwms VALUES (?, ?)",
+                    ('M%i' % i, json.dumps([[0.25]*4]*(i+5))))
+    cur.execute("""INSERT INTO best_selex_models
+                   VALUES ('T0', 7, 'CTCF', 'Homo_sapiens', -1.5, ?)""",
+                (json.dumps(np.eye(4).tolist()),))
+    conn.commit()
+    conn.close()
+
+def connect_to_test_db(fname):
+    conn = sqlite3.connect(
+        fname, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+    conn.create_function('format', 2, lambda pattern, x: pattern % x)
+    return conn
+
+def test_cached_loaders(monkeypatch):
+    # configure_cache changes the module settings - restore them afterwards
+    monkeypatch.setattr(DB, 'CACHE_DIR', DB.CACHE_DIR)
+    monkeypatch.setattr(DB, 'CACHE_TTL', DB.CACHE_TTL)
+    tmp_dir = tempfile.mkdtemp()
+    db_fname = os.path.join(tmp_dir, 'cisbp.sqlite')
+    try:
+        build_test_db(db_fname)
+        DB.set_connection_factory(
+            lambda: connect_to_test_db(db_fname), paramstyle='qmark')
+        DB.configure_cache(cache_dir=os.path.join(tmp_dir, 'cache'))
+
+        models = DB.load_pwms_from_db(tf_names=['MAX', 'YY1'])
+        assert [m.motif_id for m in models] == ['M1', 'M2']
+        assert [m.motif_len for m in models] == [6, 7]
+        models = DB.load_binding_models_from_db()
+        assert [m.motif_id for m in models] == ['SELEX_7', 'M1', 'M2']
+
+        # once the results are cached, the DB is no longer needed
+        os.unlink(db_fname)
+        DB.clear_memory_cache()
+        DB.set_offline_mode(True)
+        models = DB.load_pwms_from_db(tf_names=['MAX', 'YY1'])
+        assert [m.motif_id for m in models] == ['M1', 'M2']
+        try:
+            DB.load_pwms_from_db(tf_names='CTCF')
+        except ValueError:
+            pass
+        else:
+            assert False, "Offline cache misses should raise a ValueError"
+
+        DB.invalidate_cache()
+        try:
+            DB.load_pwms_from_db(tf_names=['MAX', 'YY1'])
+        except ValueError:
+            pass
+        else:
+            assert False, "The cache should be empty"
+    finally:
+        DB.set_offline_mode(False)
+        DB.set_connection_factory(DB._psycopg2_connect)
+        DB.clear_memory_cache()
+        shutil.rmtree(tmp_dir)
+
+class MockConnection(object):
+    def rollback(self):
+        self.num_rollbacks += 1
+        if self.fail_rollback:
+            raise sqlite3.OperationalError("connection lost")
+
+    def close(self):
+        self.is_closed = True
+
+    def __init__(self):
+        self.fail_rollback = False
+        self.num_rollbacks = 0
+        self.is_closed = False
+
+def raise_in_db_connection():
+    try:
+        with DB.db_connection() as conn:
+            raise KeyError('query failed')
+    except KeyError:
+        pass
+    else:
+        assert False, "The exception should be re-raised"
+    return conn
+
+def test_db_connection_errors():
+    connections = []
+    def connection_factory():
+        connections.append(MockConnection())
+        return connections[-1]
+    DB.set_connection_factory(connection_factory)
+    try:
+        # the failed transaction is rolled back, and the connection reused
+        conn = raise_in_db_connection()
+        assert conn.num_rollbacks == 1 and not conn.is_closed
+        assert raise_in_db_connection() is conn
+        assert len(connections) == 1
+        # a connection that can't be rolled back is closed and discarded
+        conn.fail_rollback = True
+        assert raise_in_db_connection() is conn
+        assert conn.is_closed
+        with DB.db_connection() as new_conn:
+            assert new_conn is not conn
+        assert DB._get_pool()._size == 1
+    finally:
+        DB.set_connection_factory(DB._psycopg2_connect)
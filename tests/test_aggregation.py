@@ -0,0 +1,40 @@
+import numpy as np
+
+from pyDNAbinding.aggregation import RegionScoreAggregator
+from pyDNAbinding.binding_model import FixedLengthDNASequences
+from pyDNAbinding.benchmark import build_random_seqs, build_random_models
+
+ALL_STATS = ('max', 'mean', 'top_k_mean', 'count_above', 'log_sum_exp',
+             'quantiles')
+
+def test_aggregate():
+    scores = np.random.RandomState(0).randn(3, 4, 50).astype('float32')
+    aggregator = RegionScoreAggregator(
+        ALL_STATS, top_k=3, threshold=1.0, quantiles=(0.9, 0.5),
+        quantile_window=5, temperature=0.5)
+    assert aggregator.stat_names == [
+        'max', 'mean', 'top3_mean', 'count_above_1', 'log_sum_exp',
+        'q90', 'q50']
+    agg_scores = aggregator.aggregate(scores)
+    assert agg_scores.shape == (3, 4, 7)
+    x = scores[1,2]
+    expected = [
+        x.max(), x.mean(), np.sort(x)[-3:].mean(), (x > 1).sum(),
+        0.5*np.log(np.exp(x/0.5).sum()),
+        np.percentile(x.reshape(10, 5).max(1), 90),
+        np.percentile(x.reshape(10, 5).max(1), 50) ]
+    assert np.allclose(agg_scores[1,2], expected, atol=1e-4)
+
+def test_fused_aggregation():
+    seqs = FixedLengthDNASequences(build_random_seqs(9, 80))
+    models = build_random_models(2, 6) + build_random_models(2, 10, seed=1)
+    aggregator = RegionScoreAggregator(ALL_STATS)
+    # a small budget splits the sequences into blocks
+    agg_scores = seqs.aggregate_models_binding_sites(
+        models, aggregator, max_memory=5000)
+    assert agg_scores.shape == (4, 9, aggregator.num_stats)
+    for model_index, model in enumerate(models):
+        expected = aggregator.aggregate(seqs.score_binding_sites(model, 'MAX'))
+        assert np.allclose(agg_scores[model_index], expected, atol=1e-4)
+    assert seqs.aggregate_models_binding_sites([], aggregator).shape == (
+        0, 9, aggregator.num_stats)
@@ -0,0 +1,65 @@
+from collections import Counter
+
+import numpy as np
+
+from pyDNAbinding import background
+from pyDNAbinding.background import (
+    get_background_table, calc_gc_content, clear_background_cache )
+from pyDNAbinding.sequence import (
+    sample_random_coded_seqs, sample_random_seqs, decode_coded_seqs,
+    dinucleotide_shuffle_coded_seqs, dinucleotide_shuffle_seqs )
+from pyDNAbinding.benchmark import build_random_models
+
+def dinucleotide_counts(seq):
+    return Counter(seq[i:i+2] for i in xrange(len(seq)-1))
+
+def test_random_seqs():
+    coded_seqs = sample_random_coded_seqs(100, 1000, 0.7, random_state=0)
+    assert coded_seqs.dtype == np.uint8 and coded_seqs.shape == (100, 1000)
+    assert abs(((coded_seqs == 1) | (coded_seqs == 2)).mean() - 0.7) < 0.01
+    # seeded samples are reproducible
+    assert (sample_random_coded_seqs(100, 1000, 0.7, random_state=0)
+            == coded_seqs).all()
+    seqs = decode_coded_seqs(coded_seqs[:3])
+    assert [len(seq) for seq in seqs] == [1000]*3
+    assert seqs[0][:10] == "".join('ACGT'[x] for x in coded_seqs[0,:10])
+    assert sample_random_seqs(2, 5, random_state=1) == sample_random_seqs(
+        2, 5, random_state=1)
+
+def test_dinucleotide_shuffle():
+    random_state = np.random.RandomState(0)
+    for seq in ('ACGTTGCANNACGGGTTTAC', 'AAAAAAAAAC', 'ATGCGCGCGCATATATGGC'):
+        for shuffled in dinucleotide_shuffle_seqs([seq]*5, random_state):
+            assert dinucleotide_counts(shuffled) == dinucleotide_counts(seq)
+            assert shuffled[0] == seq[0] and shuffled[-1] == seq[-1]
+    coded_seqs = sample_random_coded_seqs(50, 200, random_state=random_state)
+    shuffled = dinucleotide_shuffle_coded_seqs(coded_seqs, random_state)
+    assert (shuffled != coded_seqs).mean() > 0.5
+    for seq, shuffled_seq in zip(coded_seqs, shuffled):
+        assert ( np.bincount(5*seq[:-1] + seq[1:], minlength=25)
+                 == np.bincount(5*shuffled_seq[:-1] + shuffled_seq[1:],
+                                minlength=25) ).all()
+
+def test_background_table(tmpdir, monkeypatch):
+    monkeypatch.setenv(background.BACKGROUND_CACHE_ENV_VARIABLE, str(tmpdir))
+    clear_background_cache()
+    model = build_random_models(1, 10)[0]
+    table = get_background_table(model, num_sites=10000)
+    assert get_background_table(model, num_sites=10000) is table
+    # the second lookup loads the table from disk
+    clear_background_cache()
+    loaded_table = get_background_table(model, num_sites=10000)
+    assert loaded_table is not table
+    assert (loaded_table.score_quantiles == table.score_quantiles).all()
+
+    # the p-values of fresh background scores are roughly uniform
+    gc_content = 0.61
+    seq = sample_random_seqs(1, 20000, gc_content, random_state=1)[0]
+    assert abs(calc_gc_content(seq) - gc_content) < 0.02
+    scores = model.score_binding_sites(seq, 'MAX')
+    pvalues = table.pvalues(scores, calc_gc_content(seq))
+    assert abs(pvalues.mean() - 0.5) < 0.05
+    assert abs((pvalues < 0.1).mean() - 0.1) < 0.02
+    assert abs(table.zscores(scores, gc_content).mean()) < 0.1
+    # p-values decrease with the score
+    assert (np.diff(table.pvalues(np.sort(scores), gc_content)) <= 0).all()
@@ -0,0 +1,12 @@
+from pyDNAbinding.benchmark import (
+    BENCHMARKS, run_benchmarks, find_regressions )
+
+def test_find_regressions():
+    baseline = {'a': {'time': 1.0}, 'b': {'time': 1.0}}
+    results = {'a': {'time': 1.1}, 'b': {'time': 1.5}, 'c': {'time': 9.0}}
+    assert find_regressions(results, baseline, 0.25) == [('b', 1.0, 1.5)]
+
+def test_run_benchmarks():
+    results = run_benchmarks('^encode', repeat=1)
+    assert results.keys() == [x for x in BENCHMARKS if x.startswith('encode')]
+    assert all(x['time'] > 0 for x in results.values())
@@ -0,0 +1,69 @@
+import numpy as np
+
+from pyDNAbinding.binding_model import (
+    FixedLengthDNASequences, PackedDNASequences )
+from pyDNAbinding.binding_site_scores import BindingSiteScores
+from pyDNAbinding.signal import ScoringWorkspace
+from pyDNAbinding.benchmark import build_random_seqs, build_random_models
+
+def test_binding_site_scores():
+    model = build_random_models(1, 8)[0]
+    seqs = build_random_seqs(3, 100) + ['ACG'] + build_random_seqs(
+        1, 20000, seed=1)
+    scores = model.build_binding_site_scores(PackedDNASequences(seqs))
+    assert len(scores) == len(seqs)
+    assert list(scores.num_sites) == [93, 93, 93, 0, 19993]
+    for i, seq in enumerate(seqs):
+        if len(seq) < model.motif_len:
+            assert len(scores[i]) == 0
+            continue
+        fwd = model.score_binding_sites(seq, 'FWD')
+        rc = model.score_binding_sites(seq, 'RC')
+        assert np.allclose(scores[i], np.maximum(fwd, rc), atol=1e-4)
+        is_clear_winner = np.abs(fwd - rc) > 1e-4
+        assert (scores.strands(i)[is_clear_winner]
+                == (rc > fwd)[is_clear_winner]).all()
+        assert scores.max_scores()[i] == scores[i].max()
+        assert scores.argmax_positions()[i] == scores[i].argmax()
+    assert scores.max_scores()[3] == -np.inf
+    assert scores.argmax_positions()[3] == -1
+    # the strands take one bit per site
+    assert scores._packed_is_rc.nbytes == (len(scores.scores) + 7)//8
+
+    sites = scores.top_sites(10)
+    assert (np.diff(sites['score']) <= 0).all()
+    assert np.allclose(
+        sites['score'], np.sort(scores.scores)[::-1][:10])
+    for site in sites:
+        assert scores[site['seq_index']][site['position']] == site['score']
+        assert scores.strands(site['seq_index'])[site['position']] \
+            == site['is_rc']
+    above = scores.sites_above(sites['score'][-1] - 1e-6)
+    assert len(above) == 10
+    assert (np.diff(above['seq_index']) >= 0).all()
+
+    regions = [('chr1', 1000*i) for i in xrange(len(seqs))]
+    lines = scores.to_bed(sites[:2], regions, 'motif').splitlines()
+    contig, start, stop, name, score, strand = lines[0].split()
+    assert contig == 'chr1' and name == 'motif'
+    assert int(start) == 1000*sites[0]['seq_index'] + sites[0]['position']
+    assert int(stop) - int(start) == model.motif_len
+    assert strand == ('-' if sites[0]['is_rc'] else '+')
+
+def test_fixed_length_binding_site_scores():
+    model = build_random_models(1, 6)[0]
+    seqs = build_random_seqs(20, 50)
+    scores = model.build_binding_site_scores(
+        FixedLengthDNASequences(seqs), ScoringWorkspace(50, 6))
+    expected = model.build_binding_site_scores(seqs)
+    assert np.allclose(scores.scores, expected.scores, atol=1e-5)
+    assert (scores.offsets == expected.offsets).all()
+    assert np.allclose(scores.scores.reshape(20, -1),
+                       FixedLengthDNASequences(seqs).score_binding_sites(
+                           model, 'MAX'), atol=1e-5)
+    try:
+        BindingSiteScores(np.zeros(5), [0, 5], np.zeros(4, dtype=bool), 6)
+    except ValueError:
+        pass
+    else:
+        assert False, "The strands don't match the scores"
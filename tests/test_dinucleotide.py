@@ -0,0 +1,97 @@
+import string
+import itertools
+
+import numpy as np
+
+from pyDNAbinding.binding_model import (
+    ConvolutionalDNABindingModel, FixedLengthDNASequences, EncodingType,
+    EnergeticDNABindingModel, DNABindingModels, build_dinucleotide_filter )
+from pyDNAbinding.sequence import (
+    one_hot_encode_sequence, dinucleotide_encode_sequence )
+from pyDNAbinding.benchmark import (
+    build_random_seqs, build_random_models, build_random_dinucleotide_models )
+
+def reverse_complement(seq):
+    return seq[::-1].translate(string.maketrans('ACGT', 'TGCA'))
+
+def test_dinucleotide_encoding():
+    seq = 'ACGTNkAT'
+    one_hot = one_hot_encode_sequence(seq)
+    coded_seq = dinucleotide_encode_sequence(seq)
+    assert coded_seq.shape == (len(seq), 16)
+    expected = (one_hot[:-1,:,None]*one_hot[1:,None,:]).reshape(-1, 16)
+    assert np.allclose(coded_seq[:-1], expected)
+    assert (coded_seq[-1] == 0).all()
+
+def test_build_dinucleotide_filter():
+    model = build_random_models(1, 8)[0]
+    dinucleotide_model = ConvolutionalDNABindingModel(
+        build_dinucleotide_filter(model.convolutional_filter))
+    assert dinucleotide_model.encoding_type == EncodingType.DINUCLEOTIDE
+    seq = build_random_seqs(1, 200)[0] + 'NNACGT'
+    for direction in ('FWD', 'RC', 'MAX'):
+        assert np.allclose(
+            dinucleotide_model.score_binding_sites(seq, direction),
+            model.score_binding_sites(seq, direction), atol=1e-5)
+    assert dinucleotide_model.consensus_seq == model.consensus_seq
+    assert np.allclose(
+        dinucleotide_model.summary.max_score, model.summary.max_score)
+
+def test_dinucleotide_model():
+    model = build_random_dinucleotide_models(1, 5)[0]
+    seq = build_random_seqs(1, 100)[0]
+    # the reverse complement scores are the forward scores of the reverse
+    # complement sequence
+    assert np.allclose(
+        model.score_binding_sites(seq, 'RC'),
+        model.score_binding_sites(reverse_complement(seq), 'FWD')[::-1],
+        atol=1e-5)
+    # brute force the best and worst binding sites
+    scores = dict(
+        ("".join(site), model.score_binding_sites("".join(site), 'FWD')[0])
+        for site in itertools.product('ACGT', repeat=5))
+    assert np.allclose(model.summary.max_score, max(scores.values()), atol=1e-5)
+    assert np.allclose(model.summary.min_score, min(scores.values()), atol=1e-5)
+    assert np.allclose(
+        model.summary.mean_score, np.mean(scores.values()), atol=1e-5)
+    assert np.allclose(
+        scores[model.consensus_seq], model.summary.max_score, atol=1e-5)
+
+    filt = np.array(model.convolutional_filter)
+    filt[-1,0] = 1.0
+    try:
+        ConvolutionalDNABindingModel(filt)
+    except ValueError:
+        pass
+    else:
+        assert False, "The last row of a dinucleotide filter must be zero"
+
+def test_dinucleotide_engines():
+    models = build_random_dinucleotide_models(3, 6)
+    seqs = FixedLengthDNASequences(build_random_seqs(20, 50))
+    expected = np.array(
+        [seqs._naive_score_binding_sites(model, 'MAX') for model in models])
+    for model, model_expected in zip(models, expected):
+        assert np.allclose(seqs._batch_score_binding_sites(model, 'MAX'),
+                           model_expected, atol=1e-5)
+    assert np.allclose(
+        seqs.score_models_binding_sites(models, 'MAX'), expected, atol=1e-5)
+
+def test_dinucleotide_energetic_model_conversions():
+    filt = build_random_dinucleotide_models(1, 6)[0].convolutional_filter
+    model = EnergeticDNABindingModel(-1.0, -np.array(filt))
+    assert model.encoding_type == EncodingType.DINUCLEOTIDE
+    assert np.allclose(model.min_energy, -model.summary.max_score)
+    # the PWM and energy helpers assume one base per row
+    for func in (lambda: model.build_pwm(0.0),
+                 lambda: DNABindingModels([model]).build_pwm_models(0.0),
+                 model.build_all_As_affinity_and_ddg_array,
+                 lambda: model.ddg_array.calc_min_energy(model.ref_energy),
+                 lambda: model.ddg_array.consensus_seq(),
+                 lambda: model.ddg_array.mean_energy):
+        try:
+            func()
+        except TypeError:
+            pass
+        else:
+            assert False, "Dinucleotide models should be rejected"
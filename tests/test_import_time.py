@@ -0,0 +1,57 @@
+"""Check that importing pyDNAbinding stays cheap.
+
+Each module is imported in a fresh interpreter, and the fastest of several
+runs, less the time it takes to import numpy (which every module needs), is
+compared against the budget - so the test doesn't depend on how fast the
+machine is. Run this file directly to print the import times of every
+module.
+"""
+import os
+import sys
+import subprocess
+
+# seconds on top of the numpy import time - can be raised for slow (e.g.
+# network file system) installs
+IMPORT_TIME_BUDGET = float(
+    os.environ.get('PYDNABINDING_IMPORT_TIME_BUDGET', 0.05))
+N_RUNS = 5
+
+SCORING_CORE_MODULES = (
+    'pyDNAbinding.binding_model', 'pyDNAbinding.signal',
+    'pyDNAbinding.sequence', 'pyDNAbinding.DB', 'pyDNAbinding.plot')
+# these should only be imported when they're used
+LAZY_DEPENDENCIES = ('yaml', 'scipy', 'matplotlib', 'shapely', 'psycopg2')
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def measure_import(module_name):
+    """Return the fastest import time of module_name and the loaded modules.
+
+    """
+    code = ("import sys, time; t = time.time(); import %s; "
+            "print time.time() - t; print ' '.join(sys.modules.keys())"
+            % module_name)
+    times = []
+    for i in xrange(N_RUNS):
+        output = subprocess.check_output(
+            [sys.executable, '-c', code], cwd=PACKAGE_DIR)
+        import_time, modules = output.split("\n", 1)
+        times.append(float(import_time))
+    return min(times), set(modules.split())
+
+def test_import_time():
+    numpy_import_time = measure_import('numpy')[0]
+    for module_name in SCORING_CORE_MODULES:
+        import_time, modules = measure_import(module_name)
+        assert import_time - numpy_import_time < IMPORT_TIME_BUDGET, \
+            "Importing %s took %.3fs (budget %.3fs + %.3fs for numpy)" % (
+                module_name, import_time, IMPORT_TIME_BUDGET,
+                numpy_import_time)
+        loaded = [x for x in LAZY_DEPENDENCIES if x in modules]
+        assert len(loaded) == 0, \
+            "Importing %s loaded %s" % (module_name, ", ".join(loaded))
+
+if __name__ == '__main__':
+    for module_name in ('numpy',) + SCORING_CORE_MODULES:
+        print "%-30s %.1f ms" % (
+            module_name, 1000*measure_import(module_name)[0])
@@ -0,0 +1,37 @@
+import itertools
+
+import numpy as np
+
+from pyDNAbinding.kmer import (
+    build_kmer_score_table, score_seq_with_kmer_table, kmer_index,
+    kmer_from_index )
+from pyDNAbinding.benchmark import build_random_seqs, build_random_models
+
+def test_kmer_index():
+    assert kmer_index('AAA') == 0
+    assert kmer_index('ACGT') == 0*64 + 1*16 + 2*4 + 3
+    for index in (0, 17, 255):
+        assert kmer_index(kmer_from_index(index, 4)) == index
+
+def test_kmer_score_table():
+    model = build_random_models(1, 4)[0]
+    for k in (4, 6):
+        for direction in ('FWD', 'RC', 'MAX'):
+            table = model.build_kmer_score_table(k, direction)
+            assert table.shape == (4**k,)
+            for kmer in itertools.islice(
+                    itertools.product('ACGT', repeat=k), 0, None, 37):
+                kmer = "".join(kmer)
+                expected = model.score_binding_sites(kmer, direction).max()
+                assert abs(table[kmer_index(kmer)] - expected) < 1e-4
+
+def test_score_seq_with_kmer_table():
+    model = build_random_models(1, 5)[0]
+    table = build_kmer_score_table(model, 7)
+    seq = build_random_seqs(1, 100)[0]
+    scores = score_seq_with_kmer_table(seq, table)
+    expected = model.score_binding_sites(seq, 'MAX')
+    expected = np.array([expected[i:i+3].max() for i in xrange(len(scores))])
+    assert np.abs(scores - expected).max() < 1e-4
+    scores = score_seq_with_kmer_table(seq[:10] + 'N' + seq[11:], table)
+    assert np.isnan(scores[4:11]).all() and not np.isnan(scores[11:]).any()
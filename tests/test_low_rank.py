@@ -0,0 +1,51 @@
+import numpy as np
+
+from pyDNAbinding.binding_model import (
+    DNABindingModels, EnergeticDNABindingModel )
+from pyDNAbinding.benchmark import build_random_seqs, build_random_models
+
+def build_redundant_models(n_models, seed=0):
+    # noisy combinations of a few base motifs, with different lengths
+    random_state = np.random.RandomState(seed)
+    base_ddg_arrays = random_state.randn(3, 12, 4)
+    models = []
+    for i in xrange(n_models):
+        motif_len = (10, 12)[i%2]
+        ddg_array = np.dot(random_state.rand(3), base_ddg_arrays.reshape(3, -1))
+        ddg_array = ddg_array.reshape(12, 4)[:motif_len]
+        ddg_array += 1e-3*random_state.randn(*ddg_array.shape)
+        models.append(EnergeticDNABindingModel(random_state.randn(), ddg_array))
+    return DNABindingModels(models)
+
+def test_low_rank_scoring():
+    models = build_redundant_models(20)
+    seq = build_random_seqs(1, 300)[0] + 'NNAC'
+    basis = models.build_low_rank_approximation(max_error=0.05)
+    assert basis.rank < 20
+    assert (models.approximation_errors <= 0.05).all()
+    for direction in ('FWD', 'RC', 'MAX'):
+        exact = models.score_binding_sites(seq, direction)
+        approx = models.score_binding_sites(seq, direction, approximate=True)
+        for model_index, (x, y) in enumerate(zip(exact, approx)):
+            assert x.shape == y.shape
+            error = np.abs(x - y).max()
+            assert error <= models.approximation_errors[model_index] + 1e-4
+
+def test_low_rank_full_rank():
+    models = DNABindingModels(build_random_models(5, 8))
+    basis = models.build_low_rank_approximation(max_error=1e-4)
+    assert basis.rank == 5
+    seq = build_random_seqs(1, 50)[0]
+    for x, y in zip(models.score_binding_sites(seq, 'MAX'),
+                    models.score_binding_sites(seq, 'MAX', approximate=True)):
+        assert np.abs(x - y).max() < 1e-3
+
+def test_low_rank_no_models():
+    models = DNABindingModels([])
+    assert models.score_binding_sites('ACGTACGT', 'MAX', approximate=True) == []
+    try:
+        models.build_low_rank_approximation()
+    except ValueError:
+        pass
+    else:
+        assert False, "A low rank basis of no models should be rejected"
@@ -0,0 +1,57 @@
+import numpy as np
+
+from pyDNAbinding.binding_model import DNABindingModels, PWMBindingModel
+from pyDNAbinding.misc import logistic
+from pyDNAbinding.benchmark import build_random_models
+
+def build_random_pwm_models(n_models, seed=0):
+    random_state = np.random.RandomState(seed)
+    models = []
+    for i in xrange(n_models):
+        counts = random_state.rand((8, 11)[i%2], 4) + 0.01
+        models.append(PWMBindingModel(
+            counts/counts.sum(1)[:,None], motif_id='PWM_%i' % i))
+    return models
+
+def loop_build_pwm(model, chem_pot):
+    # the original per position implementation
+    pwm = np.zeros((4, model.motif_len), dtype=float)
+    mean_energy = chem_pot + model.mean_energy
+    for i, base_energies in enumerate(model.ddg_array):
+        base_mut_energies = mean_energy + base_energies.mean() - base_energies
+        occs = logistic(base_mut_energies)
+        pwm[:,i] = occs/occs.sum()
+    return pwm
+
+def test_build_energetic_models():
+    pwm_models = build_random_pwm_models(5)
+    models = DNABindingModels(pwm_models).build_energetic_models()
+    for pwm_model, model in zip(pwm_models, models):
+        assert model.motif_id == pwm_model.motif_id
+        assert model.ref_energy == 0
+        assert np.allclose(model.ddg_array, -pwm_model.convolutional_filter)
+        seq = 'ACGTTGCAAGTCGATCGA'
+        assert np.allclose(model.score_binding_sites(seq, 'MAX'),
+                           pwm_model.score_binding_sites(seq, 'MAX'))
+    shape_model = pwm_models[0].build_energetic_model(include_shape=True)
+    assert shape_model.ddg_array.shape == (8, 10)
+
+def test_build_pwm_models():
+    models = build_random_models(3, 8) + build_random_models(2, 12, seed=1)
+    chem_pots = [-1.0, 0.0, 1.0, 2.0, -3.0]
+    pwm_models = DNABindingModels(models).build_pwm_models(chem_pots)
+    for model, pwm_model, chem_pot in zip(models, pwm_models, chem_pots):
+        expected = loop_build_pwm(model, chem_pot)
+        assert np.allclose(model.build_pwm(chem_pot), expected)
+        assert np.allclose(pwm_model.pwm, expected.T, atol=1e-6)
+
+def test_build_all_As_affinities_and_ddg_arrays():
+    for model in build_random_models(3, 6):
+        affinity, ddg_array = model.build_all_As_affinity_and_ddg_array()
+        assert ddg_array.shape == (3, 6)
+        # the all As sequence and a C at position 2
+        assert np.allclose(
+            -model.score_binding_sites('AAAAAA', 'FWD')[0], affinity)
+        assert np.allclose(
+            -model.score_binding_sites('AACAAA', 'FWD')[0],
+            affinity + ddg_array[0,2], atol=1e-5)
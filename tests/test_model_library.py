@@ -0,0 +1,78 @@
+from StringIO import StringIO
+
+import numpy as np
+
+from pyDNAbinding.binding_model import (
+    DNABindingModels, EnergeticDNABindingModel, PWMBindingModel,
+    load_binding_models )
+from pyDNAbinding.model_library import (
+    BindingModelLibrary, save_binding_model_library,
+    convert_yaml_to_binding_model_library, MODEL_ARRAY_NAMES )
+from pyDNAbinding.binding_model import MODEL_TYPES
+
+def build_test_models(n_models=20):
+    np.random.seed(0)
+    models = []
+    for i in xrange(n_models):
+        motif_len = np.random.randint(6, 20)
+        if i%2 == 0:
+            models.append(EnergeticDNABindingModel(
+                np.random.randn(), 
+                np.random.randn(motif_len, 4),
+                tf_id='T%i' % i, motif_id='SELEX_%i' % i, tf_name='TF%i' % i))
+        else:
+            pwm = np.random.rand(motif_len, 4)
+            models.append(PWMBindingModel(
+                pwm/pwm.sum(1)[:,None],
+                tf_id='T%i' % i, motif_id='M%i' % i, tf_name='TF%i' % i))
+    return DNABindingModels(models)
+
+def test_library_round_trip(tmpdir):
+    models = build_test_models()
+    fname = str(tmpdir.join('models.bml'))
+    save_binding_model_library(models, fname)
+    library = BindingModelLibrary(fname)
+    assert len(library) == len(models)
+    for model, library_model in zip(models, library):
+        assert type(model) is type(library_model)
+        assert model.meta_data == library_model.meta_data
+        assert (model.convolutional_filter 
+                == library_model.convolutional_filter).all()
+    assert library.get_model('M3').tf_name == 'TF3'
+    assert [m.motif_id for m in library.get_models(tf_names=['TF4', 'TF7'])
+            ] == ['SELEX_4', 'M7']
+    # every model type that the loader builds can be saved
+    assert sorted(MODEL_ARRAY_NAMES) == sorted(MODEL_TYPES)
+
+def test_yaml_round_trip(tmpdir):
+    yaml_fp = StringIO()
+    build_test_models().save(yaml_fp)
+    yaml_fname = str(tmpdir.join('models.yaml'))
+    library_fname = str(tmpdir.join('models.bml'))
+    with open(yaml_fname, 'w') as ofp:
+        ofp.write(yaml_fp.getvalue())
+    convert_yaml_to_binding_model_library(yaml_fname, library_fname)
+    assert (BindingModelLibrary(library_fname).get_models().yaml_str
+            == load_binding_models(yaml_fname).yaml_str)
+
+def test_library_lookups(tmpdir):
+    models = build_test_models(6)
+    fname = str(tmpdir.join('models.bml'))
+    save_binding_model_library(list(models) + [models[1]], fname)
+    library = BindingModelLibrary(fname)
+    assert [m.motif_id for m in library.get_models(tf_ids=['T4', 'T0'])
+            ] == ['SELEX_0', 'SELEX_4']
+    assert [m.motif_id for m in library.get_models(motif_ids='M3')] == ['M3']
+    assert len(library.get_models(tf_names=['NOT_A_TF'])) == 0
+    try:
+        library.get_model('NOT_A_MOTIF')
+    except KeyError:
+        pass
+    else:
+        assert False, "A missing motif_id should raise a KeyError"
+    try:
+        library.get_model('M1')
+    except ValueError as inst:
+        assert 'M1' in str(inst)
+    else:
+        assert False, "A duplicated motif_id should raise a ValueError"
@@ -0,0 +1,63 @@
+import itertools
+
+import numpy as np
+
+from pyDNAbinding.binding_model import (
+    DNABindingModels, EnergeticDNABindingModel )
+from pyDNAbinding.benchmark import build_random_models
+
+def brute_force_scores(model):
+    scores = [model.score_binding_sites("".join(seq), 'FWD')[0]
+              for seq in itertools.product('ACGT', repeat=model.motif_len)]
+    return np.array(scores)
+
+def test_model_summary():
+    model = build_random_models(1, 5)[0]
+    scores = brute_force_scores(model)
+    summary = model.summary
+    assert np.allclose(summary.max_score, scores.max(), atol=1e-5)
+    assert np.allclose(summary.min_score, scores.min(), atol=1e-5)
+    assert np.allclose(summary.mean_score, scores.mean(), atol=1e-5)
+    assert np.allclose(
+        model.score_binding_sites(summary.consensus_seq, 'FWD')[0],
+        scores.max(), atol=1e-5)
+    assert np.allclose(model.min_energy, -scores.max(), atol=1e-5)
+    assert np.allclose(model.max_energy, -scores.min(), atol=1e-5)
+    assert summary.suffix_max_scores[-1] == 0
+    assert np.allclose(summary.suffix_max_scores[0], summary.max_score)
+    # the summary is cached
+    assert model.summary is summary
+
+def test_model_summary_invalidation():
+    model = build_random_models(1, 6)[0]
+    summary = model.summary
+    # the filters can't be modified in place
+    try:
+        model.convolutional_filter[0,0] = 1.0
+    except ValueError:
+        pass
+    else:
+        assert False, "The convolutional filter should be read-only"
+    model.ref_energy = model.ref_energy + 1.0
+    assert model.summary is not summary
+    assert model.summary.filter_hash != summary.filter_hash
+    assert np.allclose(model.summary.max_score, summary.max_score - 1.0)
+    # an identical model has the same hash
+    same_model = EnergeticDNABindingModel(model.ref_energy, model.ddg_array)
+    assert same_model.summary.filter_hash == model.summary.filter_hash
+
+def test_model_summaries():
+    models = DNABindingModels(
+        build_random_models(3, 6) + build_random_models(2, 9, seed=1))
+    summaries = models.summaries
+    assert summaries.max_scores.shape == (5,)
+    assert summaries.suffix_max_scores.shape == (5, 10)
+    for i, model in enumerate(models):
+        assert np.allclose(summaries.max_scores[i], model.summary.max_score)
+        assert summaries.consensus_seqs[i] == model.consensus_seq
+        assert (summaries.suffix_max_scores[i,model.motif_len:] == 0).all()
+    assert models.summaries is summaries
+    models[0].ref_energy = models[0].ref_energy - 2.0
+    assert models.summaries is not summaries
+    assert np.allclose(
+        models.summaries.max_scores[0], summaries.max_scores[0] + 2.0)
@@ -0,0 +1,39 @@
+import numpy as np
+
+from pyDNAbinding.binding_model import EnergeticDNABindingModel
+from pyDNAbinding.motif_similarity import (
+    calc_motif_similarities, cluster_models, select_representative_models )
+from pyDNAbinding.benchmark import build_random_models
+
+def test_motif_similarities():
+    models = build_random_models(5, 8)
+    ddg_array = np.array(models[0].ddg_array)
+    # the same motif with extra flanking positions, on the reverse strand
+    rc_model = EnergeticDNABindingModel(
+        1.0, np.vstack((np.zeros((2, 4)), ddg_array[::-1,::-1]*2)))
+    sims = calc_motif_similarities(models + [rc_model,])
+    assert sims.similarity.shape == (6, 6)
+    assert np.allclose(np.diag(sims.similarity), 1, atol=1e-5)
+    assert sims.similarity[0,5] > 0.999
+    # the reverse complement of rc_model is the motif followed by the padding
+    assert sims.is_rc[0,5] and sims.offsets[0,5] == 0
+    assert not sims.is_rc[5,5] and sims.offsets[5,5] == 0
+    assert sims.similarity[0,1:5].max() < 0.9
+
+def test_cluster_models():
+    models = build_random_models(4, 10)
+    duplicate = EnergeticDNABindingModel(
+        0.0, np.array(models[2].ddg_array) + 0.01)
+    models = models + [duplicate,]
+    clusters = cluster_models(models, 0.9)
+    assert sorted(len(x) for x in clusters) == [1, 1, 1, 2]
+    assert [2, 4] in [sorted(x) for x in clusters]
+    assert len(select_representative_models(models, 0.9)) == 4
+
+def test_empty_model_lists():
+    models = build_random_models(2, 6)
+    sims = calc_motif_similarities([])
+    assert sims.similarity.shape == (0, 0)
+    assert calc_motif_similarities(models, []).similarity.shape == (2, 0)
+    assert cluster_models([]) == []
+    assert len(select_representative_models([])) == 0
@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+import pytest
+
+from pyDNAbinding.plot import (
+    logo_paths, model_base_frequencies, information_content_heights,
+    render_logos )
+from pyDNAbinding.binding_model import PWMBindingModel
+from pyDNAbinding.benchmark import build_random_models
+
+def test_logo_paths():
+    letter_heights = np.array([[0.5, 1.0, 0.0, 0.25],
+                               [0.0, 0.0, 2.0, 0.0]])
+    paths = logo_paths(letter_heights)
+    # A (and its hole), C, G and T
+    assert [color for color, vertices, codes in paths] == [
+        'red', 'white', 'blue', 'orange', 'green']
+    bounds = {}
+    for color, vertices, codes in paths:
+        assert len(vertices) == len(codes)
+        # one subpath per drawn letter
+        assert (codes == 1).sum() == 1
+        bounds[color] = (vertices.min(0), vertices.max(0))
+    # the letters are stacked from the shortest to the tallest
+    assert np.allclose(bounds['green'][0], [0.5, 0.0])
+    assert np.allclose(bounds['green'][1], [1.5, 0.25])
+    assert np.allclose(bounds['red'][0], [0.5, 0.25])
+    assert np.allclose(bounds['red'][1], [1.5, 0.75])
+    assert np.allclose(bounds['blue'][0], [0.5, 0.75])
+    assert np.allclose(bounds['blue'][1], [1.5, 1.75])
+    assert np.allclose(bounds['orange'][0], [1.5, 0.0])
+    assert np.allclose(bounds['orange'][1], [2.5, 2.0])
+
+def test_information_content_heights():
+    model = build_random_models(1, 6)[0]
+    freqs = model_base_frequencies(model)
+    assert np.allclose(freqs.sum(1), 1)
+    assert (freqs.argmax(1) == np.array(
+        ['ACGT'.index(x) for x in model.consensus_seq])).all()
+    pwm = np.array([[1.0, 0, 0, 0], [0.25, 0.25, 0.25, 0.25]])
+    heights = information_content_heights(
+        model_base_frequencies(PWMBindingModel(pwm)))
+    assert np.allclose(heights, [[2, 0, 0, 0], [0, 0, 0, 0]])
+
+def test_render_logos(tmpdir):
+    pytest.importorskip('matplotlib')
+    models = build_random_models(3, 8)
+    fnames = render_logos(models, str(tmpdir), processes=2, chunk_size=2)
+    assert len(fnames) == 3
+    assert all(os.path.getsize(fname) > 0 for fname in fnames)
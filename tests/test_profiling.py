@@ -0,0 +1,30 @@
+from pyDNAbinding import profiling
+from pyDNAbinding.binding_model import FixedLengthDNASequences
+from pyDNAbinding.benchmark import build_random_seqs, build_random_models
+
+def test_profile_stages():
+    seqs = build_random_seqs(10, 200)
+    model = build_random_models(1, 10)[0]
+    assert not profiling.is_enabled()
+    with profiling.profile() as stats:
+        fl_seqs = FixedLengthDNASequences(seqs)
+        fl_seqs.score_binding_sites(model, 'MAX')
+        model.score_binding_sites(seqs[0], 'MAX')
+    assert not profiling.is_enabled()
+    for name in ('encode', 'score', 'score.fixed_length_seqs',
+                 'score.strand_max', 'signal.plan'):
+        assert stats[name].calls > 0, name
+        assert stats[name].self_time <= stats[name].total_time + 1e-9
+    assert stats['encode'].bytes_allocated > 0
+    assert stats['signal.plan'].cache_hits + stats['signal.plan'].cache_misses > 0
+    assert 'score.strand_max' in profiling.report(stats)
+
+    metrics = []
+    profiling.export_metrics(lambda *args: metrics.append(args), stats)
+    assert ('pyDNAbinding.score.calls', stats['score'].calls) in metrics
+
+def test_profile_disabled():
+    profiling.reset()
+    model = build_random_models(1, 10)[0]
+    model.score_binding_sites(build_random_seqs(1, 100)[0], 'MAX')
+    assert profiling.get_stats() == {}
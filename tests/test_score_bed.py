@@ -0,0 +1,154 @@
+import os
+import gzip
+import json
+import multiprocessing
+
+import numpy as np
+
+from pyDNAbinding import score_bed
+from pyDNAbinding.score_bed import (
+    IndexedFastaFile, main, score_regions, load_models, iter_pool_results,
+    parse_arguments )
+from pyDNAbinding.aggregation import RegionScoreAggregator
+from pyDNAbinding.binding_model import DNABindingModels
+from pyDNAbinding.benchmark import build_random_seqs, build_random_models
+
+def write_test_data(tmpdir):
+    contigs = build_random_seqs(2, 1000)
+    genome_fname = str(tmpdir.join('genome.fa'))
+    with open(genome_fname, 'w') as ofp:
+        for i, seq in enumerate(contigs):
+            ofp.write(">chr%i\n" % (i+1))
+            for start in xrange(0, len(seq), 60):
+                ofp.write(seq[start:start+60] + "\n")
+    regions = [('chr%i' % (i%2+1), 10*i, 10*i+50+i%3) for i in xrange(25)]
+    bed_fname = str(tmpdir.join('regions.bed'))
+    with open(bed_fname, 'w') as ofp:
+        for region in regions:
+            ofp.write("%s\t%i\t%i\n" % region)
+    models = build_random_models(3, 8)
+    models_fname = str(tmpdir.join('models.yaml'))
+    with open(models_fname, 'w') as ofp:
+        DNABindingModels(models).save(ofp)
+    return contigs, regions, genome_fname, bed_fname, models_fname
+
+def test_indexed_fasta_file(tmpdir):
+    contigs, regions, genome_fname = write_test_data(tmpdir)[:3]
+    genome = IndexedFastaFile(genome_fname)
+    for contig, start, stop in [('chr1', 0, 10), ('chr2', 55, 185),
+                                ('chr1', 990, 1010)]:
+        assert genome.fetch(contig, start, stop) == \
+            contigs[int(contig[3:])-1][start:stop]
+
+def test_score_bed_resume(tmpdir, monkeypatch):
+    contigs, regions, genome_fname, bed_fname, models_fname = \
+        write_test_data(tmpdir)
+    args = [bed_fname, '--genome', genome_fname, '--models', models_fname,
+            '--chunk-size', '4']
+    expected_fname = str(tmpdir.join('expected.tsv.gz'))
+    assert main(args + ['--output', expected_fname]) == 0
+    with gzip.open(expected_fname) as fp:
+        expected = fp.read()
+    lines = expected.splitlines()
+    assert len(lines) == 3*len(regions)
+    assert [tuple(x.split()[:3]) for x in lines[::3]] == [
+        (contig, str(start), str(stop)) for contig, start, stop in regions]
+
+    # interrupt a run after 3 chunks, and then resume it
+    output_fname = str(tmpdir.join('output.tsv.gz'))
+    score_regions = score_bed.score_regions
+    calls = []
+    def interrupted_score_regions(*args):
+        if len(calls) == 3: raise KeyboardInterrupt
+        calls.append(1)
+        return score_regions(*args)
+    monkeypatch.setattr(score_bed, 'score_regions', interrupted_score_regions)
+    try:
+        main(args + ['--output', output_fname])
+        assert False, "The run should have been interrupted"
+    except KeyboardInterrupt:
+        pass
+    assert os.path.exists(output_fname + '.checkpoint')
+    with open(output_fname + '.checkpoint') as fp:
+        config = json.load(fp)['config']
+    assert config['models'] == os.path.abspath(models_fname)
+    monkeypatch.setattr(score_bed, 'score_regions', score_regions)
+    assert main(args + ['--output', output_fname]) == 0
+    assert not os.path.exists(output_fname + '.checkpoint')
+    with gzip.open(output_fname) as fp:
+        assert fp.read() == expected
+
+    # resuming with different aggregation parameters is an error
+    monkeypatch.setattr(score_bed, 'score_regions', interrupted_score_regions)
+    del calls[:]
+    try:
+        main(args + ['--output', output_fname])
+    except KeyboardInterrupt:
+        pass
+    try:
+        main(args + ['--output', output_fname, '--quantile-window', '2'])
+    except ValueError:
+        pass
+    else:
+        assert False, "The checkpoint is for a different quantile window"
+
+def test_score_bed_npz(tmpdir):
+    contigs, regions, genome_fname, bed_fname, models_fname = \
+        write_test_data(tmpdir)
+    output_dir = str(tmpdir.join('output'))
+    assert main([bed_fname, '--genome', genome_fname, '--models',
+                 models_fname, '--output', output_dir, '--chunk-size', '10',
+                 '--output-format', 'npz']) == 0
+    chunks = [np.load(os.path.join(output_dir, 'chunk_%06i.npz' % i))
+              for i in xrange(3)]
+    assert sum(len(x['starts']) for x in chunks) == len(regions)
+    assert chunks[0]['scores'].shape == (10, 3, 7)
+    with open(os.path.join(output_dir, 'models.json')) as fp:
+        assert len(json.load(fp)['motif_ids']) == 3
+
+def test_score_short_regions(tmpdir):
+    contigs, regions, genome_fname, bed_fname, models_fname = \
+        write_test_data(tmpdir)
+    genome = IndexedFastaFile(genome_fname)
+    # the models are 8 bases long
+    regions = [('chr1', 0, 50), ('chr1', 100, 105), ('chr2', 10, 10)]
+    scores = score_regions(
+        genome, regions, load_models(models_fname), RegionScoreAggregator())
+    assert scores.shape == (3, 3, 7)
+    assert not np.isnan(scores[0]).any()
+    assert np.isnan(scores[1:]).all()
+
+def test_score_bed_processes(tmpdir):
+    contigs, regions, genome_fname, bed_fname, models_fname = \
+        write_test_data(tmpdir)
+    args = [bed_fname, '--genome', genome_fname, '--chunk-size', '4']
+    expected_fname = str(tmpdir.join('expected.tsv.gz'))
+    assert main(args + ['--models', models_fname,
+                        '--output', expected_fname]) == 0
+    output_fname = str(tmpdir.join('output.tsv.gz'))
+    assert main(args + ['--models', models_fname, '--output', output_fname,
+                        '--processes', '2']) == 0
+    with gzip.open(expected_fname) as fp, gzip.open(output_fname) as ofp:
+        assert fp.read() == ofp.read()
+    # the workers load the models from --models
+    try:
+        parse_arguments(args + ['--output', output_fname, '--processes', '2'])
+    except SystemExit:
+        pass
+    else:
+        assert False, "--processes without --models should be rejected"
+
+def test_iter_pool_results():
+    num_read = []
+    def items():
+        for i in xrange(20):
+            num_read.append(i)
+            yield i
+    pool = multiprocessing.Pool(2)
+    try:
+        for i, result in enumerate(iter_pool_results(pool, abs, items(), 3)):
+            assert result == i
+            # the items are only read a few ahead of the results
+            assert len(num_read) <= i + 3
+    finally:
+        pool.terminate()
@@ -1,20 +1,33 @@
+import os
+import sys
+import subprocess
+
 import numpy as np
 
 import random
 
 import pyDNAbinding
+from pyDNAbinding import profiling
 from pyDNAbinding.signal import (
     multichannel_fftconvolve, 
     multichannel_overlap_add_fftconvolve, 
-    multichannel_convolve)
+    multichannel_overlap_save_convolve,
+    multichannel_direct_convolve,
+    multichannel_batch_convolve,
+    multichannel_convolve,
+    set_convolve_strategy_table,
+    load_convolve_strategy_table,
+    ScoringWorkspace)
+from pyDNAbinding.tuning import calibrate_convolve_strategies
 
 from pyDNAbinding.binding_model import (
-    DNASequence, DNASequences, FixedLengthDNASequences, 
-    ConvolutionalDNABindingModel,
-    score_coded_seq_with_convolutional_filter )
+    DNASequence, DNASequences, FixedLengthDNASequences, PackedDNASequences,
+    ConvolutionalDNABindingModel, ReducedDeltaDeltaGArray,
+    score_coded_seq_with_convolutional_filter, DEFAULT_BLAS_MEMORY_BUDGET )
 from pyDNAbinding.DB import ( 
     load_binding_models_from_db, load_selex_models_from_db, load_pwms_from_db)
 from pyDNAbinding.sequence import sample_random_seqs
+from pyDNAbinding.benchmark import build_random_seqs, build_random_models
 
 TEST_MODEL_TF_NAME = 'CTCF'
 
@@ -89,6 +102,174 @@ def test_my_fft_convolve():
             test(x, h)
     print 'PASS'
 
+def test_convolve_strategies():
+    for seq_len in (20, 100, 3000):
+        xs = FixedLengthDNASequences(
+            sample_random_seqs(5, seq_len)).one_hot_coded_seqs
+        h = np.random.rand(random.randint(1, 20), 4)
+        batch = multichannel_batch_convolve(xs, h)
+        for x, batch_res in zip(xs, batch):
+            expected = multichannel_fftconvolve(x, h)
+            for convolve in (multichannel_direct_convolve, 
+                             multichannel_overlap_add_fftconvolve,
+                             multichannel_overlap_save_convolve):
+                assert np.abs(convolve(x, h) - expected).max() < 1e-6
+            assert np.abs(batch_res - expected).max() < 1e-6
+
+def test_overlap_save_strands():
+    model = build_random_models(1, 12)[0]
+    x = FixedLengthDNASequences(
+        sample_random_seqs(1, 20000)).one_hot_coded_seqs[0]
+    rc_x = np.ascontiguousarray(x[::-1,::-1])
+    fwd = multichannel_fftconvolve(x, model.convolutional_filter[::-1,::-1])
+    rc = multichannel_fftconvolve(
+        rc_x, model.convolutional_filter[::-1,::-1])[::-1]
+    set_convolve_strategy_table(None)
+    try:
+        for direction, expected in (('FWD', fwd), ('RC', rc),
+                                    ('MAX', np.maximum(fwd, rc))):
+            scores = score_coded_seq_with_convolutional_filter(
+                x, model.convolutional_filter, direction)
+            assert np.abs(scores - expected).max() < 1e-6
+    finally:
+        load_convolve_strategy_table()
+
+# Score a 10 Mb sequence in both directions, and print the increase in peak
+# memory use and the size of the score array. This runs in a subprocess so
+# that the peak resident memory (ru_maxrss) only covers this test.
+def test_reduced_ddg_array_reverse_complement():
+    ddg_array = np.random.RandomState(0).randn(9, 5).astype('float32').view(
+        ReducedDeltaDeltaGArray)
+    ts_cont, rc_array = ddg_array.reverse_complement()
+    assert rc_array.shape == (9, 5)
+    # the positions are reversed
+    rc_array = np.asarray(rc_array)[:,::-1]
+    assert np.allclose(ts_cont, ddg_array[2].sum())
+    assert np.allclose(rc_array[0], ddg_array[1] - np.r_[ddg_array[2,:3], 0, 0])
+    assert np.allclose(rc_array[1], ddg_array[0] - np.r_[ddg_array[2,:3], 0, 0])
+    assert np.allclose(rc_array[2], -np.r_[ddg_array[2,:3], 0, 0])
+    # the shape rows are kept
+    assert np.allclose(
+        rc_array[3:], ddg_array[3:] - np.r_[ddg_array[2,:3], 0, 0])
+
+SCORING_MEMORY_SCRIPT = """
+import resource
+import numpy as np
+from pyDNAbinding.sequence import one_hot_encode_sequence
+from pyDNAbinding.benchmark import build_random_models
+bases = np.frombuffer('ACGT', dtype='S1')
+def coded_random_seq(seq_len):
+    return one_hot_encode_sequence(bases[
+        np.random.RandomState(0).randint(4, size=seq_len)].tostring())
+model = build_random_models(1, 20)[0]
+model.score_binding_sites(coded_random_seq(100000), 'MAX')
+coded_seq = coded_random_seq(10000000)
+with open('/proc/self/statm') as fp:
+    rss = int(fp.read().split()[1])*resource.getpagesize()
+scores = model.score_binding_sites(coded_seq, 'MAX')
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+print peak - rss, scores.nbytes
+"""
+
+def test_max_scoring_memory():
+    if not os.path.exists('/proc/self/statm'):
+        return
+    env = dict(os.environ)
+    # use the default strategies (overlap-save for long sequences)
+    env['PYDNABINDING_CONVOLVE_STRATEGY_TABLE'] = os.devnull + '.missing'
+    output = subprocess.check_output(
+        [sys.executable, '-c', SCORING_MEMORY_SCRIPT], env=env)
+    allocated, score_bytes = map(int, output.split())
+    # the scores are the only sequence length allocation - the rest is the
+    # per block workspace
+    assert allocated < 1.25*score_bytes, (allocated, score_bytes)
+
+def test_convolve_strategy_table():
+    table = calibrate_convolve_strategies(
+        seq_lens=(50, 500), filter_lens=(6,), batch_sizes=(1, 10), 
+        min_time=0.001)
+    assert len(table['strategies']) == 2
+    assert table['strategies'][0][0][0] in ('DIRECT', 'FFT', 'OVERLAP_ADD')
+    model = ConvolutionalDNABindingModel(np.random.rand(6, 4))
+    seqs = FixedLengthDNASequences(sample_random_seqs(10, 500))
+    expected = seqs._naive_score_binding_sites(model, 'MAX')
+    try:
+        for strategy in ('DIRECT', 'FFT', 'OVERLAP_ADD', 'BATCH'):
+            table['strategies'] = [[[strategy]]*2]*2
+            set_convolve_strategy_table(table)
+            scores = seqs.score_binding_sites(model, 'MAX')
+            assert np.abs(scores - expected).max() < 1e-6
+    finally:
+        load_convolve_strategy_table()
+
+def test_scoring_workspace():
+    model = build_random_models(1, 12)[0]
+    seqs = FixedLengthDNASequences(sample_random_seqs(10, 500))
+    expected = seqs._naive_score_binding_sites(model, 'MAX')
+    workspace = ScoringWorkspace(500, 12, batch_size=10)
+    out = np.empty_like(expected)
+    try:
+        for strategy in ('DIRECT', 'FFT', 'OVERLAP_ADD', 'BATCH'):
+            set_convolve_strategy_table({
+                'seq_lens': [500], 'filter_lens': [12], 'batch_sizes': [1],
+                'strategies': [[[strategy]]]})
+            for direction in ('FWD', 'RC', 'MAX'):
+                expected = seqs._naive_score_binding_sites(model, direction)
+                out.fill(np.nan)
+                with profiling.profile() as stats:
+                    scores = seqs.score_binding_sites(
+                        model, direction, out=out, workspace=workspace)
+                assert scores is out
+                assert np.abs(scores - expected).max() < 1e-6
+                # the preallocated buffers are large enough
+                if 'workspace' in stats:
+                    assert stats['workspace'].cache_misses == 0
+            scores = model.score_seqs_binding_sites(
+                seqs, 'MAX', out=out, workspace=workspace)
+            assert all(np.shares_memory(x, out) for x in scores)
+    finally:
+        load_convolve_strategy_table()
+
+def test_packed_seqs():
+    seqs = sample_random_seqs(20, 30) + ['ACGTN', 'acgt', '']
+    packed_seqs = PackedDNASequences(seqs)
+    assert len(packed_seqs) == len(seqs)
+    assert list(packed_seqs.seq_lens) == [len(seq) for seq in seqs]
+    assert packed_seqs.nbytes == sum(len(seq) for seq in seqs) + 8*(len(seqs)+1)
+    for seq, view in zip(seqs, packed_seqs):
+        assert str(view) == seq
+        assert (view.one_hot_coded_seq 
+                == DNASequence(seq).one_hot_coded_seq).all()
+    assert [str(x) for x in packed_seqs[3:6]] == seqs[3:6]
+    assert len(packed_seqs[5:2]) == 0
+    assert list(packed_seqs[5:2].seq_lens) == []
+    assert str(packed_seqs[-2]) == 'acgt'
+
+    model = ConvolutionalDNABindingModel(np.random.rand(5, 4))
+    for expected, scores in zip(
+            model.score_seqs_binding_sites(DNASequences(seqs[:20]), 'MAX'),
+            model.score_seqs_binding_sites(packed_seqs[:20], 'MAX')):
+        assert np.abs(expected - scores).max() < 1e-6
+    fixed_len_seqs = FixedLengthDNASequences(seqs[:20])
+    for seq, view in zip(seqs, fixed_len_seqs):
+        assert str(view) == seq
+        assert np.abs(model.score_binding_sites(view, 'MAX') 
+                      - model.score_binding_sites(seq, 'MAX')).max() < 1e-6
+
+def test_blas_scoring():
+    seqs = FixedLengthDNASequences(build_random_seqs(7, 60))
+    models = build_random_models(3, 6) + build_random_models(2, 11, seed=1)
+    for direction in ('FWD', 'RC', 'MAX'):
+        # use a small budget so that the sites are split into blocks
+        for max_memory in (DEFAULT_BLAS_MEMORY_BUDGET, 1000):
+            all_scores = seqs.score_models_binding_sites(
+                models, direction, max_memory=max_memory)
+            for model, scores in zip(models, all_scores):
+                expected = seqs.score_binding_sites(model, direction)
+                assert scores.shape == expected.shape
+                assert np.abs(scores - expected).max() < 1e-4
+    assert seqs.score_models_binding_sites([], 'MAX') == []
+
 def compare_convolve_speeds(x, h):
     from scipy.signal import fftconvolve
     import timeit
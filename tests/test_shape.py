@@ -0,0 +1,59 @@
+import itertools
+
+import numpy as np
+
+from pyDNAbinding import shape as shape_module
+from pyDNAbinding.shape import (
+    build_shape_table, pentamer_index, shape_encode_coded_seqs,
+    one_hot_plus_shape_encode_sequences, set_default_shape_table,
+    NUM_SHAPE_FEATURES )
+from pyDNAbinding.sequence import code_encode_sequences
+from pyDNAbinding.binding_model import (
+    ConvolutionalDNABindingModel, FixedLengthDNASequences,
+    reverse_complement_convolutional_filter )
+
+def build_random_shape_table():
+    np.random.seed(0)
+    return build_shape_table(dict(
+        ("".join(pentamer), np.random.rand(NUM_SHAPE_FEATURES))
+        for pentamer in itertools.product('ACGT', repeat=5)))
+
+def test_pentamer_lookup():
+    shape_table = build_random_shape_table()
+    seq = 'ACGTTGCANA'
+    shape = shape_encode_coded_seqs(
+        code_encode_sequences([seq,]), shape_table)[0]
+    for i in xrange(2, len(seq)-2):
+        pentamer = seq[i-2:i+3]
+        if 'N' in pentamer:
+            expected = shape_table.mean(0)
+        else:
+            expected = shape_table[pentamer_index(pentamer)]
+        assert np.abs(shape[i] - expected).max() < 1e-6
+    assert np.abs(shape[:2] - shape_table.mean(0)).max() < 1e-6
+
+def test_one_hot_plus_shape_scoring(monkeypatch):
+    shape_table = build_random_shape_table()
+    seqs = ['ACGTTGCAGTAC', 'TTTTGGGGCCCA']
+    coded_seqs = one_hot_plus_shape_encode_sequences(seqs, shape_table)
+    assert coded_seqs.shape == (2, 12, 10)
+
+    filt = np.random.rand(4, 10)
+    model = ConvolutionalDNABindingModel(filt)
+    assert model.encoding_type == 'ONE_HOT_PLUS_SHAPE'
+    # restore the default shape table when the test finishes
+    monkeypatch.setattr(
+        shape_module, '_default_shape_table', shape_module._default_shape_table)
+    set_default_shape_table(shape_table)
+    fixed_len_seqs = FixedLengthDNASequences(seqs)
+    for direction, f in (
+            ('FWD', filt),
+            ('RC', reverse_complement_convolutional_filter(filt))):
+        scores = fixed_len_seqs.score_binding_sites(model, direction)
+        for coded_seq, seq_scores in zip(coded_seqs, scores):
+            expected = [(coded_seq[i:i+4]*f).sum() for i in xrange(9)]
+            assert np.abs(seq_scores - expected).max() < 1e-4
+        # scoring a single sequence string should give the same result
+        assert np.abs(
+            model.score_binding_sites(seqs[0], direction) - scores[0]
+        ).max() < 1e-4
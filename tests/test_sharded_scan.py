@@ -0,0 +1,87 @@
+import os
+import multiprocessing
+
+import numpy as np
+
+from pyDNAbinding.sharded_scan import (
+    init_scan, run_worker, merge_scan, load_manifest, load_track, WorkQueue,
+    manifest_fname, main )
+from pyDNAbinding.score_bed import load_models
+from pyDNAbinding.binding_model import DNABindingModels
+from pyDNAbinding.benchmark import build_random_seqs, build_random_models
+
+def write_test_data(tmpdir):
+    contigs = build_random_seqs(1, 1000) + build_random_seqs(1, 700, seed=1)
+    genome_fname = str(tmpdir.join('genome.fa'))
+    with open(genome_fname, 'w') as ofp:
+        for i, seq in enumerate(contigs):
+            ofp.write(">chr%i\n" % (i+1))
+            for start in xrange(0, len(seq), 60):
+                ofp.write(seq[start:start+60] + "\n")
+    models = build_random_models(2, 8) + build_random_models(1, 12, seed=1)
+    models_fname = str(tmpdir.join('models.yaml'))
+    with open(models_fname, 'w') as ofp:
+        DNABindingModels(models).save(ofp)
+    return contigs, genome_fname, models_fname
+
+def crashing_worker(scan_dir):
+    # claim a unit, and die without finishing it
+    WorkQueue(scan_dir).claim('crashed', lease_seconds=1.0)
+    os._exit(1)
+
+def test_sharded_scan(tmpdir):
+    contigs, genome_fname, models_fname = write_test_data(tmpdir)
+    scan_dir = str(tmpdir.join('scan'))
+    init_scan(scan_dir, genome_fname, models_fname, chunk_size=300,
+              model_block_size=2)
+    manifest = load_manifest(scan_dir)
+    # (4 + 3 chunks) x 2 model blocks
+    assert len(manifest['units']) == 14
+    # an init that died before writing the manifest can be re-run
+    os.rename(manifest_fname(scan_dir), manifest_fname(scan_dir) + '.bak')
+    init_scan(scan_dir, genome_fname, models_fname, chunk_size=300,
+              model_block_size=2)
+    assert WorkQueue(scan_dir).status()['pending'] == 14
+    # re-initializing is a no-op, unless the arguments changed
+    init_scan(scan_dir, genome_fname, models_fname, chunk_size=300,
+              model_block_size=2)
+    try:
+        init_scan(scan_dir, genome_fname, models_fname, chunk_size=200)
+    except ValueError:
+        pass
+    else:
+        assert False, "The scan arguments changed"
+
+    crashed = multiprocessing.Process(target=crashing_worker, args=(scan_dir,))
+    crashed.start()
+    crashed.join()
+    assert WorkQueue(scan_dir).status()['running'] == 1
+    try:
+        merge_scan(scan_dir)
+    except ValueError:
+        pass
+    else:
+        assert False, "The scan isn't finished"
+
+    workers = [multiprocessing.Process(
+                   target=run_worker, args=(scan_dir, 'worker%i' % i),
+                   kwargs={'lease_seconds': 1.0, 'poll_seconds': 0.1})
+               for i in xrange(3)]
+    for worker in workers: worker.start()
+    for worker in workers: worker.join(60)
+    assert [worker.exitcode for worker in workers] == [0, 0, 0]
+    queue = WorkQueue(scan_dir)
+    assert queue.status()['done'] == 14
+    # the crashed worker's unit was claimed again after its lease expired
+    assert queue.attempts(0) == 2
+    assert len(os.listdir(os.path.join(scan_dir, 'units'))) == 14
+
+    assert main(['merge', scan_dir]) == 0
+    models = load_models(models_fname)
+    for i, seq in enumerate(contigs):
+        track = load_track(scan_dir, 'chr%i' % (i+1))
+        assert track.shape == (3, len(seq))
+        for model, model_track in zip(models, track):
+            expected = model.score_binding_sites(seq, 'MAX')
+            assert np.allclose(model_track[:len(expected)], expected, atol=1e-5)
+            assert np.isnan(model_track[len(expected):]).all()
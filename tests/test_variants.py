@@ -0,0 +1,66 @@
+import numpy as np
+
+from pyDNAbinding.variants import (
+    Variant, score_variants, saturation_mutagenesis )
+from pyDNAbinding.misc import calc_occ
+from pyDNAbinding.benchmark import build_random_seqs, build_random_models
+
+def full_rescore_delta(seq, variant, model):
+    # rescore the whole sequence, and compare the binding sites that overlap
+    # the variant by masking everything else
+    pos, ref, alt = variant.pos, variant.ref, variant.alt
+    alt_seq = seq[:pos] + alt + seq[pos+len(ref):]
+    def overlapping_max(seq, allele_len):
+        scores = model.score_binding_sites(seq, 'MAX')
+        lo = max(0, pos - model.motif_len + 1)
+        return scores[lo:pos+allele_len].max()
+    return overlapping_max(alt_seq, len(alt)) - overlapping_max(seq, len(ref))
+
+def test_score_variants():
+    seqs = build_random_seqs(2, 200)
+    models = build_random_models(3, 8) + build_random_models(1, 12, seed=1)
+    variants = [
+        Variant(0, 50, seqs[0][50], 'ACGT'.replace(seqs[0][50], '')[0]),
+        Variant(1, 3, seqs[1][3], 'G' if seqs[1][3] != 'G' else 'T'),
+        Variant(1, 100, seqs[1][100:103], seqs[1][100]),
+        Variant(0, 120, seqs[0][120], seqs[0][120] + 'TTAC'),
+        Variant(0, 195, seqs[0][195], 'A' if seqs[0][195] != 'A' else 'C'),
+    ]
+    scores = score_variants(seqs, variants, models)
+    assert scores.deltas.shape == (len(variants), len(models))
+    for i, variant in enumerate(variants):
+        for j, model in enumerate(models):
+            expected = full_rescore_delta(seqs[variant.seq_id], variant, model)
+            assert abs(scores.deltas[i,j] - expected) < 1e-3
+
+def test_score_variants_no_models():
+    seqs = build_random_seqs(1, 50)
+    try:
+        score_variants(seqs, [Variant(0, 10, seqs[0][10], 'N')], [])
+    except ValueError:
+        pass
+    else:
+        assert False, "Scoring variants without models should be rejected"
+
+def test_saturation_mutagenesis():
+    seq = build_random_seqs(1, 60)[0]
+    models = build_random_models(2, 6) + build_random_models(1, 9, seed=1)
+    for statistic in ('MAX', 'OCCUPANCY'):
+        deltas = saturation_mutagenesis(seq, models, statistic, chem_pot=-2.0)
+        assert deltas.shape == (len(seq), 4, len(models))
+        for pos in (0, 4, 30, 59):
+            for base_index, base in enumerate('ACGT'):
+                mut_seq = seq[:pos] + base + seq[pos+1:]
+                for model_index, model in enumerate(models):
+                    ref = model.score_binding_sites(seq, 'MAX')
+                    alt = model.score_binding_sites(mut_seq, 'MAX')
+                    if statistic == 'MAX':
+                        expected = alt.max() - ref.max()
+                    else:
+                        expected = sum(
+                            calc_occ(-2.0, -model.score_binding_sites(
+                                x, direction)).sum()*sign
+                            for x, sign in ((mut_seq, 1), (seq, -1))
+                            for direction in ('FWD', 'RC'))
+                    assert abs(deltas[pos, base_index, model_index]
+                               - expected) < 1e-3